@@ -39,16 +39,53 @@ CREATE TABLE IF NOT EXISTS devices (
     metadata JSONB
 );
 
--- Create device_data table for time-series data
+-- Create device_data table for time-series data, range-partitioned by month
+-- so retention can drop whole partitions instead of running DELETEs
 CREATE TABLE IF NOT EXISTS device_data (
-    id SERIAL PRIMARY KEY,
-    device_id VARCHAR(100) NOT NULL,
+    id BIGSERIAL,
+    device_pk INTEGER NOT NULL,  -- devices.id, not the external device_id
     data_type VARCHAR(50) NOT NULL,
-    value NUMERIC NOT NULL,
+    value_q SMALLINT,            -- fixed-point reading, scale per data_type (VALUE_SCALES)
+    value_raw DOUBLE PRECISION,  -- readings without a scale or out of int16 range
     unit VARCHAR(20),
-    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    metadata JSONB
-);
+    timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    metadata JSONB,
+    PRIMARY KEY (id, timestamp)
+) PARTITION BY RANGE (timestamp);
+
+-- Catches readings outside every monthly partition (late or back-dated
+-- timestamps, or a month not created yet) so inserts never fail
+CREATE TABLE IF NOT EXISTS device_data_default PARTITION OF device_data DEFAULT;
+
+-- Create the monthly partition starting at month_start (device_data_yYYYYmMM).
+-- Rows the default partition already holds for that month are moved into it,
+-- since a range the default partition has rows for cannot be attached.
+CREATE OR REPLACE FUNCTION create_device_data_partition(month_start DATE)
+RETURNS VOID AS $$
+DECLARE
+    partition_name TEXT := 'device_data_y' || to_char(month_start, 'YYYY') || 'm' || to_char(month_start, 'MM');
+    range_start DATE := date_trunc('month', month_start)::date;
+    range_end DATE := (date_trunc('month', month_start) + INTERVAL '1 month')::date;
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN;
+    END IF;
+    CREATE TEMP TABLE device_data_moved AS
+        SELECT * FROM device_data_default WHERE timestamp >= range_start AND timestamp < range_end;
+    DELETE FROM device_data_default WHERE timestamp >= range_start AND timestamp < range_end;
+    EXECUTE format(
+        'CREATE TABLE %I PARTITION OF device_data FOR VALUES FROM (%L) TO (%L)',
+        partition_name, range_start, range_end
+    );
+    INSERT INTO device_data SELECT * FROM device_data_moved;
+    DROP TABLE device_data_moved;
+END;
+$$ language 'plpgsql';
+
+-- Partitions for the current and next two months; the MQTT worker keeps
+-- creating them ahead of time (RetentionService.ensure_partitions)
+SELECT create_device_data_partition((date_trunc('month', CURRENT_DATE) + n * INTERVAL '1 month')::date)
+FROM generate_series(0, 2) AS n;
 
 -- Create automation_rules table
 CREATE TABLE IF NOT EXISTS automation_rules (
@@ -69,7 +106,7 @@ CREATE TABLE IF NOT EXISTS automation_rules (
 CREATE TABLE IF NOT EXISTS user_sessions (
     id SERIAL PRIMARY KEY,
     user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-    token_hash VARCHAR(128) NOT NULL,
+    token_hash VARCHAR(64) NOT NULL,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     expires_at TIMESTAMP NOT NULL,
     is_active BOOLEAN DEFAULT true,
@@ -81,13 +118,15 @@ CREATE TABLE IF NOT EXISTS user_sessions (
 CREATE INDEX IF NOT EXISTS idx_devices_device_id ON devices(device_id);
 CREATE INDEX IF NOT EXISTS idx_devices_user_id ON devices(user_id);
 CREATE INDEX IF NOT EXISTS idx_devices_status ON devices(status);
-CREATE INDEX IF NOT EXISTS idx_device_data_device_id ON device_data(device_id);
+CREATE INDEX IF NOT EXISTS idx_device_data_device_pk ON device_data(device_pk);
 CREATE INDEX IF NOT EXISTS idx_device_data_timestamp ON device_data(timestamp);
+CREATE INDEX IF NOT EXISTS idx_device_data_device_ts ON device_data(device_pk, timestamp);
+CREATE INDEX IF NOT EXISTS idx_device_data_device_type_ts ON device_data(device_pk, data_type, timestamp);
 CREATE INDEX IF NOT EXISTS idx_device_data_type ON device_data(data_type);
 CREATE INDEX IF NOT EXISTS idx_automation_rules_user_id ON automation_rules(user_id);
 CREATE INDEX IF NOT EXISTS idx_automation_rules_active ON automation_rules(is_active);
-CREATE INDEX IF NOT EXISTS idx_user_sessions_user_id ON user_sessions(user_id);
-CREATE INDEX IF NOT EXISTS idx_user_sessions_active ON user_sessions(is_active);
+CREATE INDEX IF NOT EXISTS idx_user_sessions_user_active_exp ON user_sessions(user_id, is_active, expires_at);
+CREATE INDEX IF NOT EXISTS idx_user_sessions_token_hash ON user_sessions(token_hash);
 
 -- Create triggers for updated_at timestamps
 CREATE OR REPLACE FUNCTION update_updated_at_column()
@@ -6,18 +6,106 @@ and sends it to the cloud platform via MQTT.
 """
 
 import paho.mqtt.client as mqtt
-import json
+import numpy as np
 import time
-import random
+import re
+import queue
 import threading
-from datetime import datetime
 import logging
 import argparse
 
+# Prefer orjson, then ujson, then stdlib json
+try:
+    import orjson
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+    try:
+        import ujson as json
+    except ImportError:
+        import json
+    json_dumps = json.dumps
+    json_loads = json.loads
+
+# Numba is optional: it JIT-compiles the random-walk update when installed
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+COLLECTION_INTERVAL = 5.0  # Seconds between data collection cycles
+
+# Command topics addressed to a single device: devices/<device_id>/commands
+_CMD_RE = re.compile(r"^devices/([^/]+)/commands$")
+
+def _now_ms():
+    """Current time as integer epoch milliseconds (the wire timestamp format)"""
+    return time.time_ns() // 1_000_000
+
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _update_walk(state, noise, low, high):
+        for i in prange(state.size):
+            state[i] = min(high, max(low, state[i] + noise[i]))
+else:
+    def _update_walk(state, noise, low, high):
+        state += noise
+        np.clip(state, low, high, out=state)
+
+def _random_walk(state, rng, step, low, high):
+    """Advance every device's reading by a bounded random step, in place"""
+    # Keep within realistic range
+    _update_walk(state, rng.uniform(-step, step, size=state.size), float(low), float(high))
+    return state.round(1).tolist()
+
+def _generate_temperature(rng, state, n):
+    # Simulate temperature with some variation
+    return {"temperature": _random_walk(state, rng, 0.5, 15.0, 30.0)}
+
+def _generate_humidity(rng, state, n):
+    # Simulate humidity
+    return {"humidity": _random_walk(state, rng, 2.0, 30.0, 70.0)}
+
+def _generate_motion(rng, state, n):
+    # Simulate motion detection (binary)
+    return {"motion": (rng.random(n) < 0.2).astype(np.uint8).tolist()}  # 20% chance of motion
+
+def _generate_smart_light(rng, state, n):
+    # Simulate smart light with brightness and color
+    brightness = rng.integers(0, 101, size=n)
+    is_on = rng.random(n) < 0.5
+    return {
+        "brightness": brightness.tolist(),
+        "is_on": is_on.tolist(),
+        "power_consumption": np.where(is_on, (brightness * 0.1).round(2), 0).tolist()
+    }
+
+def _generate_door(rng, state, n):
+    # Simulate door sensor (open/closed)
+    return {"is_open": (rng.random(n) < 0.25).tolist()}  # 25% chance of open
+
+def _generate_generic(rng, state, n):
+    # Generic sensor
+    return {"value": rng.uniform(0, 100, size=n).round(2).tolist()}
+
+# device_type -> (vectorized value generator, units, initial walk value)
+SENSOR_MODELS = {
+    "temperature_sensor": (_generate_temperature, {"temperature": "°C"}, 22.0),
+    "humidity_sensor": (_generate_humidity, {"humidity": "%"}, 45.0),
+    "motion_sensor": (_generate_motion, {"motion": "boolean"}, None),
+    "smart_light": (_generate_smart_light, {
+        "brightness": "%",
+        "is_on": "boolean",
+        "power_consumption": "W"
+    }, None),
+    "door_sensor": (_generate_door, {"is_open": "boolean"}, None),
+}
+GENERIC_SENSOR_MODEL = (_generate_generic, {"value": "units"}, None)
+
 class IoTDeviceSimulator:
     """Simulates different types of IoT devices"""
     
@@ -25,135 +113,127 @@ class IoTDeviceSimulator:
         self.device_id = device_id
         self.device_type = device_type
         self.location = location
-        self.last_values = {}
         
-    def generate_data(self):
-        """Generate realistic sensor data based on device type"""
-        timestamp = datetime.utcnow().isoformat()
+        # Static per-device metadata, built once instead of on every publish
+        self.data_topic = f"devices/{device_id}/data"
+        self.status_topic = f"devices/{device_id}/status"
+        self.command_topic = f"devices/{device_id}/commands"
+        self.units = SENSOR_MODELS.get(device_type, GENERIC_SENSOR_MODEL)[1]
+        self._base = {
+            "device_id": device_id,
+            "device_type": device_type,
+            "location": location
+        }
         
-        if self.device_type == "temperature_sensor":
-            # Simulate temperature with some variation
-            base_temp = self.last_values.get('temperature', 22.0)
-            temperature = base_temp + random.uniform(-0.5, 0.5)
-            temperature = max(15.0, min(30.0, temperature))  # Keep within realistic range
-            self.last_values['temperature'] = temperature
-            
-            return {
-                "device_id": self.device_id,
-                "device_type": self.device_type,
-                "location": self.location,
-                "timestamp": timestamp,
-                "data": {
-                    "temperature": round(temperature, 1)
-                },
-                "units": {
-                    "temperature": "°C"
-                }
-            }
-            
-        elif self.device_type == "humidity_sensor":
-            # Simulate humidity
-            base_humidity = self.last_values.get('humidity', 45.0)
-            humidity = base_humidity + random.uniform(-2.0, 2.0)
-            humidity = max(30.0, min(70.0, humidity))
-            self.last_values['humidity'] = humidity
-            
-            return {
-                "device_id": self.device_id,
-                "device_type": self.device_type,
-                "location": self.location,
-                "timestamp": timestamp,
-                "data": {
-                    "humidity": round(humidity, 1)
-                },
-                "units": {
-                    "humidity": "%"
-                }
-            }
-            
-        elif self.device_type == "motion_sensor":
-            # Simulate motion detection (binary)
-            motion = random.choice([0, 0, 0, 0, 1])  # 20% chance of motion
-            
-            return {
-                "device_id": self.device_id,
-                "device_type": self.device_type,
-                "location": self.location,
-                "timestamp": timestamp,
-                "data": {
-                    "motion": motion
-                },
-                "units": {
-                    "motion": "boolean"
-                }
-            }
-            
-        elif self.device_type == "smart_light":
-            # Simulate smart light with brightness and color
-            brightness = random.randint(0, 100)
-            is_on = random.choice([True, False])
-            
-            return {
-                "device_id": self.device_id,
-                "device_type": self.device_type,
-                "location": self.location,
-                "timestamp": timestamp,
-                "data": {
-                    "brightness": brightness,
-                    "is_on": is_on,
-                    "power_consumption": round(brightness * 0.1, 2) if is_on else 0
-                },
-                "units": {
-                    "brightness": "%",
-                    "is_on": "boolean",
-                    "power_consumption": "W"
-                }
-            }
-            
-        elif self.device_type == "door_sensor":
-            # Simulate door sensor (open/closed)
-            is_open = random.choice([True, False, False, False])  # 25% chance of open
-            
-            return {
-                "device_id": self.device_id,
-                "device_type": self.device_type,
-                "location": self.location,
-                "timestamp": timestamp,
-                "data": {
-                    "is_open": is_open
-                },
-                "units": {
-                    "is_open": "boolean"
-                }
-            }
-            
-        else:
-            # Generic sensor
-            return {
-                "device_id": self.device_id,
-                "device_type": self.device_type,
-                "location": self.location,
-                "timestamp": timestamp,
-                "data": {
-                    "value": round(random.uniform(0, 100), 2)
-                },
-                "units": {
-                    "value": "units"
-                }
-            }
+    def build_payload(self, data, ts_ms):
+        """Wrap one set of sensor readings in the device's data message"""
+        return {
+            **self._base,
+            "timestamp": ts_ms,
+            "data": data,
+            "units": self.units
+        }
+
+class DeviceGroup:
+    """
+    Devices of a single type whose readings are generated together.
+    Random-walk state is kept as one NumPy array for the whole group.
+    """
+    
+    def __init__(self, device_type):
+        self.device_type = device_type
+        self._generate, self.units, self._initial = SENSOR_MODELS.get(device_type, GENERIC_SENSOR_MODEL)
+        self.devices = []
+        self.state = np.empty(0)
+    
+    def add(self, device):
+        self.devices.append(device)
+        if self._initial is not None:
+            self.state = np.append(self.state, self._initial)
+    
+    def generate(self, rng):
+        """Yield (device, data) pairs for one collection cycle"""
+        columns = self._generate(rng, self.state, len(self.devices))
+        fields = list(columns)
+        for device, values in zip(self.devices, zip(*columns.values())):
+            yield device, dict(zip(fields, values))
+
+class MessageDispatcher:
+    """
+    Bounded outbound queue drained by a single publisher thread.
+    Producers never block: when the queue is full the message is dropped,
+    since a fresher reading will follow. An optional rate limit spaces out
+    publishes so bursts do not flood the broker.
+    """
+    
+    def __init__(self, client, max_pending=10000, rate_limit=0):
+        self.client = client
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.interval = 1.0 / rate_limit if rate_limit else 0.0
+        self.dropped = 0
+        self._thread = None
+    
+    def submit(self, topic, payload):
+        """Queue a message for publishing; returns False if it was dropped"""
+        try:
+            self.queue.put_nowait((topic, payload))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning(f"Outbound queue full, {self.dropped} messages dropped so far")
+            return False
+    
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def stop(self, timeout=5):
+        """Publish everything already queued, then stop the publisher thread"""
+        if self._thread is None:
+            return
+        self.queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+    
+    def _run(self):
+        next_at = time.monotonic()
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.interval:
+                now = time.monotonic()
+                if next_at > now:
+                    time.sleep(next_at - now)
+                next_at = max(next_at, now) + self.interval
+            try:
+                self.client.publish(*item)
+            except Exception as e:
+                logger.error(f"Error publishing to {item[0]}: {e}")
 
 class EdgeGatewaySimulator:
     """Simulates an edge gateway that manages multiple IoT devices"""
     
-    def __init__(self, gateway_id, mqtt_broker='localhost', mqtt_port=1883):
+    def __init__(self, gateway_id, mqtt_broker='localhost', mqtt_port=1883, batch_size=0, rate_limit=0):
         self.gateway_id = gateway_id
         self.mqtt_broker = mqtt_broker
         self.mqtt_port = mqtt_port
+        self.batch_size = batch_size  # 0 publishes one message per device
+        self.batch_topic = f"gateway/{gateway_id}/batch"
         self.devices = []
+        self._devices_by_id = {}
+        self._device_summary = []  # gateway status "devices" list, kept in step with self.devices
+        self._groups = {}  # device_type -> DeviceGroup
+        self._rng = np.random.default_rng()
+        self._cycle = 0
         self.client = mqtt.Client()
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
         self.client.on_disconnect = self.on_disconnect
+        # QoS 0 publishes never wait on the broker; allow plenty in flight
+        self.client.max_inflight_messages_set(1000)
+        self.dispatcher = MessageDispatcher(self.client, rate_limit=rate_limit)
         self.is_running = False
         
     def on_connect(self, client, userdata, flags, rc):
@@ -161,8 +241,8 @@ class EdgeGatewaySimulator:
         if rc == 0:
             logger.info(f"Gateway {self.gateway_id} connected to MQTT broker")
             # Subscribe to command topics for all devices
-            for device in self.devices:
-                client.subscribe(f"devices/{device.device_id}/commands")
+            for device in self._devices_by_id.values():
+                client.subscribe(device.command_topic)
         else:
             logger.error(f"Failed to connect to MQTT broker, return code {rc}")
     
@@ -173,20 +253,21 @@ class EdgeGatewaySimulator:
     def on_message(self, client, userdata, msg):
         """Handle incoming MQTT messages (commands)"""
         try:
-            topic_parts = msg.topic.split('/')
-            if len(topic_parts) >= 3 and topic_parts[2] == 'commands':
-                device_id = topic_parts[1]
-                command = json.loads(msg.payload.decode())
-                logger.info(f"Received command for device {device_id}: {command}")
-                # Here you would implement device command handling
-                self.handle_device_command(device_id, command)
+            m = _CMD_RE.match(msg.topic)
+            if not m:
+                return
+            device_id = m.group(1)
+            command = json_loads(msg.payload)
+            logger.info(f"Received command for device {device_id}: {command}")
+            # Here you would implement device command handling
+            self.handle_device_command(device_id, command)
         except Exception as e:
             logger.error(f"Error processing command: {e}")
     
     def handle_device_command(self, device_id, command):
         """Handle commands sent to devices"""
         # Find the device
-        device = next((d for d in self.devices if d.device_id == device_id), None)
+        device = self._devices_by_id.get(device_id)
         if device:
             logger.info(f"Executing command on {device_id}: {command}")
             # Simulate command execution
@@ -202,31 +283,43 @@ class EdgeGatewaySimulator:
         """Add a simulated device to the gateway"""
         device = IoTDeviceSimulator(device_id, device_type, location)
         self.devices.append(device)
+        self._devices_by_id[device_id] = device
+        self._device_summary.append({"device_id": device_id, "type": device_type, "location": location})
+        group = self._groups.get(device_type)
+        if group is None:
+            group = self._groups[device_type] = DeviceGroup(device_type)
+        group.add(device)
         logger.info(f"Added device: {device_id} ({device_type}) in {location}")
     
-    def publish_device_data(self, device):
+    def publish_device_data(self, device, readings, ts_ms):
         """Publish data from a device to MQTT"""
         try:
-            data = device.generate_data()
-            topic = f"devices/{device.device_id}/data"
-            payload = json.dumps(data)
-            self.client.publish(topic, payload)
+            data = device.build_payload(readings, ts_ms)
+            payload = json_dumps(data)
+            self.dispatcher.submit(device.data_topic, payload)
             logger.debug(f"Published data for {device.device_id}: {data['data']}")
         except Exception as e:
             logger.error(f"Error publishing device data: {e}")
     
+    def publish_batch(self, messages):
+        """Publish several device data messages as a single gateway batch"""
+        try:
+            self.dispatcher.submit(self.batch_topic, json_dumps(messages))
+            logger.debug(f"Published batch of {len(messages)} device messages")
+        except Exception as e:
+            logger.error(f"Error publishing device batch: {e}")
+    
     def publish_device_status(self, device, status="online"):
         """Publish device status to MQTT"""
         try:
             status_data = {
                 "device_id": device.device_id,
                 "status": status,
-                "timestamp": datetime.utcnow().isoformat(),
+                "timestamp": _now_ms(),
                 "gateway_id": self.gateway_id
             }
-            topic = f"devices/{device.device_id}/status"
-            payload = json.dumps(status_data)
-            self.client.publish(topic, payload)
+            payload = json_dumps(status_data)
+            self.dispatcher.submit(device.status_topic, payload)
             logger.debug(f"Published status for {device.device_id}: {status}")
         except Exception as e:
             logger.error(f"Error publishing device status: {e}")
@@ -237,36 +330,57 @@ class EdgeGatewaySimulator:
             gateway_data = {
                 "gateway_id": self.gateway_id,
                 "status": "online",
-                "timestamp": datetime.utcnow().isoformat(),
+                "timestamp": _now_ms(),
                 "device_count": len(self.devices),
-                "devices": [{"device_id": d.device_id, "type": d.device_type, "location": d.location} 
-                           for d in self.devices]
+                "devices": self._device_summary
             }
             topic = f"gateway/{self.gateway_id}/status"
-            payload = json.dumps(gateway_data)
-            self.client.publish(topic, payload)
+            payload = json_dumps(gateway_data)
+            self.dispatcher.submit(topic, payload)
             logger.debug(f"Published gateway status")
         except Exception as e:
             logger.error(f"Error publishing gateway status: {e}")
     
     def data_collection_loop(self):
         """Main loop for collecting and publishing device data"""
+        deadline = time.monotonic()
         while self.is_running:
             try:
-                # Publish data from all devices
-                for device in self.devices:
-                    self.publish_device_data(device)
+                # One timestamp shared by every reading in this cycle
+                ts_ms = _now_ms()
+                
+                # Generate readings per device type in one vectorized pass
+                batch = []
+                for group in self._groups.values():
+                    for device, readings in group.generate(self._rng):
+                        if not self.batch_size:
+                            self.publish_device_data(device, readings, ts_ms)
+                            continue
+                        batch.append(device.build_payload(readings, ts_ms))
+                        if len(batch) >= self.batch_size:
+                            self.publish_batch(batch)
+                            batch = []
+                if batch:
+                    self.publish_batch(batch)
                     
                 # Publish gateway status every 10 cycles
-                if random.randint(1, 10) == 1:
+                self._cycle += 1
+                if self._cycle % 10 == 0:
                     self.publish_gateway_status()
                 
-                # Wait before next collection cycle
-                time.sleep(5)  # Collect data every 5 seconds
+                # Wait until the next cycle is due, so publish work does not add to the interval
+                deadline += COLLECTION_INTERVAL
+                sleep_for = deadline - time.monotonic()
+                if sleep_for > 0:
+                    time.sleep(sleep_for)
+                elif sleep_for < -COLLECTION_INTERVAL:
+                    # More than a cycle behind: skip missed cycles rather than bursting
+                    deadline = time.monotonic()
                 
             except Exception as e:
                 logger.error(f"Error in data collection loop: {e}")
                 time.sleep(1)
+                deadline = time.monotonic()
     
     def start(self):
         """Start the edge gateway simulator"""
@@ -274,6 +388,10 @@ class EdgeGatewaySimulator:
             # Connect to MQTT broker
             self.client.connect(self.mqtt_broker, self.mqtt_port, 60)
             self.client.loop_start()
+            self.dispatcher.start()
+            
+            # Compile the random-walk kernel now rather than on the first cycle
+            _update_walk(np.zeros(1), np.zeros(1), 0.0, 1.0)
             
             # Publish initial device statuses
             for device in self.devices:
@@ -297,6 +415,7 @@ class EdgeGatewaySimulator:
         for device in self.devices:
             self.publish_device_status(device, "offline")
         
+        self.dispatcher.stop()
         self.client.loop_stop()
         self.client.disconnect()
         logger.info(f"Edge Gateway {self.gateway_id} stopped")
@@ -308,11 +427,16 @@ def main():
     parser.add_argument('--mqtt-broker', default='localhost', help='MQTT broker host')
     parser.add_argument('--mqtt-port', type=int, default=1883, help='MQTT broker port')
     parser.add_argument('--duration', type=int, default=300, help='Simulation duration in seconds')
+    parser.add_argument('--batch-size', type=int, default=0,
+                        help='Device messages per gateway batch publish (0 publishes per device)')
+    parser.add_argument('--rate-limit', type=float, default=0,
+                        help='Maximum MQTT publishes per second (0 for unlimited)')
     
     args = parser.parse_args()
     
     # Create edge gateway
-    gateway = EdgeGatewaySimulator(args.gateway_id, args.mqtt_broker, args.mqtt_port)
+    gateway = EdgeGatewaySimulator(args.gateway_id, args.mqtt_broker, args.mqtt_port,
+                                   args.batch_size, args.rate_limit)
     
     # Add simulated devices
     gateway.add_device("temp_001", "temperature_sensor", "Living Room")
@@ -0,0 +1,27 @@
+"""
+Gunicorn configuration for the IoT Platform backend.
+Run with: gunicorn -c gunicorn.conf.py src.main:app
+"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv('GUNICORN_WORKERS', (os.cpu_count() or 1) * 2 + 1))
+# gthread by default: bcrypt and the pandas analytics run CPU-bound in the
+# request, which a gevent worker would let block every other connection
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))  # gevent/eventlet only
+timeout = 60
+keepalive = 5
+accesslog = '-'
+errorlog = '-'
+
+def post_fork(server, worker):
+    # psycopg2 waits in C and would block the gevent hub; psycogreen is optional
+    if worker_class == 'gevent':
+        try:
+            from psycogreen.gevent import patch_psycopg
+        except ImportError:
+            server.log.warning('psycogreen not installed; database calls will block gevent workers')
+        else:
+            patch_psycopg()
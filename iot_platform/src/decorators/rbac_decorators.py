@@ -1,178 +1,186 @@
 """
 RBAC Decorators for Flask routes
 """
-from flask import request, jsonify, current_app
+from flask import request, jsonify, current_app, g
 from functools import wraps
-from src.models.user import User, UserSession
+from src.models.user import User, UserSession, perm_mask
 import hashlib
 
-def token_required(f):
-    """Decorator to require authentication for routes"""
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        token = None
-        
-        # Get token from header
-        if 'Authorization' in request.headers:
-            auth_header = request.headers['Authorization']
-            try:
-                token = auth_header.split(" ")[1]  # Bearer <token>
-            except IndexError:
-                return jsonify({'error': 'Invalid token format'}), 401
-        
-        if not token:
-            return jsonify({'error': 'Token is missing'}), 401
-        
-        try:
-            # Verify token
-            current_user = User.verify_token(token, current_app.config['SECRET_KEY'])
-            if current_user is None:
-                return jsonify({'error': 'Token is invalid or expired'}), 401
-            
-            if not current_user.is_active:
-                return jsonify({'error': 'User account is disabled'}), 401
-                
-        except Exception as e:
-            return jsonify({'error': 'Token verification failed'}), 401
-        
-        return f(current_user, *args, **kwargs)
+def invalidate(token):
+    """Drop a token from the verification cache (e.g. on logout)"""
+    User.invalidate_token(token)
+
+def _get_bearer():
+    """
+    Return (token, error_response) from the Authorization header.
+    Exactly one of the two is None.
+    """
+    auth_header = request.headers.get('Authorization')
+    if auth_header is None:
+        return None, (jsonify({'error': 'Token is missing'}), 401)
+    
+    try:
+        token = auth_header.split(" ")[1]  # Bearer <token>
+    except IndexError:
+        return None, (jsonify({'error': 'Invalid token format'}), 401)
     
-    return decorated
+    if not token:
+        return None, (jsonify({'error': 'Token is missing'}), 401)
+    return token, None
 
-def permission_required(resource, action):
-    """Decorator to require specific permissions"""
+def _is_admin(user):
+    return user.is_superuser or (user.user_role is not None and user.user_role.name in ['admin', 'super_admin'])
+
+def auth_required(permission=None, any_permissions=None, role=None, superuser=False,
+                  admin=False, owner_fn=None, organization_member=False):
+    """
+    Single authentication/authorization decorator for Flask routes.
+    
+    The bearer token is parsed and verified once, then the requested checks run
+    inline before the view is called with the current user:
+      permission          -- (resource, action) tuple the user must hold
+      any_permissions     -- list of (resource, action); the user must hold one
+      role                -- role name the user must have (superusers bypass)
+      superuser           -- require is_superuser
+      admin               -- require admin/super_admin role or superuser
+      owner_fn            -- with permission, also admit the owner of the resource;
+                             called with the resource id, returns the owner's user id
+      organization_member -- require membership of kwargs['organization_id']
+    """
+    # Everything derived from the decorator arguments is computed once, here
+    perm_str = '%s:%s' % tuple(permission) if permission is not None else None
+    any_mask = perm_mask(any_permissions) if any_permissions is not None else None
+    any_perm_list = [f'{r}:{a}' for r, a in any_permissions] if any_permissions is not None else None
+    
     def decorator(f):
         @wraps(f)
-        @token_required
-        def decorated(current_user, *args, **kwargs):
-            if not current_user.has_permission(resource, action):
+        def decorated(*args, **kwargs):
+            token, error = _get_bearer()
+            if error:
+                return error
+            
+            try:
+                # Verify token
+                current_user = User.verify_token(token, current_app.config['SECRET_KEY'])
+                if current_user is None:
+                    return jsonify({'error': 'Token is invalid or expired'}), 401
+                
+                if not current_user.is_active:
+                    return jsonify({'error': 'User account is disabled'}), 401
+                    
+            except Exception as e:
+                return jsonify({'error': 'Token verification failed'}), 401
+            
+            auth = g.auth = current_user.auth_context()
+            
+            if superuser and not current_user.is_superuser:
+                return jsonify({
+                    'error': 'Superuser privileges required',
+                    'user_role': current_user.role_name
+                }), 403
+            
+            if admin and not _is_admin(current_user):
+                return jsonify({
+                    'error': 'Admin privileges required',
+                    'user_role': current_user.role_name
+                }), 403
+            
+            if role is not None and not current_user.is_superuser:  # Superusers bypass role checks
+                if not current_user.user_role or current_user.user_role.name != role:
+                    return jsonify({
+                        'error': f'Role "{role}" required',
+                        'user_role': current_user.role_name
+                    }), 403
+            
+            if permission is not None and not auth.has_permission(*permission):
+                if not (owner_fn and _owns_resource(current_user, owner_fn, kwargs)):
+                    if owner_fn:
+                        message = 'Access denied. You must either own this resource or have the required permission.'
+                    else:
+                        message = 'Insufficient permissions'
+                    return jsonify({
+                        'error': message,
+                        'required_permission': perm_str,
+                        'user_role': current_user.role_name
+                    }), 403
+            
+            if any_mask is not None and not auth.has_any_permission(any_mask):
                 return jsonify({
                     'error': 'Insufficient permissions',
-                    'required_permission': f'{resource}:{action}',
-                    'user_role': current_user.user_role.name if current_user.user_role else 'No role assigned'
+                    'required_permissions': any_perm_list,
+                    'user_role': current_user.role_name
                 }), 403
+            
+            if organization_member:
+                organization_id = kwargs.get('organization_id')
+                if not organization_id:
+                    return jsonify({'error': 'Organization ID required'}), 400
+                
+                # Superusers and admins can access any organization
+                if not _is_admin(current_user):
+                    # Check if user is a member of the organization
+                    from src.models.organization import OrganizationMember
+                    membership = OrganizationMember.query.filter_by(
+                        user_id=current_user.id,
+                        organization_id=organization_id
+                    ).first()
+                    
+                    if not membership:
+                        return jsonify({
+                            'error': 'You are not a member of this organization',
+                            'organization_id': organization_id
+                        }), 403
+            
             return f(current_user, *args, **kwargs)
         return decorated
     return decorator
 
+def _owns_resource(user, get_owner_func, kwargs):
+    """Check whether the user owns the resource addressed by the route kwargs"""
+    resource_id = kwargs.get('id') or kwargs.get('device_id') or kwargs.get('user_id')
+    if resource_id:
+        try:
+            return get_owner_func(resource_id) == user.id
+        except Exception:
+            pass
+    return False
+
+# Named shorthands for auth_required, kept for existing routes
+
+def token_required(f):
+    """Decorator to require authentication for routes"""
+    return auth_required()(f)
+
+def permission_required(resource, action):
+    """Decorator to require specific permissions"""
+    return auth_required(permission=(resource, action))
+
 def any_permission_required(permissions):
     """Decorator to require any of the specified permissions"""
-    def decorator(f):
-        @wraps(f)
-        @token_required
-        def decorated(current_user, *args, **kwargs):
-            if not current_user.has_any_permission(permissions):
-                return jsonify({
-                    'error': 'Insufficient permissions',
-                    'required_permissions': [f'{r}:{a}' for r, a in permissions],
-                    'user_role': current_user.user_role.name if current_user.user_role else 'No role assigned'
-                }), 403
-            return f(current_user, *args, **kwargs)
-        return decorated
-    return decorator
+    return auth_required(any_permissions=permissions)
 
 def superuser_required(f):
     """Decorator to require superuser privileges"""
-    @wraps(f)
-    @token_required
-    def decorated(current_user, *args, **kwargs):
-        if not current_user.is_superuser:
-            return jsonify({
-                'error': 'Superuser privileges required',
-                'user_role': current_user.user_role.name if current_user.user_role else 'No role assigned'
-            }), 403
-        return f(current_user, *args, **kwargs)
-    return decorated
+    return auth_required(superuser=True)(f)
 
 def role_required(role_name):
     """Decorator to require a specific role"""
-    def decorator(f):
-        @wraps(f)
-        @token_required
-        def decorated(current_user, *args, **kwargs):
-            if not current_user.user_role or current_user.user_role.name != role_name:
-                if not current_user.is_superuser:  # Superusers bypass role checks
-                    return jsonify({
-                        'error': f'Role "{role_name}" required',
-                        'user_role': current_user.user_role.name if current_user.user_role else 'No role assigned'
-                    }), 403
-            return f(current_user, *args, **kwargs)
-        return decorated
-    return decorator
+    return auth_required(role=role_name)
 
 def admin_required(f):
     """Decorator to require admin role or superuser"""
-    @wraps(f)
-    @token_required
-    def decorated(current_user, *args, **kwargs):
-        if not current_user.is_superuser:
-            if not current_user.user_role or current_user.user_role.name not in ['admin', 'super_admin']:
-                return jsonify({
-                    'error': 'Admin privileges required',
-                    'user_role': current_user.user_role.name if current_user.user_role else 'No role assigned'
-                }), 403
-        return f(current_user, *args, **kwargs)
-    return decorated
+    return auth_required(admin=True)(f)
 
 def owner_or_permission_required(resource, action, get_owner_func):
     """
     Decorator that allows access if user owns the resource OR has the required permission
     get_owner_func should be a function that takes the resource_id and returns the owner_id
     """
-    def decorator(f):
-        @wraps(f)
-        @token_required
-        def decorated(current_user, *args, **kwargs):
-            # Check if user has the required permission
-            if current_user.has_permission(resource, action):
-                return f(current_user, *args, **kwargs)
-            
-            # Check if user owns the resource
-            resource_id = kwargs.get('id') or kwargs.get('device_id') or kwargs.get('user_id')
-            if resource_id:
-                try:
-                    owner_id = get_owner_func(resource_id)
-                    if owner_id == current_user.id:
-                        return f(current_user, *args, **kwargs)
-                except Exception:
-                    pass
-            
-            return jsonify({
-                'error': 'Access denied. You must either own this resource or have the required permission.',
-                'required_permission': f'{resource}:{action}',
-                'user_role': current_user.user_role.name if current_user.user_role else 'No role assigned'
-            }), 403
-        return decorated
-    return decorator
+    return auth_required(permission=(resource, action), owner_fn=get_owner_func)
 
 def organization_member_required(f):
     """Decorator to require organization membership"""
-    @wraps(f)
-    @token_required
-    def decorated(current_user, *args, **kwargs):
-        organization_id = kwargs.get('organization_id')
-        if not organization_id:
-            return jsonify({'error': 'Organization ID required'}), 400
-        
-        # Superusers and admins can access any organization
-        if current_user.is_superuser or (current_user.user_role and current_user.user_role.name in ['admin', 'super_admin']):
-            return f(current_user, *args, **kwargs)
-        
-        # Check if user is a member of the organization
-        from src.models.organization import OrganizationMember
-        membership = OrganizationMember.query.filter_by(
-            user_id=current_user.id,
-            organization_id=organization_id
-        ).first()
-        
-        if not membership:
-            return jsonify({
-                'error': 'You are not a member of this organization',
-                'organization_id': organization_id
-            }), 403
-        
-        return f(current_user, *args, **kwargs)
-    return decorated
+    return auth_required(organization_member=True)(f)
 
 def validate_request_data(required_fields=None, optional_fields=None):
     """Decorator to validate request data"""
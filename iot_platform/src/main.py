@@ -1,10 +1,19 @@
 import os
 import sys
+import threading
 # DON'T CHANGE THIS !!!
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
+from collections.abc import Mapping
+from decimal import Decimal
+import sqlite3
+import click
+import orjson
 from flask import Flask, send_from_directory
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from src.models.user import db, User, UserSession, Role, Permission
 from src.routes.user import user_bp
 from src.routes.device import device_bp
@@ -14,14 +23,42 @@ from src.routes.matter_thread import matter_thread_bp
 from src.routes.analytics import analytics_bp
 from src.routes.billing import billing_bp
 from src.routes.rbac import rbac_bp
-from src.models.device import Device, DeviceData, AutomationRule, ThreadNetwork
+from src.models.device import Device, DeviceData, DeviceMatterThread, AutomationRule, ThreadNetwork
 from src.models.organization import Organization, Location, Room, OrganizationMember
-from src.models.billing import Subscription, Invoice, PaymentMethod, UsageRecord
+from src.models.billing import Subscription, Invoice, PaymentMethod, UsageRecord, UsageSummary
 from src.services.rbac_service import RBACService
+from src.services.retention_service import RetentionService
 from src.services.mqtt_service import init_mqtt_service
 from src.services.automation_engine import init_automation_engine, create_sample_rules
 
+class OrjsonProvider(JSONProvider):
+    """Serialize jsonify() and request.get_json() with orjson"""
+    options = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+    @staticmethod
+    def _default(o):
+        if isinstance(o, Decimal):
+            return float(o)
+        if isinstance(o, Mapping):  # e.g. read-only MappingProxyType config
+            return dict(o)
+        if hasattr(o, '__html__'):
+            return str(o.__html__())
+        raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self._default, option=self.options).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # orjson already produces UTF-8 bytes, so skip the str round trip
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self._default, option=self.options)
+        return self._app.response_class(body, mimetype='application/json')
+
 app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
+app.json = OrjsonProvider(app)
 app.config['SECRET_KEY'] = 'asdf#FGSgvasgf$5$WGT'
 
 # Enable CORS for all routes
@@ -39,50 +76,104 @@ app.register_blueprint(rbac_bp, url_prefix='/api/rbac')
 # uncomment if you need to use database
 app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(os.path.dirname(__file__), 'database', 'app.db')}"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# A request holds one pooled connection, so the pool must cover a worker's
+# concurrency: GUNICORN_THREADS for gthread, far more for gevent workers
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': int(os.getenv('DB_POOL_SIZE', 10)),
+    'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 20)),
+    'pool_recycle': 1800,  # Seconds; replace connections before server-side idle timeouts
+}
 db.init_app(app)
-with app.app_context():
-    db.create_all()
 
-# Initialize MQTT service
-mqtt_service = init_mqtt_service(app)
+@event.listens_for(Engine, 'connect')
+def _configure_sqlite(dbapi_connection, connection_record):
+    # Telemetry arrives as many small commits. In WAL mode with synchronous=NORMAL
+    # a commit appends to the log without an fsync (checkpoints still sync), and
+    # readers no longer block the writer. A power loss can drop the last few
+    # commits but never corrupts the database.
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
 
-# Initialize automation engine
-automation_engine = init_automation_engine(app)
+# MQTT ingestion and the automation engine must run in exactly one process,
+# so under gunicorn they only start where MQTT_WORKER=1 (see `flask mqtt-worker`)
+mqtt_service = None
+automation_engine = None
 
-# Create sample automation rules (only if none exist)
-with app.app_context():
-    if AutomationRule.query.count() == 0:
-        create_sample_rules()
+def start_background_services():
+    """Connect to the MQTT broker and start the automation engine"""
+    global mqtt_service, automation_engine
+    if mqtt_service is not None:
+        return
     
-    # Initialize RBAC system
-    RBACService.initialize_default_roles_and_permissions()
-    print("RBAC system initialized with default roles and permissions")
+    # Initialize MQTT service
+    mqtt_service = init_mqtt_service(app)
     
-    # Create default admin user if no users exist
-    if User.query.count() == 0:
-        # Get admin role
-        admin_role = Role.query.filter_by(name='admin').first()
-        user_role = Role.query.filter_by(name='user').first()
+    # Initialize automation engine
+    automation_engine = init_automation_engine(app)
+
+def seed_database():
+    """Create tables and seed default roles, users and sample automation rules"""
+    with app.app_context():
+        db.create_all()
+        
+        # Create sample automation rules (only if none exist)
+        if AutomationRule.query.count() == 0:
+            create_sample_rules()
         
-        admin_user = User(
-            username='admin',
-            email='admin@iot-platform.com',
-            role_id=admin_role.id if admin_role else None,
-            is_superuser=True
-        )
-        admin_user.set_password('admin123')
+        # Initialize RBAC system
+        RBACService.initialize_default_roles_and_permissions()
+        print("RBAC system initialized with default roles and permissions")
         
-        demo_user = User(
-            username='demo',
-            email='demo@iot-platform.com',
-            role_id=user_role.id if user_role else None
-        )
-        demo_user.set_password('demo123')
+        # Create default admin user if no users exist
+        if User.query.count() == 0:
+            # Get admin role
+            admin_role = Role.query.filter_by(name='admin').first()
+            user_role = Role.query.filter_by(name='user').first()
         
-        db.session.add(admin_user)
-        db.session.add(demo_user)
-        db.session.commit()
-        print("Created default users: admin/admin123 and demo/demo123")
+            admin_user = User(
+                username='admin',
+                email='admin@iot-platform.com',
+                role_id=admin_role.id if admin_role else None,
+                is_superuser=True
+            )
+            admin_user.set_password('admin123')
+        
+            demo_user = User(
+                username='demo',
+                email='demo@iot-platform.com',
+                role_id=user_role.id if user_role else None
+            )
+            demo_user.set_password('demo123')
+        
+            db.session.add(admin_user)
+            db.session.add(demo_user)
+            db.session.commit()
+            print("Created default users: admin/admin123 and demo/demo123")
+
+@app.cli.command('seed')
+def seed_command():
+    """Create tables and seed default data."""
+    seed_database()
+
+@app.cli.command('mqtt-worker')
+def mqtt_worker_command():
+    """Run MQTT ingestion and the automation engine in this process."""
+    start_background_services()
+    threading.Event().wait()
+
+@app.cli.command('purge-device-data')
+@click.option('--days', default=90, show_default=True, help='Keep telemetry newer than this many days.')
+def purge_device_data_command(days):
+    """Drop expired telemetry and create upcoming partitions."""
+    RetentionService.ensure_partitions()
+    result = RetentionService.purge_device_data(days)
+    print(f"Purged device data: {result}")
+
+if os.getenv('MQTT_WORKER') == '1':
+    start_background_services()
 
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
@@ -102,4 +193,7 @@ def serve(path):
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # Development server only; production runs under gunicorn (see gunicorn.conf.py)
+    seed_database()
+    start_background_services()
+    app.run(host='0.0.0.0', port=5000, debug=os.getenv('FLASK_DEBUG') == '1')
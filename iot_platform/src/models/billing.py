@@ -1,8 +1,18 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects import postgresql, sqlite
 from datetime import datetime, timedelta
-import json
-
-db = SQLAlchemy()
+from typing import Optional
+from dataclasses import dataclass, field
+from sqlalchemy import select
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import Mapped, mapped_column, Session, object_session
+from types import MappingProxyType
+from src.models.user import db, utcnow
+from src.services.cache_service import cache
+import hashlib
+import orjson
+import os
+import sys
 
 class Subscription(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -15,8 +25,8 @@ class Subscription(db.Model):
     canceled_at = db.Column(db.DateTime, nullable=True)
     trial_start = db.Column(db.DateTime, nullable=True)
     trial_end = db.Column(db.DateTime, nullable=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = db.Column(db.DateTime, server_default=utcnow())
+    updated_at = db.Column(db.DateTime, server_default=utcnow(), onupdate=datetime.utcnow)
     
     # Relationships
     user = db.relationship('User', backref='subscription')
@@ -31,45 +41,147 @@ class Subscription(db.Model):
             'user_id': self.user_id,
             'plan_id': self.plan_id,
             'status': self.status,
-            'current_period_start': self.current_period_start.isoformat() if self.current_period_start else None,
-            'current_period_end': self.current_period_end.isoformat() if self.current_period_end else None,
+            'current_period_start': self.current_period_start,
+            'current_period_end': self.current_period_end,
             'cancel_at_period_end': self.cancel_at_period_end,
-            'canceled_at': self.canceled_at.isoformat() if self.canceled_at else None,
-            'trial_start': self.trial_start.isoformat() if self.trial_start else None,
-            'trial_end': self.trial_end.isoformat() if self.trial_end else None,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+            'canceled_at': self.canceled_at,
+            'trial_start': self.trial_start,
+            'trial_end': self.trial_end,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
         }
 
+# Cached subscription snapshots (to_dict() output), keyed by user
+SUBSCRIPTION_CACHE_TTL = 30 * 60  # seconds
+
+def _subscription_cache_key(user_id):
+    return f"sub:{user_id}"
+
+def get_subscription_cached(user_id):
+    """
+    Return the user's subscription as a to_dict() snapshot, or None.
+    Datetimes come back as ISO strings. For changes, load the model instead.
+    """
+    key = _subscription_cache_key(user_id)
+    data = cache.get(key)
+    if data is None:
+        subscription = db.session.execute(
+            db.select(Subscription).where(Subscription.user_id == user_id)
+        ).scalars().first()
+        if subscription is None:
+            return None
+        data = orjson.loads(orjson.dumps(subscription.to_dict()))
+        cache.set(key, data, SUBSCRIPTION_CACHE_TTL)
+    return data
+
+@db.event.listens_for(Subscription, 'after_insert')
+@db.event.listens_for(Subscription, 'after_update')
+@db.event.listens_for(Subscription, 'after_delete')
+def _invalidate_subscription_cache(mapper, connection, target):
+    # These run at flush; deleting now would let a concurrent read re-cache the
+    # pre-commit row, so the delete waits for the commit
+    session = object_session(target)
+    if session is None:
+        cache.delete(_subscription_cache_key(target.user_id))
+    else:
+        session.info.setdefault(_STALE_SUBSCRIPTIONS, set()).add(target.user_id)
+
+_STALE_SUBSCRIPTIONS = 'stale_subscriptions'  # Session.info key
+
+@db.event.listens_for(Session, 'after_commit')
+def _drop_stale_subscriptions(session):
+    for user_id in session.info.pop(_STALE_SUBSCRIPTIONS, ()):
+        cache.delete(_subscription_cache_key(user_id))
+
+@db.event.listens_for(Session, 'after_rollback')
+def _discard_stale_subscriptions(session):
+    session.info.pop(_STALE_SUBSCRIPTIONS, None)
+
+@dataclass(slots=True)
+class InvoiceOut:
+    """Invoice listing row built from Invoice.select_out(); see DeviceOut"""
+    id: int
+    subscription_id: int
+    invoice_number: str
+    amount_cents: int
+    amount: float = field(init=False)
+    currency: Optional[str]
+    status: Optional[str]
+    description: Optional[str]
+    due_date: datetime
+    paid_at: Optional[datetime]
+    created_at: Optional[datetime]
+    updated_at: Optional[datetime]
+    
+    def __post_init__(self):
+        self.amount = self.amount_cents / 100
+
+@dataclass(slots=True)
+class PaymentMethodOut:
+    """Payment method listing row built from PaymentMethod.select_out()"""
+    id: int
+    user_id: int
+    type: str
+    brand: Optional[str]
+    last4: Optional[str]
+    exp_month: Optional[int]
+    exp_year: Optional[int]
+    is_default: Optional[bool]
+    created_at: Optional[datetime]
+    updated_at: Optional[datetime]
+
 class Invoice(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     subscription_id = db.Column(db.Integer, db.ForeignKey('subscription.id'), nullable=False)
     invoice_number = db.Column(db.String(50), unique=True, nullable=False)
-    amount = db.Column(db.Numeric(10, 2), nullable=False)
+    amount_cents = db.Column(db.BigInteger, nullable=False)  # Integer minor units, no Decimal math
     currency = db.Column(db.String(3), default='USD')
     status = db.Column(db.String(20), default='pending')  # pending, paid, failed, canceled
     description = db.Column(db.Text, nullable=True)
     due_date = db.Column(db.DateTime, nullable=False)
     paid_at = db.Column(db.DateTime, nullable=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = db.Column(db.DateTime, server_default=utcnow())
+    updated_at = db.Column(db.DateTime, server_default=utcnow(), onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        # Invoice listings are per subscription, newest first
+        db.Index('ix_invoice_sub_created', 'subscription_id', 'created_at'),
+    )
     
     def __repr__(self):
         return f'<Invoice {self.invoice_number}>'
     
+    @hybrid_property
+    def amount(self):
+        """Amount in currency units, for display"""
+        return self.amount_cents / 100
+    
+    @staticmethod
+    def new_number():
+        """Random INV-XXXXXXXX number (8 uppercase hex digits), without building a UUID"""
+        return 'INV-' + os.urandom(4).hex().upper()
+    
+    @classmethod
+    def select_out(cls):
+        """Column select whose rows construct InvoiceOut, without loading Invoice objects"""
+        return select(cls.id, cls.subscription_id, cls.invoice_number, cls.amount_cents,
+                      cls.currency, cls.status, cls.description, cls.due_date, cls.paid_at,
+                      cls.created_at, cls.updated_at)
+    
     def to_dict(self):
         return {
             'id': self.id,
             'subscription_id': self.subscription_id,
             'invoice_number': self.invoice_number,
-            'amount': float(self.amount),
+            'amount_cents': self.amount_cents,
+            'amount': self.amount,
             'currency': self.currency,
             'status': self.status,
             'description': self.description,
-            'due_date': self.due_date.isoformat() if self.due_date else None,
-            'paid_at': self.paid_at.isoformat() if self.paid_at else None,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+            'due_date': self.due_date,
+            'paid_at': self.paid_at,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
         }
 
 class PaymentMethod(db.Model):
@@ -81,8 +193,8 @@ class PaymentMethod(db.Model):
     exp_month = db.Column(db.Integer, nullable=True)
     exp_year = db.Column(db.Integer, nullable=True)
     is_default = db.Column(db.Boolean, default=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = db.Column(db.DateTime, server_default=utcnow())
+    updated_at = db.Column(db.DateTime, server_default=utcnow(), onupdate=datetime.utcnow)
     
     # Relationships
     user = db.relationship('User', backref='payment_methods')
@@ -90,6 +202,12 @@ class PaymentMethod(db.Model):
     def __repr__(self):
         return f'<PaymentMethod {self.id} - {self.type}>'
     
+    @classmethod
+    def select_out(cls):
+        """Column select whose rows construct PaymentMethodOut"""
+        return select(cls.id, cls.user_id, cls.type, cls.brand, cls.last4, cls.exp_month,
+                      cls.exp_year, cls.is_default, cls.created_at, cls.updated_at)
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -100,23 +218,29 @@ class PaymentMethod(db.Model):
             'exp_month': self.exp_month,
             'exp_year': self.exp_year,
             'is_default': self.is_default,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
         }
 
 class UsageRecord(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    metric_type = db.Column(db.String(50), nullable=False)  # devices, automations, api_calls, storage
-    usage_count = db.Column(db.Integer, default=0)
-    period_start = db.Column(db.DateTime, nullable=False)
-    period_end = db.Column(db.DateTime, nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user_id: Mapped[int] = mapped_column(db.ForeignKey('user.id'))
+    metric_type: Mapped[str] = mapped_column(db.String(50))  # devices, automations, api_calls, storage
+    usage_count: Mapped[Optional[int]] = mapped_column(default=0)
+    period_start: Mapped[datetime]
+    period_end: Mapped[datetime]
+    created_at: Mapped[Optional[datetime]] = mapped_column(server_default=utcnow())
+    updated_at: Mapped[Optional[datetime]] = mapped_column(server_default=utcnow(), onupdate=datetime.utcnow)
     
     # Relationships
     user = db.relationship('User', backref='usage_records')
     
+    __table_args__ = (
+        # Usage lookups filter by user and metric over a billing period
+        db.Index('ix_usage_user_metric_period', 'user_id', 'metric_type', 'period_start'),
+    )
+    __mapper_args__ = {'eager_defaults': True}
+    
     def __repr__(self):
         return f'<UsageRecord {self.id} - {self.metric_type}>'
     
@@ -126,17 +250,88 @@ class UsageRecord(db.Model):
             'user_id': self.user_id,
             'metric_type': self.metric_type,
             'usage_count': self.usage_count,
-            'period_start': self.period_start.isoformat() if self.period_start else None,
-            'period_end': self.period_end.isoformat() if self.period_end else None,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+            'period_start': self.period_start,
+            'period_end': self.period_end,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
         }
+    
+    @staticmethod
+    def record_usage(user_id, metric_type, period_start, period_end, amount=1):
+        """Add usage to the period's UsageRecord and its UsageSummary rollup (caller commits)"""
+        record = UsageRecord.query.filter_by(
+            user_id=user_id,
+            metric_type=metric_type,
+            period_start=period_start
+        ).first()
+        if record is None:
+            record = UsageRecord(
+                user_id=user_id,
+                metric_type=metric_type,
+                usage_count=0,
+                period_start=period_start,
+                period_end=period_end
+            )
+            db.session.add(record)
+        record.usage_count = (record.usage_count or 0) + amount
+        UsageSummary.increment(user_id, metric_type, period_start, amount)
+        return record
+
+class UsageSummary(db.Model):
+    """
+    Running usage total per user, metric and billing period.
+    Kept up to date incrementally so limit checks are a primary-key lookup
+    instead of an aggregate over UsageRecord rows.
+    Only usage written through UsageRecord.record_usage() lands here, so
+    /billing/usage keeps reading UsageRecord until metering goes through it.
+    """
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    metric_type = db.Column(db.String(50), primary_key=True)
+    period_start = db.Column(db.DateTime, primary_key=True)
+    total = db.Column(db.Integer, default=0, nullable=False)
+    
+    def __repr__(self):
+        return f'<UsageSummary {self.user_id} - {self.metric_type}: {self.total}>'
+    
+    @staticmethod
+    def get_total(user_id, metric_type, period_start):
+        summary = db.session.get(UsageSummary, (user_id, metric_type, period_start))
+        return summary.total if summary else 0
+    
+    @staticmethod
+    def increment(user_id, metric_type, period_start, amount=1):
+        """Atomically add to a period's total, creating the row on first use"""
+        dialect = db.session.get_bind().dialect.name
+        if dialect == 'postgresql':
+            insert = postgresql.insert
+        elif dialect == 'sqlite':
+            insert = sqlite.insert
+        else:
+            summary = db.session.get(UsageSummary, (user_id, metric_type, period_start))
+            if summary is None:
+                summary = UsageSummary(user_id=user_id, metric_type=metric_type,
+                                       period_start=period_start, total=0)
+                db.session.add(summary)
+            summary.total += amount
+            return
+        
+        stmt = insert(UsageSummary).values(
+            user_id=user_id,
+            metric_type=metric_type,
+            period_start=period_start,
+            total=amount
+        )
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=['user_id', 'metric_type', 'period_start'],
+            set_={'total': UsageSummary.total + stmt.excluded.total}
+        ))
 
 # Subscription plans configuration
-SUBSCRIPTION_PLANS = {
+_PLANS = {
     'basic': {
         'name': 'Basic',
         'price': 9.99,
+        'price_cents': 999,
         'interval': 'month',
         'features': [
             'Up to 10 devices',
@@ -154,6 +349,7 @@ SUBSCRIPTION_PLANS = {
     'professional': {
         'name': 'Professional',
         'price': 29.99,
+        'price_cents': 2999,
         'interval': 'month',
         'features': [
             'Up to 100 devices',
@@ -172,6 +368,7 @@ SUBSCRIPTION_PLANS = {
     'enterprise': {
         'name': 'Enterprise',
         'price': 99.99,
+        'price_cents': 9999,
         'interval': 'month',
         'features': [
             'Unlimited devices',
@@ -190,3 +387,25 @@ SUBSCRIPTION_PLANS = {
         }
     }
 }
+
+def _freeze(value):
+    """Recursively make plan data read-only: dicts become mapping proxies, lists tuples"""
+    if isinstance(value, dict):
+        return MappingProxyType({sys.intern(k): _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+SUBSCRIPTION_PLANS = _freeze(_PLANS)
+
+# The catalog is static, so its JSON is encoded once here rather than per response
+SUBSCRIPTION_PLANS_JSON = orjson.dumps(_PLANS)
+SUBSCRIPTION_PLANS_ETAG = hashlib.blake2b(SUBSCRIPTION_PLANS_JSON, digest_size=8).hexdigest()
+PLAN_DETAILS_JSON = MappingProxyType({plan_id: orjson.dumps(plan) for plan_id, plan in _PLANS.items()})
+
+# Plan limits as (devices, automations, api_calls, storage) tuples
+LIMIT_METRICS = ('devices', 'automations', 'api_calls', 'storage')
+SUBSCRIPTION_LIMITS = MappingProxyType({
+    plan_id: tuple(plan['limits'][metric] for metric in LIMIT_METRICS)
+    for plan_id, plan in SUBSCRIPTION_PLANS.items()
+})
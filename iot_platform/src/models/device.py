@@ -1,21 +1,212 @@
+import math
 from flask_sqlalchemy import SQLAlchemy
+from typing import Optional
+from dataclasses import dataclass
+from types import MappingProxyType
+from sqlalchemy import insert, select, case, cast, func
+from sqlalchemy.ext.hybrid import hybrid_property, Comparator
+from sqlalchemy.orm import Mapped, mapped_column, load_only, raiseload
+from sqlalchemy.dialects.postgresql import JSONB
 from datetime import datetime
-from src.models.user import db
+from src.models.user import db, utcnow
+from src.models.organization import Room, count_children
+
+# JSON documents: native JSONB on PostgreSQL, generic JSON (text) elsewhere
+JSONType = db.JSON().with_variant(JSONB(), 'postgresql')
+
+@dataclass(slots=True)
+class DeviceOut:
+    """Device listing row; orjson encodes dataclasses natively, without an intermediate dict"""
+    id: int
+    device_id: str
+    name: str
+    device_type: str
+    location: Optional[str]
+    status: Optional[str]
+    last_seen: Optional[datetime]
+    created_at: Optional[datetime]
+    user_id: int
+    room_id: Optional[int]
+    room: Optional[dict]
+    config: Optional[dict]
+    matter_commissioned: Optional[bool]
+    thread_enabled: Optional[bool]
+
+@dataclass(slots=True)
+class DeviceDataOut:
+    """Serialized telemetry reading, see DeviceOut"""
+    id: int
+    device_id: str
+    timestamp: datetime
+    data_type: str
+    value: float
+    unit: Optional[str]
+
+@dataclass(slots=True)
+class ThreadNetworkOut:
+    """Thread network listing row built from ThreadNetwork.select_out()"""
+    id: int
+    name: str
+    network_name: str
+    extended_pan_id: str
+    channel: int
+    mesh_local_prefix: Optional[str]
+    is_active: Optional[bool]
+    created_at: Optional[datetime]
+    updated_at: Optional[datetime]
+    user_id: int
+    devices_count: int
+
+@dataclass(slots=True)
+class AutomationRuleOut:
+    """Automation rule listing row built from AutomationRule.select_out()"""
+    id: int
+    name: str
+    description: Optional[str]
+    trigger_device_id: str
+    trigger_condition: dict
+    action_device_id: str
+    action_command: dict
+    is_active: Optional[bool]
+    created_at: Optional[datetime]
+    user_id: int
 
 class Device(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    device_id = db.Column(db.String(100), unique=True, nullable=False)
-    name = db.Column(db.String(100), nullable=False)
-    device_type = db.Column(db.String(50), nullable=False)  # sensor, actuator, gateway
-    location = db.Column(db.String(100), nullable=True)  # Legacy field, kept for backward compatibility
-    status = db.Column(db.String(20), default='offline')  # online, offline, error
-    last_seen = db.Column(db.DateTime, default=datetime.utcnow)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    room_id = db.Column(db.Integer, db.ForeignKey('room.id'), nullable=True)  # New field for room association
+    id: Mapped[int] = mapped_column(primary_key=True)
+    device_id: Mapped[str] = mapped_column(db.String(100), unique=True)
+    name: Mapped[str] = mapped_column(db.String(100))
+    device_type: Mapped[str] = mapped_column(db.String(50))  # sensor, actuator, gateway
+    location: Mapped[Optional[str]] = mapped_column(db.String(100))  # Legacy field, kept for backward compatibility
+    status: Mapped[Optional[str]] = mapped_column(db.String(20), default='offline')  # online, offline, error
+    last_seen: Mapped[Optional[datetime]] = mapped_column(server_default=utcnow())
+    created_at: Mapped[Optional[datetime]] = mapped_column(server_default=utcnow())
+    user_id: Mapped[int] = mapped_column(db.ForeignKey('user.id'))
+    room_id: Mapped[Optional[int]] = mapped_column(db.ForeignKey('room.id'))  # New field for room association
     
     # Device-specific configuration stored as JSON
-    config = db.Column(db.Text, nullable=True)
+    config: Mapped[Optional[dict]] = mapped_column(JSONType)
+    
+    # Protocol flags stay on the hot row so listings can filter on them;
+    # the rest of the Matter/Thread detail lives in DeviceMatterThread
+    matter_commissioned: Mapped[Optional[bool]] = mapped_column(default=False)  # Commissioning status
+    thread_enabled: Mapped[Optional[bool]] = mapped_column(default=False)  # Thread support enabled
+    thread_network_id: Mapped[Optional[int]] = mapped_column(db.ForeignKey('thread_network.id'))  # Link to Thread network
+    
+    # Relationships
+    room: Mapped[Optional['Room']] = db.relationship(back_populates='devices', lazy='selectin')  # Serialized by to_dict
+    thread_network: Mapped[Optional['ThreadNetwork']] = db.relationship(back_populates='devices')
+    # Never loaded implicitly; load it with selectinload/joinedload where protocol detail is needed
+    matter_ext: Mapped[Optional['DeviceMatterThread']] = db.relationship(lazy='raise', cascade='all, delete-orphan')
+    
+    # Fetch server-generated values in the INSERT/UPDATE itself (RETURNING) instead of on next access
+    __mapper_args__ = {'eager_defaults': True}
+    
+    __table_args__ = (
+        # "My devices", optionally filtered by status
+        db.Index('ix_device_user_status', 'user_id', 'status'),
+        # Room listings, optionally narrowed to the owner
+        db.Index('ix_device_room_user', 'room_id', 'user_id'),
+        # Thread network device listings and diagnostics
+        db.Index('ix_device_thread_network', 'thread_network_id'),
+        # External device_id -> id lookups are equality only; a hash index stays small
+        db.Index('ix_device_device_id_hash', 'device_id', postgresql_using='hash').ddl_if(dialect='postgresql'),
+        # Containment queries on config (config @> '{...}'), PostgreSQL only
+        db.Index('ix_device_config_gin', 'config', postgresql_using='gin').ddl_if(dialect='postgresql'),
+    )
+    
+    def __repr__(self):
+        return f'<Device {self.name} ({self.device_id})>'
+    
+    def get_matter_ext(self):
+        """Return the Matter/Thread side row, creating it on first use"""
+        if self.matter_ext is None:
+            self.matter_ext = DeviceMatterThread()
+        return self.matter_ext
+    
+    @classmethod
+    def minimal_select(cls, user_id=None):
+        """
+        SELECT of only the columns to_dict_minimal() needs. Every other
+        column and relationship raises on access instead of lazy loading.
+        """
+        query = select(cls).options(
+            load_only(cls.id, cls.device_id, cls.name, cls.status, cls.room_id, raiseload=True),
+            raiseload('*')
+        )
+        if user_id is not None:
+            query = query.where(cls.user_id == user_id)
+        return query
+    
+    @classmethod
+    def list_minimal(cls, user_id=None):
+        return db.session.scalars(cls.minimal_select(user_id)).all()
+    
+    def to_dict_minimal(self):
+        return {
+            'id': self.id,
+            'device_id': self.device_id,
+            'name': self.name,
+            'status': self.status,
+            'room_id': self.room_id
+        }
+    
+    @classmethod
+    def list_out(cls, *criteria):
+        """
+        DeviceOut rows for a listing, read as plain columns instead of Device
+        objects. Each distinct room is loaded and serialized once.
+        """
+        return [device for batch in cls.iter_out(*criteria) for device in batch]
+    
+    @classmethod
+    def iter_out(cls, *criteria, batch_size=None):
+        """
+        Lists of DeviceOut for a listing. With batch_size the rows come from a
+        server-side cursor, so only one batch is held in memory at a time.
+        """
+        query = select(
+            cls.id, cls.device_id, cls.name, cls.device_type, cls.location, cls.status,
+            cls.last_seen, cls.created_at, cls.user_id, cls.room_id,
+            cls.config, cls.matter_commissioned, cls.thread_enabled
+        ).where(*criteria)
+        if batch_size:
+            batches = db.session.execute(query.execution_options(yield_per=batch_size)).partitions()
+        else:
+            batches = [db.session.execute(query).all()]
+        rooms = {}
+        for rows in batches:
+            room_ids = {row.room_id for row in rows if row.room_id is not None} - rooms.keys()
+            if room_ids:
+                rooms.update((room.id, room.to_dict()) for room in db.session.scalars(select(Room).where(Room.id.in_(room_ids))))
+            yield [DeviceOut(*row[:10], rooms.get(row.room_id), *row[10:]) for row in rows]
+    
+    def to_dict(self):
+        data = {
+            'id': self.id,
+            'device_id': self.device_id,
+            'name': self.name,
+            'device_type': self.device_type,
+            'location': self.location,  # Legacy field
+            'status': self.status,
+            'last_seen': self.last_seen,
+            'created_at': self.created_at,
+            'user_id': self.user_id,
+            'room_id': self.room_id,
+            'room': self.room.to_dict() if self.room else None,
+            'config': self.config,
+            'matter_commissioned': self.matter_commissioned,
+            'thread_enabled': self.thread_enabled
+        }
+        # Protocol detail is only included when the query loaded it
+        if 'matter_ext' not in db.inspect(self).unloaded and self.matter_ext:
+            data.update(self.matter_ext.to_dict())
+        return data
+
+class DeviceMatterThread(db.Model):
+    """Matter/Thread protocol detail for a Device, split out to keep the device row narrow"""
+    __tablename__ = 'device_matter_thread'
+    
+    id = db.Column(db.Integer, db.ForeignKey('device.id', ondelete='CASCADE'), primary_key=True)
     
     # Matter Protocol Support
     matter_vendor_id = db.Column(db.String(20), nullable=True)  # Matter Vendor ID
@@ -24,11 +215,9 @@ class Device(db.Model):
     matter_fabric_id = db.Column(db.String(50), nullable=True)  # Matter Fabric ID
     matter_node_id = db.Column(db.String(50), nullable=True)  # Matter Node ID
     matter_certificate = db.Column(db.Text, nullable=True)  # Matter device certificate
-    matter_commissioned = db.Column(db.Boolean, default=False)  # Commissioning status
     matter_commissioning_date = db.Column(db.DateTime, nullable=True)  # When device was commissioned
     
     # Thread Protocol Support
-    thread_enabled = db.Column(db.Boolean, default=False)  # Thread support enabled
     thread_network_name = db.Column(db.String(100), nullable=True)  # Thread network name
     thread_network_key = db.Column(db.String(100), nullable=True)  # Thread network key (encrypted)
     thread_extended_pan_id = db.Column(db.String(50), nullable=True)  # Thread Extended PAN ID
@@ -37,35 +226,20 @@ class Device(db.Model):
     thread_border_router = db.Column(db.Boolean, default=False)  # Is this device a Thread border router
     thread_router_role = db.Column(db.String(20), nullable=True)  # Thread router role (leader, router, child)
     thread_parent_address = db.Column(db.String(50), nullable=True)  # Thread parent address
-    thread_network_id = db.Column(db.Integer, db.ForeignKey('thread_network.id'), nullable=True)  # Link to Thread network
     
     def __repr__(self):
-        return f'<Device {self.name} ({self.device_id})>'
+        return f'<DeviceMatterThread {self.id}>'
     
     def to_dict(self):
         return {
-            'id': self.id,
-            'device_id': self.device_id,
-            'name': self.name,
-            'device_type': self.device_type,
-            'location': self.location,  # Legacy field
-            'status': self.status,
-            'last_seen': self.last_seen.isoformat() if self.last_seen else None,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'user_id': self.user_id,
-            'room_id': self.room_id,
-            'room': self.room.to_dict() if self.room else None,
-            'config': self.config,
             # Matter Protocol fields
             'matter_vendor_id': self.matter_vendor_id,
             'matter_product_id': self.matter_product_id,
             'matter_device_type_id': self.matter_device_type_id,
             'matter_fabric_id': self.matter_fabric_id,
             'matter_node_id': self.matter_node_id,
-            'matter_commissioned': self.matter_commissioned,
-            'matter_commissioning_date': self.matter_commissioning_date.isoformat() if self.matter_commissioning_date else None,
+            'matter_commissioning_date': self.matter_commissioning_date,
             # Thread Protocol fields
-            'thread_enabled': self.thread_enabled,
             'thread_network_name': self.thread_network_name,
             'thread_extended_pan_id': self.thread_extended_pan_id,
             'thread_channel': self.thread_channel,
@@ -75,22 +249,128 @@ class Device(db.Model):
             'thread_parent_address': self.thread_parent_address
         }
 
+# Fixed-point scale per data_type: readings are stored as round(value * scale)
+# in a 16-bit column. Never change an existing entry, stored rows depend on it.
+VALUE_SCALES = MappingProxyType({
+    'temperature': 100,
+    'humidity': 100,
+    'power_consumption': 100,
+    'value': 100,
+    'brightness': 1,
+    'motion': 1,
+    'is_on': 1,
+    'is_open': 1,
+    'switch_state': 1,
+})
+INT16_MIN, INT16_MAX = -32768, 32767
+
+class ExternalDeviceId(Comparator):
+    """
+    Compares a device.id foreign key against external Device.device_id
+    strings, resolving them with an uncorrelated subquery so the
+    (device_pk, timestamp) index is still used.
+    """
+    
+    def __eq__(self, other):
+        return self.expression == select(Device.id).where(Device.device_id == other).scalar_subquery()
+    
+    def in_(self, other):
+        return self.expression.in_(select(Device.id).where(Device.device_id.in_(other)))
+
 class DeviceData(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    device_id = db.Column(db.String(100), db.ForeignKey('device.device_id'), nullable=False)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
-    data_type = db.Column(db.String(50), nullable=False)  # temperature, humidity, switch_state, etc.
-    value = db.Column(db.Float, nullable=False)
-    unit = db.Column(db.String(20), nullable=True)
+    id: Mapped[int] = mapped_column(primary_key=True)
+    device_pk: Mapped[int] = mapped_column(db.ForeignKey('device.id'))  # Integer key, not the external device_id
+    timestamp: Mapped[datetime] = mapped_column(server_default=utcnow())
+    data_type: Mapped[str] = mapped_column(db.String(50))  # temperature, humidity, switch_state, etc.
+    # Exactly one of these is set, see encode_value(); read both through .value
+    value_q: Mapped[Optional[int]] = mapped_column(db.SmallInteger)  # Scaled reading for VALUE_SCALES types
+    value_raw: Mapped[Optional[float]] = mapped_column(db.Float)  # Unscaled types and out-of-range readings
+    unit: Mapped[Optional[str]] = mapped_column(db.String(20))
+    
+    __table_args__ = (
+        # Time-range reads are always scoped to one device
+        db.Index('ix_devicedata_device_ts', 'device_pk', 'timestamp'),
+        # ...and usually to one data_type (anomalies, ?data_type= history)
+        db.Index('ix_devicedata_device_type_ts', 'device_pk', 'data_type', 'timestamp'),
+    )
+    __mapper_args__ = {'eager_defaults': True}
+    
+    # Many-to-one by primary key: resolved from the identity map when the device is already loaded
+    device: Mapped['Device'] = db.relationship()
+    
+    # Rows per executemany in bulk_create()
+    BULK_BATCH_SIZE = 10000
     
     def __repr__(self):
         return f'<DeviceData {self.device_id}: {self.data_type}={self.value}>'
     
+    @hybrid_property
+    def device_id(self):
+        """External device_id of the reading's device"""
+        return self.device.device_id
+    
+    @device_id.inplace.comparator
+    @classmethod
+    def _device_id_comparator(cls):
+        return ExternalDeviceId(cls.device_pk)
+    
+    @staticmethod
+    def encode_value(data_type, value):
+        """
+        Return the (value_q, value_raw) pair storing a reading.
+        Raises ValueError or TypeError when value is not a finite number.
+        """
+        value = float(value)
+        if not math.isfinite(value):
+            raise ValueError(f'{data_type} reading is not a finite number: {value}')
+        scale = VALUE_SCALES.get(data_type)
+        if scale is not None:
+            scaled = round(value * scale)
+            if INT16_MIN <= scaled <= INT16_MAX:
+                return scaled, None
+        return None, value
+    
+    @staticmethod
+    def decode_value(data_type, value_q, value_raw):
+        """Inverse of encode_value()"""
+        if value_q is not None:
+            return value_q / VALUE_SCALES[data_type]
+        return value_raw
+    
+    @hybrid_property
+    def value(self):
+        return self.decode_value(self.data_type, self.value_q, self.value_raw)
+    
+    @value.inplace.setter
+    def _value_setter(self, value):
+        # data_type must be assigned first
+        self.value_q, self.value_raw = self.encode_value(self.data_type, value)
+    
+    @value.inplace.expression
+    @classmethod
+    def _value_expression(cls):
+        scale = case(dict(VALUE_SCALES), value=cls.data_type, else_=1)
+        return func.coalesce(cast(cls.value_q, db.Float) / scale, cls.value_raw)
+    
+    @classmethod
+    def bulk_create(cls, records):
+        """
+        Insert telemetry rows from a list of column dicts (keyed by device_pk)
+        with executemany, bypassing per-object ORM construction. Each dict's
+        'value' is replaced by its encoded value_q/value_raw columns.
+        The caller commits.
+        """
+        encode = cls.encode_value
+        for record in records:
+            record['value_q'], record['value_raw'] = encode(record['data_type'], record.pop('value'))
+        for start in range(0, len(records), cls.BULK_BATCH_SIZE):
+            db.session.execute(insert(cls), records[start:start + cls.BULK_BATCH_SIZE])
+    
     def to_dict(self):
         return {
             'id': self.id,
             'device_id': self.device_id,
-            'timestamp': self.timestamp.isoformat(),
+            'timestamp': self.timestamp,
             'data_type': self.data_type,
             'value': self.value,
             'unit': self.unit
@@ -105,17 +385,27 @@ class ThreadNetwork(db.Model):
     channel = db.Column(db.Integer, nullable=False)  # Thread channel (11-26)
     mesh_local_prefix = db.Column(db.String(50), nullable=True)  # Thread mesh local prefix
     is_active = db.Column(db.Boolean, default=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    created_at = db.Column(db.DateTime, server_default=utcnow())
+    updated_at = db.Column(db.DateTime, server_default=utcnow(), onupdate=datetime.utcnow)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    
+    # Denormalized child count, maintained by count_children()
+    devices_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
     
     # Relationships
     user = db.relationship('User', backref='thread_networks', lazy=True)
-    devices = db.relationship('Device', backref='thread_network', lazy=True)
+    devices = db.relationship('Device', back_populates='thread_network', lazy=True)
     
     def __repr__(self):
         return f'<ThreadNetwork {self.name}>'
     
+    @classmethod
+    def select_out(cls):
+        """Column select whose rows construct ThreadNetworkOut"""
+        return select(cls.id, cls.name, cls.network_name, cls.extended_pan_id, cls.channel,
+                      cls.mesh_local_prefix, cls.is_active, cls.created_at, cls.updated_at,
+                      cls.user_id, cls.devices_count)
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -125,10 +415,10 @@ class ThreadNetwork(db.Model):
             'channel': self.channel,
             'mesh_local_prefix': self.mesh_local_prefix,
             'is_active': self.is_active,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'updated_at': self.updated_at.isoformat() if self.updated_at else None,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
             'user_id': self.user_id,
-            'devices_count': len(self.devices)
+            'devices_count': self.devices_count
         }
 
 class AutomationRule(db.Model):
@@ -136,16 +426,22 @@ class AutomationRule(db.Model):
     name = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text, nullable=True)
     trigger_device_id = db.Column(db.String(100), nullable=False)
-    trigger_condition = db.Column(db.Text, nullable=False)  # JSON condition
+    trigger_condition = db.Column(JSONType, nullable=False)  # JSON condition
     action_device_id = db.Column(db.String(100), nullable=False)
-    action_command = db.Column(db.Text, nullable=False)  # JSON command
+    action_command = db.Column(JSONType, nullable=False)  # JSON command
     is_active = db.Column(db.Boolean, default=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    created_at = db.Column(db.DateTime, server_default=utcnow())
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     
     def __repr__(self):
         return f'<AutomationRule {self.name}>'
     
+    @classmethod
+    def select_out(cls):
+        """Column select whose rows construct AutomationRuleOut"""
+        return select(cls.id, cls.name, cls.description, cls.trigger_device_id, cls.trigger_condition,
+                      cls.action_device_id, cls.action_command, cls.is_active, cls.created_at, cls.user_id)
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -156,7 +452,9 @@ class AutomationRule(db.Model):
             'action_device_id': self.action_device_id,
             'action_command': self.action_command,
             'is_active': self.is_active,
-            'created_at': self.created_at.isoformat(),
+            'created_at': self.created_at,
             'user_id': self.user_id
         }
 
+count_children(Device, 'room_id', Room, 'devices_count')
+count_children(Device, 'thread_network_id', ThreadNetwork, 'devices_count')
@@ -1,6 +1,42 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload
 from datetime import datetime
-from src.models.user import db
+from src.models.user import db, utcnow
+
+def count_children(child, foreign_key, parent, counter):
+    """
+    Keep parent.<counter> equal to the number of child rows referencing it.
+    The counter is adjusted with a single UPDATE whenever a child row is
+    inserted, deleted or moved to another parent during a flush.
+    """
+    table = parent.__table__
+    values = {counter: table.c[counter]}
+    if 'updated_at' in table.c:
+        # A count change is not an edit of the parent; keep updated_at as is
+        values['updated_at'] = table.c.updated_at
+    
+    def adjust(connection, parent_id, delta):
+        if parent_id is not None:
+            connection.execute(table.update().where(table.c.id == parent_id).values(
+                {**values, counter: values[counter] + delta}))
+    
+    @db.event.listens_for(child, 'after_insert')
+    def after_insert(mapper, connection, target):
+        adjust(connection, getattr(target, foreign_key), 1)
+    
+    @db.event.listens_for(child, 'after_delete')
+    def after_delete(mapper, connection, target):
+        adjust(connection, getattr(target, foreign_key), -1)
+    
+    @db.event.listens_for(child, 'after_update')
+    def after_update(mapper, connection, target):
+        history = inspect(target).attrs[foreign_key].history
+        if history.has_changes():
+            for parent_id in history.deleted:
+                adjust(connection, parent_id, -1)
+            for parent_id in history.added:
+                adjust(connection, parent_id, 1)
 
 class Organization(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -11,16 +47,20 @@ class Organization(db.Model):
     email = db.Column(db.String(120), nullable=True)
     website = db.Column(db.String(255), nullable=True)
     is_active = db.Column(db.Boolean, default=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = db.Column(db.DateTime, server_default=utcnow())
+    updated_at = db.Column(db.DateTime, server_default=utcnow(), onupdate=datetime.utcnow)
     
     # Foreign key to the user who created/owns this organization
     owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     
+    # Denormalized child counts, maintained by count_children()
+    locations_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    members_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    
     # Relationships
     owner = db.relationship('User', backref='owned_organizations', lazy=True)
-    locations = db.relationship('Location', backref='organization', lazy=True, cascade='all, delete-orphan')
-    members = db.relationship('OrganizationMember', backref='organization', lazy=True, cascade='all, delete-orphan')
+    locations = db.relationship('Location', back_populates='organization', lazy=True, cascade='all, delete-orphan')
+    members = db.relationship('OrganizationMember', back_populates='organization', lazy=True, cascade='all, delete-orphan')
     
     def __repr__(self):
         return f'<Organization {self.name}>'
@@ -35,11 +75,11 @@ class Organization(db.Model):
             'email': self.email,
             'website': self.website,
             'is_active': self.is_active,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'updated_at': self.updated_at.isoformat() if self.updated_at else None,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
             'owner_id': self.owner_id,
-            'locations_count': len(self.locations),
-            'members_count': len(self.members)
+            'locations_count': self.locations_count,
+            'members_count': self.members_count
         }
 
 class Location(db.Model):
@@ -54,18 +94,27 @@ class Location(db.Model):
     latitude = db.Column(db.Float, nullable=True)
     longitude = db.Column(db.Float, nullable=True)
     is_active = db.Column(db.Boolean, default=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = db.Column(db.DateTime, server_default=utcnow())
+    updated_at = db.Column(db.DateTime, server_default=utcnow(), onupdate=datetime.utcnow)
     
     # Foreign key to the organization this location belongs to
     organization_id = db.Column(db.Integer, db.ForeignKey('organization.id'), nullable=False)
     
+    # Denormalized child count, maintained by count_children()
+    rooms_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    
     # Relationships
-    rooms = db.relationship('Room', backref='location', lazy=True, cascade='all, delete-orphan')
+    organization = db.relationship('Organization', back_populates='locations')
+    rooms = db.relationship('Room', back_populates='location', lazy=True, cascade='all, delete-orphan')
     
     def __repr__(self):
         return f'<Location {self.name}>'
     
+    @classmethod
+    def get_with_organization(cls, location_id):
+        """Load a location together with its organization in one query"""
+        return db.session.get(cls, location_id, options=[joinedload(cls.organization)])
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -79,10 +128,10 @@ class Location(db.Model):
             'latitude': self.latitude,
             'longitude': self.longitude,
             'is_active': self.is_active,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'updated_at': self.updated_at.isoformat() if self.updated_at else None,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
             'organization_id': self.organization_id,
-            'rooms_count': len(self.rooms)
+            'rooms_count': self.rooms_count
         }
 
 class Room(db.Model):
@@ -93,18 +142,27 @@ class Room(db.Model):
     floor = db.Column(db.String(20), nullable=True)
     area_sqft = db.Column(db.Float, nullable=True)
     is_active = db.Column(db.Boolean, default=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = db.Column(db.DateTime, server_default=utcnow())
+    updated_at = db.Column(db.DateTime, server_default=utcnow(), onupdate=datetime.utcnow)
     
     # Foreign key to the location this room belongs to
     location_id = db.Column(db.Integer, db.ForeignKey('location.id'), nullable=False)
     
+    # Denormalized child count, maintained by count_children()
+    devices_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    
     # Relationships
-    devices = db.relationship('Device', backref='room', lazy=True)
+    location = db.relationship('Location', back_populates='rooms')
+    devices = db.relationship('Device', back_populates='room', lazy=True)
     
     def __repr__(self):
         return f'<Room {self.name}>'
     
+    @classmethod
+    def get_with_organization(cls, room_id):
+        """Load a room with its location and organization in one query"""
+        return db.session.get(cls, room_id, options=[joinedload(cls.location).joinedload(Location.organization)])
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -114,10 +172,10 @@ class Room(db.Model):
             'floor': self.floor,
             'area_sqft': self.area_sqft,
             'is_active': self.is_active,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'updated_at': self.updated_at.isoformat() if self.updated_at else None,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
             'location_id': self.location_id,
-            'devices_count': len(self.devices)
+            'devices_count': self.devices_count
         }
 
 class OrganizationMember(db.Model):
@@ -126,10 +184,11 @@ class OrganizationMember(db.Model):
     organization_id = db.Column(db.Integer, db.ForeignKey('organization.id'), nullable=False)
     role = db.Column(db.String(20), default='member')  # owner, admin, member, viewer
     is_active = db.Column(db.Boolean, default=True)
-    joined_at = db.Column(db.DateTime, default=datetime.utcnow)
+    joined_at = db.Column(db.DateTime, server_default=utcnow())
     
     # Relationships
     user = db.relationship('User', backref='organization_memberships', lazy=True)
+    organization = db.relationship('Organization', back_populates='members')
     
     # Unique constraint to prevent duplicate memberships
     __table_args__ = (db.UniqueConstraint('user_id', 'organization_id', name='unique_user_organization'),)
@@ -144,6 +203,10 @@ class OrganizationMember(db.Model):
             'organization_id': self.organization_id,
             'role': self.role,
             'is_active': self.is_active,
-            'joined_at': self.joined_at.isoformat() if self.joined_at else None,
+            'joined_at': self.joined_at,
             'user': self.user.to_dict() if self.user else None
         }
+
+count_children(Location, 'organization_id', Organization, 'locations_count')
+count_children(OrganizationMember, 'organization_id', Organization, 'members_count')
+count_children(Room, 'location_id', Location, 'rooms_count')
@@ -1,11 +1,127 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import select
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Session, joinedload, lazyload, selectinload, object_session
+from sqlalchemy.sql.expression import FunctionElement
+from dataclasses import dataclass
 from datetime import datetime
+from typing import Optional
+from functools import cached_property
+from threading import Lock
+from cachetools import TTLCache
 import hashlib
+import hmac
+import os
+import bcrypt
 import jwt
-from datetime import timedelta
+import time
+from src.services.cache_service import cache
 
 db = SQLAlchemy()
 
+# bcrypt work factor (log2 of the key expansion rounds). bcrypt releases the
+# GIL while hashing, so gthread workers keep serving other requests meanwhile.
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', 12))
+
+# Verified tokens, keyed by a BLAKE2b digest of the token -> (user_id, exp).
+# Only ids are cached, never ORM instances, so a hit skips JWT verification
+# but still loads a session-bound user.
+_token_cache = TTLCache(maxsize=10000, ttl=60)
+_token_cache_lock = Lock()
+
+def _token_key(token):
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+# user_id -> (generations, detached User with its role and permissions loaded).
+# verify_token merges the copy into the request session with load=False, so warm
+# workers authenticate without SQL; the shared copy itself is never handed out.
+_user_cache = TTLCache(maxsize=10000, ttl=60)
+_user_cache_lock = Lock()
+
+# Entries are only valid while the generation stamps they were loaded under are
+# current. The stamps live in the shared cache and are bumped after commit, so
+# every worker drops a changed user, not just the one that wrote it. They must
+# outlive _user_cache entries, or an expired stamp could revive an old entry.
+_USERS_GENERATION_KEY = 'auth:users:gen'
+USER_GENERATION_TTL = 120  # seconds
+_STALE_USERS = 'stale_users'  # Session.info key; None stands for every user
+
+def _user_generation_key(user_id):
+    return f'auth:user:{user_id}:gen'
+
+def _user_generations(user_id):
+    """Current (all users, this user) generation stamps"""
+    return cache.get(_USERS_GENERATION_KEY), cache.get(_user_generation_key(user_id))
+
+def _bump_user_generations(user_ids):
+    stamp = time.time()
+    for user_id in user_ids:
+        key = _USERS_GENERATION_KEY if user_id is None else _user_generation_key(user_id)
+        cache.set(key, stamp, USER_GENERATION_TTL)
+
+def _invalidate_cached_users(target, user_id=None):
+    """Retire cached users once target's session commits; user_id None means every user"""
+    session = object_session(target)
+    if session is None:
+        _bump_user_generations([user_id])
+    else:
+        session.info.setdefault(_STALE_USERS, set()).add(user_id)
+
+@db.event.listens_for(Session, 'after_commit')
+def _retire_stale_users(session):
+    stale = session.info.pop(_STALE_USERS, None)
+    if stale:
+        _bump_user_generations(stale)
+
+@db.event.listens_for(Session, 'after_rollback')
+def _discard_stale_users(session):
+    session.info.pop(_STALE_USERS, None)
+
+class utcnow(FunctionElement):
+    """Current UTC time as a naive timestamp, for server_default on DateTime columns"""
+    type = db.DateTime()
+    inherit_cache = True
+
+@compiles(utcnow)
+def _utcnow_default(element, compiler, **kw):
+    # SQLite's CURRENT_TIMESTAMP is already UTC
+    return 'CURRENT_TIMESTAMP'
+
+@compiles(utcnow, 'postgresql')
+def _utcnow_postgresql(element, compiler, **kw):
+    return "TIMEZONE('utc', CURRENT_TIMESTAMP)"
+
+# (resource, action) -> bit index in a role's permission bitmask.
+# Indexes are assigned on first use and shared by every role in the process.
+PERM_ID = {}
+_perm_id_lock = Lock()
+
+def perm_bit(resource, action):
+    """Return the bit index for a (resource, action) permission"""
+    key = (resource, action)
+    bit = PERM_ID.get(key)
+    if bit is None:
+        with _perm_id_lock:
+            bit = PERM_ID.setdefault(key, len(PERM_ID))
+    return bit
+
+def perm_mask(permissions):
+    """Combine (resource, action) pairs into a single bitmask"""
+    mask = 0
+    for resource, action in permissions:
+        mask |= 1 << perm_bit(resource, action)
+    return mask
+
+# role_id -> serialized permission dicts of that role (None: every permission).
+# Shared between responses, so callers must not mutate the dicts. The TTL
+# bounds staleness in other processes; local changes invalidate immediately.
+_role_permissions_cache = TTLCache(maxsize=1024, ttl=60)
+_role_permissions_lock = Lock()
+
+def _clear_role_permissions_cache():
+    with _role_permissions_lock:
+        _role_permissions_cache.clear()
+
 class Role(db.Model):
     """Role model for RBAC"""
     id = db.Column(db.Integer, primary_key=True)
@@ -15,20 +131,45 @@ class Role(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationships
-    permissions = db.relationship('Permission', secondary='role_permissions', backref='roles')
+    permissions = db.relationship('Permission', secondary='role_permissions', backref='roles', lazy='selectin')
     users = db.relationship('User', backref='user_role', lazy=True)
     
     def __repr__(self):
         return f'<Role {self.name}>'
     
+    @property
+    def perm_bits(self):
+        """Bitmask of this role's permissions, materialized on first use"""
+        bits = self.__dict__.get('_perm_bits')
+        if bits is None:
+            bits = self._perm_bits = perm_mask((p.resource, p.action) for p in self.permissions)
+        return bits
+    
+    @staticmethod
+    def permissions_for_role(role_id):
+        """
+        Serialized permissions of a role, or of every permission when
+        role_id is None, loaded with one query and cached per process
+        """
+        with _role_permissions_lock:
+            cached = _role_permissions_cache.get(role_id)
+        if cached is None:
+            query = Permission.query
+            if role_id is not None:
+                query = query.join(role_permissions).filter(role_permissions.c.role_id == role_id)
+            cached = tuple(p.to_dict() for p in query.order_by(Permission.id))
+            with _role_permissions_lock:
+                _role_permissions_cache[role_id] = cached
+        return cached
+    
     def to_dict(self):
         return {
             'id': self.id,
             'name': self.name,
             'description': self.description,
             'is_system': self.is_system,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'permissions': [p.to_dict() for p in self.permissions]
+            'created_at': self.created_at,
+            'permissions': list(Role.permissions_for_role(self.id))
         }
 
 class Permission(db.Model):
@@ -50,7 +191,7 @@ class Permission(db.Model):
             'resource': self.resource,
             'action': self.action,
             'description': self.description,
-            'created_at': self.created_at.isoformat() if self.created_at else None
+            'created_at': self.created_at
         }
 
 # Association table for many-to-many relationship between roles and permissions
@@ -77,16 +218,44 @@ class User(db.Model):
     def __repr__(self):
         return f'<User {self.username}>'
     
+    @staticmethod
+    def list_for_serialization():
+        """
+        All users with their roles loaded in one extra SELECT, for to_dict()
+        listings; role permissions come from the per-role cache instead
+        """
+        return User.query.options(
+            selectinload(User.user_role).lazyload(Role.permissions)
+        ).all()
+    
+    @cached_property
+    def role_name(self):
+        """Name of the user's role, resolved once per instance"""
+        role = self.user_role
+        return role.name if role else 'No role assigned'
+    
     def set_password(self, password):
-        """Hash and set the user's password using SHA256"""
-        password_bytes = password.encode('utf-8')
-        self.password_hash = hashlib.sha256(password_bytes).hexdigest()
+        """Hash and set the user's password using bcrypt"""
+        # bcrypt only reads the first 72 bytes of a password
+        password_bytes = password.encode('utf-8')[:72]
+        self.password_hash = bcrypt.hashpw(password_bytes, bcrypt.gensalt(BCRYPT_ROUNDS)).decode('ascii')
     
     def check_password(self, password):
-        """Check if the provided password matches the user's password"""
+        """
+        Check if the provided password matches the user's password.
+        Legacy unsalted SHA256 hashes are rehashed with bcrypt on a
+        successful check; the caller commits.
+        """
         password_bytes = password.encode('utf-8')
-        password_hash = hashlib.sha256(password_bytes).hexdigest()
-        return password_hash == self.password_hash
+        if self.password_hash.startswith('$2'):
+            return bcrypt.checkpw(password_bytes[:72], self.password_hash.encode('ascii'))
+        
+        # Constant-time compare so the first mismatching byte isn't observable
+        password_hash = hashlib.sha256(password_bytes).hexdigest().encode('ascii')
+        if not hmac.compare_digest(password_hash, self.password_hash.encode('ascii')):
+            return False
+        self.set_password(password)
+        return True
     
     def generate_token(self, secret_key, expires_in=3600):
         """Generate a JWT token for the user"""
@@ -95,21 +264,54 @@ class User(db.Model):
             'username': self.username,
             'role_id': self.role_id,
             'is_superuser': self.is_superuser,
-            'exp': datetime.utcnow() + timedelta(seconds=expires_in)
+            'exp': int(time.time()) + expires_in  # NumericDate, no datetime round trip
         }
         return jwt.encode(payload, secret_key, algorithm='HS256')
     
     @staticmethod
     def verify_token(token, secret_key):
-        """Verify a JWT token and return the user"""
-        try:
-            payload = jwt.decode(token, secret_key, algorithms=['HS256'])
-            user = User.query.get(payload['user_id'])
-            return user
-        except jwt.ExpiredSignatureError:
-            return None
-        except jwt.InvalidTokenError:
-            return None
+        """Verify a JWT token and return the user, checking its signature at most once per TTL"""
+        key = _token_key(token)
+        with _token_cache_lock:
+            cached = _token_cache.get(key)
+        
+        if cached is None or cached[1] <= time.time():
+            try:
+                payload = jwt.decode(token, secret_key, algorithms=['HS256'])
+            except jwt.InvalidTokenError:  # Includes ExpiredSignatureError
+                return None
+            cached = (payload['user_id'], payload['exp'])
+            with _token_cache_lock:
+                _token_cache[key] = cached
+        
+        user_id = cached[0]
+        # Read the stamps before any load, so a change committed meanwhile retires the entry
+        generations = _user_generations(user_id)
+        with _user_cache_lock:
+            entry = _user_cache.get(user_id)
+        user = entry[1] if entry is not None and entry[0] == generations else None
+        
+        if user is None:
+            # Role and its permissions come back in the same SELECT, so permission
+            # checks later in the request don't lazy load them. A private session
+            # leaves the cached graph detached from every request session.
+            with Session(db.engine) as session:
+                user = session.get(User, user_id, options=[
+                    joinedload(User.user_role).joinedload(Role.permissions)
+                ])
+                if user is None:
+                    return None
+                session.expunge_all()
+            with _user_cache_lock:
+                _user_cache[user_id] = (generations, user)
+        
+        return db.session.merge(user, load=False)
+    
+    @staticmethod
+    def invalidate_token(token):
+        """Drop a token from the verification cache (e.g. on logout)"""
+        with _token_cache_lock:
+            _token_cache.pop(_token_key(token), None)
     
     def has_permission(self, resource, action):
         """Check if user has a specific permission"""
@@ -119,19 +321,29 @@ class User(db.Model):
         
         # Check if user has role and role has permission
         if self.role_id and self.user_role:
-            for permission in self.user_role.permissions:
-                if permission.resource == resource and permission.action == action:
-                    return True
+            return (self.user_role.perm_bits >> perm_bit(resource, action)) & 1 == 1
         
         return False
     
     def has_any_permission(self, permissions):
-        """Check if user has any of the specified permissions"""
-        for resource, action in permissions:
-            if self.has_permission(resource, action):
-                return True
+        """
+        Check if user has any of the specified permissions.
+        Accepts (resource, action) pairs or a mask from perm_mask().
+        """
+        if self.is_superuser:
+            return True
+        
+        if self.role_id and self.user_role:
+            mask = permissions if isinstance(permissions, int) else perm_mask(permissions)
+            return (self.user_role.perm_bits & mask) != 0
+        
         return False
     
+    def auth_context(self):
+        """Snapshot of the user's permission state for the current request"""
+        perm_bits = self.user_role.perm_bits if self.role_id and self.user_role else 0
+        return AuthContext(self.id, bool(self.is_superuser), perm_bits)
+    
     def get_permissions(self):
         """Get all permissions for the user"""
         if self.is_superuser:
@@ -143,6 +355,14 @@ class User(db.Model):
         
         return []
     
+    def get_permission_dicts(self):
+        """Serialized permissions for the user, from the per-role cache"""
+        if self.is_superuser:
+            return list(Role.permissions_for_role(None))
+        if self.role_id:
+            return list(Role.permissions_for_role(self.role_id))
+        return []
+    
     def to_dict(self, include_sensitive=False):
         data = {
             'id': self.id,
@@ -152,27 +372,101 @@ class User(db.Model):
             'role': self.user_role.to_dict() if self.user_role else None,
             'is_active': self.is_active,
             'is_superuser': self.is_superuser,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'last_login': self.last_login.isoformat() if self.last_login else None,
-            'permissions': [p.to_dict() for p in self.get_permissions()]
+            'created_at': self.created_at,
+            'last_login': self.last_login,
+            'permissions': self.get_permission_dicts()
         }
         if include_sensitive:
             data['password_hash'] = self.password_hash
         return data
 
+@dataclass(slots=True, frozen=True)
+class AuthContext:
+    """
+    Plain-attribute view of an authenticated user's permissions, built once
+    per request by the auth decorators and stored as flask.g.auth so later
+    checks skip the ORM attribute machinery
+    """
+    user_id: int
+    is_superuser: bool
+    perm_bits: int
+    
+    def has_permission(self, resource, action):
+        return self.is_superuser or (self.perm_bits >> perm_bit(resource, action)) & 1 == 1
+    
+    def has_any_permission(self, permissions):
+        """Accepts (resource, action) pairs or a mask from perm_mask()"""
+        if self.is_superuser:
+            return True
+        mask = permissions if isinstance(permissions, int) else perm_mask(permissions)
+        return (self.perm_bits & mask) != 0
+
+@db.event.listens_for(Role.permissions, 'append')
+@db.event.listens_for(Role.permissions, 'remove')
+def _reset_perm_bits(role, permission, initiator):
+    """Drop a role's cached permission bitmask when its permissions change"""
+    role.__dict__.pop('_perm_bits', None)
+    _clear_role_permissions_cache()
+    _invalidate_cached_users(role)
+
+@db.event.listens_for(Permission, 'after_insert')
+@db.event.listens_for(Permission, 'after_update')
+@db.event.listens_for(Permission, 'after_delete')
+@db.event.listens_for(Role, 'after_delete')
+def _reset_role_permissions(mapper, connection, target):
+    _clear_role_permissions_cache()
+    _invalidate_cached_users(target)
+
+@db.event.listens_for(Role, 'after_update')
+def _reset_role_users(mapper, connection, target):
+    _invalidate_cached_users(target)
+
+@db.event.listens_for(User, 'after_update')
+@db.event.listens_for(User, 'after_delete')
+def _reset_cached_user(mapper, connection, target):
+    # Covers is_active flips and role changes
+    _invalidate_cached_users(target, target.id)
+
+@dataclass(slots=True)
+class UserSessionOut:
+    """Session listing row built from UserSession.select_out(); orjson encodes it without a dict"""
+    id: int
+    user_id: int
+    created_at: Optional[datetime]
+    expires_at: datetime
+    is_active: Optional[bool]
+    ip_address: Optional[str]
+
 class UserSession(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    token_hash = db.Column(db.String(128), nullable=False)
+    token_hash = db.Column(db.String(64), nullable=False)  # hash_token() hex digest
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     expires_at = db.Column(db.DateTime, nullable=False)
     is_active = db.Column(db.Boolean, default=True)
     ip_address = db.Column(db.String(45), nullable=True)
     user_agent = db.Column(db.String(255), nullable=True)
     
+    __table_args__ = (
+        # Active-session listings filter by user, is_active and expiry
+        db.Index('ix_session_user_active_exp', 'user_id', 'is_active', 'expires_at'),
+        # Logout looks a session up by its token hash
+        db.Index('ix_session_token_hash', 'token_hash'),
+    )
+    
     def __repr__(self):
         return f'<UserSession {self.user_id}>'
     
+    @staticmethod
+    def hash_token(token):
+        """Hex digest stored in token_hash (BLAKE2b-256)"""
+        return hashlib.blake2b(token.encode(), digest_size=32).hexdigest()
+    
+    @classmethod
+    def select_out(cls):
+        """Column select whose rows construct UserSessionOut"""
+        return select(cls.id, cls.user_id, cls.created_at, cls.expires_at, cls.is_active, cls.ip_address)
+    
     def is_expired(self):
         return datetime.utcnow() > self.expires_at
     
@@ -180,8 +474,8 @@ class UserSession(db.Model):
         return {
             'id': self.id,
             'user_id': self.user_id,
-            'created_at': self.created_at.isoformat(),
-            'expires_at': self.expires_at.isoformat(),
+            'created_at': self.created_at,
+            'expires_at': self.expires_at,
             'is_active': self.is_active,
             'ip_address': self.ip_address
         }
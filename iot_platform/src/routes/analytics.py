@@ -1,4 +1,6 @@
+import heapq
 from flask import Blueprint, request, jsonify
+from src.models.user import db
 from src.services.analytics_service import analytics_service
 from src.routes.auth import token_required, permission_required
 
@@ -105,26 +107,25 @@ def get_dashboard_summary(current_user):
         if 'error' in overview:
             return jsonify(overview), 500
         
-        # Get recent anomalies across all devices
+        # Get recent anomalies across the 50 most recently active devices
         from src.models.device import Device
-        devices = Device.query.all()
+        devices = db.session.query(Device.device_id, Device.name).order_by(
+            Device.last_seen.desc().nulls_last(), Device.id
+        ).limit(50).all()  # Plain rows, no ORM hydration
+        results = analytics_service.detect_anomalies_bulk(
+            [device_id for device_id, _ in devices], 'temperature', hours=6, threshold=2.0
+        )
         
         all_anomalies = []
-        for device in devices[:5]:  # Limit to first 5 devices for performance
-            try:
-                anomalies = analytics_service.detect_anomalies(
-                    device.device_id, 'temperature', hours=6, threshold=2.0
-                )
-                for anomaly in anomalies:
-                    anomaly['device_id'] = device.device_id
-                    anomaly['device_name'] = device.name
-                all_anomalies.extend(anomalies)
-            except:
-                continue
-        
-        # Sort by timestamp and get most recent
-        all_anomalies.sort(key=lambda x: x['timestamp'], reverse=True)
-        recent_anomalies = all_anomalies[:10]
+        for device_id, device_name in devices:
+            anomalies = results.get(device_id, [])
+            for anomaly in anomalies:
+                anomaly['device_id'] = device_id
+                anomaly['device_name'] = device_name
+            all_anomalies.extend(anomalies)
+        
+        # Most recent 10 by timestamp without sorting the whole list
+        recent_anomalies = heapq.nlargest(10, all_anomalies, key=lambda x: x['timestamp'])
         
         return jsonify({
             'system_health': overview['system_health'],
@@ -155,32 +156,26 @@ def generate_device_report(current_user, device_id):
         if not device:
             return jsonify({'error': 'Device not found'}), 404
         
-        # Get comprehensive data
-        statistics = analytics_service.get_device_statistics(device_id, hours)
-        health = analytics_service.get_device_health_score(device_id, hours)
+        # Statistics, health and anomalies all come from one telemetry query
+        statistics, health, anomalies_by_type = analytics_service.generate_report_bundle(device_id, hours)
+        
+        device_info = {
+            'device_id': device.device_id,
+            'name': device.name,
+            'type': device.device_type,
+            'location': device.location,
+            'status': device.status,
+            'last_seen': device.last_seen
+        }
+        time_period = {
+            'hours': hours,
+            'start_time': statistics.get('time_range', {}).get('start'),
+            'end_time': statistics.get('time_range', {}).get('end')
+        }
         
-        # Get anomalies for different data types
-        anomalies_by_type = {}
-        if 'statistics' in statistics:
-            for data_type in statistics['statistics'].keys():
-                anomalies = analytics_service.detect_anomalies(device_id, data_type, hours)
-                if anomalies:
-                    anomalies_by_type[data_type] = anomalies
-        
-        report = {
-            'device_info': {
-                'device_id': device.device_id,
-                'name': device.name,
-                'type': device.device_type,
-                'location': device.location,
-                'status': device.status,
-                'last_seen': device.last_seen.isoformat() if device.last_seen else None
-            },
-            'time_period': {
-                'hours': hours,
-                'start_time': statistics.get('time_range', {}).get('start'),
-                'end_time': statistics.get('time_range', {}).get('end')
-            },
+        return jsonify({
+            'device_info': device_info,
+            'time_period': time_period,
             'statistics': statistics,
             'health': health,
             'anomalies': anomalies_by_type,
@@ -191,9 +186,7 @@ def generate_device_report(current_user, device_id):
                 'total_anomalies': sum(len(a) for a in anomalies_by_type.values()),
                 'issues_count': len(health.get('issues', []))
             }
-        }
-        
-        return jsonify(report), 200
+        }), 200
         
     except Exception as e:
         return jsonify({'error': 'Failed to generate device report'}), 500
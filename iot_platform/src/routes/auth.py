@@ -1,55 +1,12 @@
 from flask import Blueprint, request, jsonify, current_app
-from functools import wraps
-from src.models.user import db, User, UserSession
+from sqlalchemy import or_
+from src.models.user import db, User, UserSession, UserSessionOut, Role
+# token_required/permission_required are re-exported for the route modules that import them from here
+from src.decorators.rbac_decorators import auth_required, token_required, permission_required, invalidate as invalidate_token
 from datetime import datetime, timedelta
-import hashlib
 
 auth_bp = Blueprint('auth', __name__)
 
-def token_required(f):
-    """Decorator to require authentication for routes"""
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        token = None
-        
-        # Get token from header
-        if 'Authorization' in request.headers:
-            auth_header = request.headers['Authorization']
-            try:
-                token = auth_header.split(" ")[1]  # Bearer <token>
-            except IndexError:
-                return jsonify({'error': 'Invalid token format'}), 401
-        
-        if not token:
-            return jsonify({'error': 'Token is missing'}), 401
-        
-        try:
-            # Verify token
-            current_user = User.verify_token(token, current_app.config['SECRET_KEY'])
-            if current_user is None:
-                return jsonify({'error': 'Token is invalid or expired'}), 401
-            
-            if not current_user.is_active:
-                return jsonify({'error': 'User account is disabled'}), 401
-                
-        except Exception as e:
-            return jsonify({'error': 'Token verification failed'}), 401
-        
-        return f(current_user, *args, **kwargs)
-    
-    return decorated
-
-def permission_required(permission):
-    """Decorator to require specific permissions"""
-    def decorator(f):
-        @wraps(f)
-        def decorated(current_user, *args, **kwargs):
-            if not current_user.has_permission(permission):
-                return jsonify({'error': 'Insufficient permissions'}), 403
-            return f(current_user, *args, **kwargs)
-        return decorated
-    return decorator
-
 @auth_bp.route('/register', methods=['POST'])
 def register():
     """Register a new user"""
@@ -76,18 +33,24 @@ def register():
         if '@' not in email:
             return jsonify({'error': 'Invalid email format'}), 400
         
-        # Check if user already exists
-        if User.query.filter_by(username=username).first():
-            return jsonify({'error': 'Username already exists'}), 409
-        
-        if User.query.filter_by(email=email).first():
+        # Check if user already exists; both columns are unique, so indexed
+        clash = db.session.execute(
+            db.select(User.username)
+            .where(or_(User.username == username, User.email == email))
+            .order_by((User.username == username).desc())  # Report the username clash first
+            .limit(1)
+        ).first()
+        if clash:
+            if clash.username == username:
+                return jsonify({'error': 'Username already exists'}), 409
             return jsonify({'error': 'Email already registered'}), 409
         
-        # Create new user
+        # Create new user with the default role
+        default_role = Role.query.filter_by(name='user').first()
         user = User(
             username=username,
             email=email,
-            role=data.get('role', 'user')  # Default to 'user' role
+            role_id=default_role.id if default_role else None
         )
         user.set_password(password)
         
@@ -127,17 +90,18 @@ def login():
             return jsonify({'error': 'Account is disabled'}), 401
         
         # Update last login
-        user.last_login = datetime.utcnow()
+        now = datetime.utcnow()
+        user.last_login = now
         
         # Generate token
         token = user.generate_token(current_app.config['SECRET_KEY'])
         
         # Create session record
-        token_hash = hashlib.sha256(token.encode()).hexdigest()
+        token_hash = UserSession.hash_token(token)
         session = UserSession(
             user_id=user.id,
             token_hash=token_hash,
-            expires_at=datetime.utcnow() + timedelta(hours=24),
+            expires_at=now + timedelta(hours=24),
             ip_address=request.remote_addr,
             user_agent=request.headers.get('User-Agent', '')[:255]
         )
@@ -166,8 +130,10 @@ def logout(current_user):
         token = auth_header.split(" ")[1] if " " in auth_header else ""
         
         if token:
+            invalidate_token(token)
+            
             # Find and deactivate session
-            token_hash = hashlib.sha256(token.encode()).hexdigest()
+            token_hash = UserSession.hash_token(token)
             session = UserSession.query.filter_by(
                 user_id=current_user.id,
                 token_hash=token_hash,
@@ -229,12 +195,11 @@ def update_profile(current_user):
         return jsonify({'error': 'Profile update failed'}), 500
 
 @auth_bp.route('/users', methods=['GET'])
-@token_required
-@permission_required('manage_users')
+@auth_required(permission=('users', 'manage'))
 def get_users(current_user):
     """Get all users (admin only)"""
     try:
-        users = User.query.all()
+        users = User.list_for_serialization()
         return jsonify({
             'users': [user.to_dict() for user in users]
         }), 200
@@ -242,8 +207,7 @@ def get_users(current_user):
         return jsonify({'error': 'Failed to get users'}), 500
 
 @auth_bp.route('/users/<int:user_id>', methods=['PUT'])
-@token_required
-@permission_required('manage_users')
+@auth_required(permission=('users', 'manage'))
 def update_user(current_user, user_id):
     """Update user (admin only)"""
     try:
@@ -255,10 +219,10 @@ def update_user(current_user, user_id):
         
         # Update allowed fields
         if 'role' in data:
-            if data['role'] in ['user', 'admin', 'guest']:
-                user.role = data['role']
-            else:
+            role = Role.query.filter_by(name=data['role']).first()
+            if not role:
                 return jsonify({'error': 'Invalid role'}), 400
+            user.role_id = role.id
         
         if 'is_active' in data:
             user.is_active = bool(data['is_active'])
@@ -275,8 +239,7 @@ def update_user(current_user, user_id):
         return jsonify({'error': 'User update failed'}), 500
 
 @auth_bp.route('/users/<int:user_id>', methods=['DELETE'])
-@token_required
-@permission_required('manage_users')
+@auth_required(permission=('users', 'manage'))
 def delete_user(current_user, user_id):
     """Delete user (admin only)"""
     try:
@@ -287,8 +250,8 @@ def delete_user(current_user, user_id):
         if not user:
             return jsonify({'error': 'User not found'}), 404
         
-        # Deactivate sessions
-        UserSession.query.filter_by(user_id=user_id).update({'is_active': False})
+        # Deactivate sessions; none are loaded in this session, so skip syncing the identity map
+        UserSession.query.filter_by(user_id=user_id).update({'is_active': False}, synchronize_session=False)
         
         # Delete user
         db.session.delete(user)
@@ -305,15 +268,14 @@ def delete_user(current_user, user_id):
 def get_sessions(current_user):
     """Get current user's active sessions"""
     try:
-        sessions = UserSession.query.filter_by(
-            user_id=current_user.id,
-            is_active=True
-        ).filter(
+        rows = db.session.execute(UserSession.select_out().where(
+            UserSession.user_id == current_user.id,
+            UserSession.is_active == True,
             UserSession.expires_at > datetime.utcnow()
-        ).all()
+        ))
         
         return jsonify({
-            'sessions': [session.to_dict() for session in sessions]
+            'sessions': [UserSessionOut(*row) for row in rows]
         }), 200
         
     except Exception as e:
@@ -1,28 +1,32 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify
+from sqlalchemy import select, func, update
+from sqlalchemy.orm import aliased
 from src.models.user import db, User
-from src.models.billing import Subscription, Invoice, PaymentMethod, UsageRecord, SUBSCRIPTION_PLANS
+from src.models.device import Device, AutomationRule
+from src.models.billing import Subscription, Invoice, InvoiceOut, PaymentMethod, PaymentMethodOut, UsageRecord, SUBSCRIPTION_PLANS, SUBSCRIPTION_PLANS_JSON, SUBSCRIPTION_PLANS_ETAG, PLAN_DETAILS_JSON, SUBSCRIPTION_LIMITS, get_subscription_cached
 from src.routes.auth import token_required
+from src.routes.responses import static_json
 from datetime import datetime, timedelta
-import uuid
+import orjson
 
 billing_bp = Blueprint('billing', __name__)
 
+def _subscription_response(subscription_data, status=200):
+    """Subscription JSON with the plan's pre-encoded details spliced in as plan_details"""
+    plan_json = PLAN_DETAILS_JSON.get(subscription_data['plan_id'], b'{}')
+    body = orjson.dumps(subscription_data)[:-1] + b',"plan_details":' + plan_json + b'}'
+    return Response(body, status=status, mimetype='application/json')
+
 @billing_bp.route('/billing/subscription', methods=['GET'])
 @token_required
 def get_subscription(current_user):
     """Get current user's subscription"""
-    subscription = Subscription.query.filter_by(user_id=current_user.id).first()
+    subscription_data = get_subscription_cached(current_user.id)
     
-    if not subscription:
+    if not subscription_data:
         return jsonify({'error': 'No subscription found'}), 404
     
-    # Get plan details
-    plan_details = SUBSCRIPTION_PLANS.get(subscription.plan_id, {})
-    
-    subscription_data = subscription.to_dict()
-    subscription_data['plan_details'] = plan_details
-    
-    return jsonify(subscription_data)
+    return _subscription_response(subscription_data)
 
 @billing_bp.route('/billing/subscription', methods=['POST'])
 @token_required
@@ -57,8 +61,8 @@ def create_subscription(current_user):
     plan_details = SUBSCRIPTION_PLANS[plan_id]
     invoice = Invoice(
         subscription_id=subscription.id,
-        invoice_number=f"INV-{uuid.uuid4().hex[:8].upper()}",
-        amount=plan_details['price'],
+        invoice_number=Invoice.new_number(),
+        amount_cents=plan_details['price_cents'],
         currency='USD',
         status='pending',
         description=f"{plan_details['name']} Plan - {now.strftime('%B %Y')}",
@@ -68,10 +72,7 @@ def create_subscription(current_user):
     db.session.add(invoice)
     db.session.commit()
     
-    subscription_data = subscription.to_dict()
-    subscription_data['plan_details'] = plan_details
-    
-    return jsonify(subscription_data), 201
+    return _subscription_response(subscription.to_dict(), 201)
 
 @billing_bp.route('/billing/subscription', methods=['PUT'])
 @token_required
@@ -88,8 +89,9 @@ def update_subscription(current_user):
         return jsonify({'error': 'No subscription found'}), 404
     
     # Update subscription
+    now = datetime.utcnow()
     subscription.plan_id = plan_id
-    subscription.updated_at = datetime.utcnow()
+    subscription.updated_at = now
     
     db.session.commit()
     
@@ -97,21 +99,18 @@ def update_subscription(current_user):
     plan_details = SUBSCRIPTION_PLANS[plan_id]
     invoice = Invoice(
         subscription_id=subscription.id,
-        invoice_number=f"INV-{uuid.uuid4().hex[:8].upper()}",
-        amount=plan_details['price'],
+        invoice_number=Invoice.new_number(),
+        amount_cents=plan_details['price_cents'],
         currency='USD',
         status='pending',
-        description=f"{plan_details['name']} Plan - {datetime.utcnow().strftime('%B %Y')}",
-        due_date=datetime.utcnow() + timedelta(days=7)
+        description=f"{plan_details['name']} Plan - {now.strftime('%B %Y')}",
+        due_date=now + timedelta(days=7)
     )
     
     db.session.add(invoice)
     db.session.commit()
     
-    subscription_data = subscription.to_dict()
-    subscription_data['plan_details'] = plan_details
-    
-    return jsonify(subscription_data)
+    return _subscription_response(subscription.to_dict())
 
 @billing_bp.route('/billing/subscription/cancel', methods=['POST'])
 @token_required
@@ -147,12 +146,10 @@ def reactivate_subscription(current_user):
 @token_required
 def get_invoices(current_user):
     """Get user's invoices"""
-    subscription = Subscription.query.filter_by(user_id=current_user.id).first()
-    if not subscription:
-        return jsonify([])
-    
-    invoices = Invoice.query.filter_by(subscription_id=subscription.id).order_by(Invoice.created_at.desc()).all()
-    return jsonify([invoice.to_dict() for invoice in invoices])
+    rows = db.session.execute(Invoice.select_out().join(Subscription).where(
+        Subscription.user_id == current_user.id
+    ).order_by(Invoice.created_at.desc()))
+    return jsonify([InvoiceOut(*row) for row in rows])
 
 @billing_bp.route('/billing/invoices/<int:invoice_id>/download', methods=['GET'])
 @token_required
@@ -177,8 +174,8 @@ def download_invoice(current_user, invoice_id):
 @token_required
 def get_payment_methods(current_user):
     """Get user's payment methods"""
-    payment_methods = PaymentMethod.query.filter_by(user_id=current_user.id).all()
-    return jsonify([pm.to_dict() for pm in payment_methods])
+    rows = db.session.execute(PaymentMethod.select_out().where(PaymentMethod.user_id == current_user.id))
+    return jsonify([PaymentMethodOut(*row) for row in rows])
 
 @billing_bp.route('/billing/payment-methods', methods=['POST'])
 @token_required
@@ -239,16 +236,22 @@ def remove_payment_method(current_user, payment_method_id):
 @token_required
 def set_default_payment_method(current_user, payment_method_id):
     """Set a payment method as default"""
-    payment_method = PaymentMethod.query.filter_by(id=payment_method_id, user_id=current_user.id).first()
-    if not payment_method:
+    # One UPDATE flags this method and clears the rest; the EXISTS guard
+    # leaves everything untouched when the method isn't the user's
+    target = aliased(PaymentMethod)
+    owned = select(target.id).where(
+        target.id == payment_method_id,
+        target.user_id == current_user.id
+    ).exists()
+    result = db.session.execute(
+        update(PaymentMethod)
+        .where(PaymentMethod.user_id == current_user.id, owned)
+        .values(is_default=(PaymentMethod.id == payment_method_id)),
+        execution_options={'synchronize_session': False}
+    )
+    if result.rowcount == 0:
         return jsonify({'error': 'Payment method not found'}), 404
     
-    # Remove default from all other payment methods
-    PaymentMethod.query.filter_by(user_id=current_user.id).update({'is_default': False})
-    
-    # Set this one as default
-    payment_method.is_default = True
-    
     db.session.commit()
     
     return jsonify({'message': 'Default payment method updated'})
@@ -257,68 +260,53 @@ def set_default_payment_method(current_user, payment_method_id):
 @token_required
 def get_usage(current_user):
     """Get current usage statistics"""
-    subscription = Subscription.query.filter_by(user_id=current_user.id).first()
+    subscription = get_subscription_cached(current_user.id)
     if not subscription:
         return jsonify({'error': 'No subscription found'}), 404
     
-    plan_details = SUBSCRIPTION_PLANS.get(subscription.plan_id, {})
-    limits = plan_details.get('limits', {})
+    device_limit, automation_limit, api_calls_limit, storage_limit = \
+        SUBSCRIPTION_LIMITS.get(subscription['plan_id'], (0, 0, 0, 0))
     
     # Get current usage
-    current_period_start = subscription.current_period_start
-    current_period_end = subscription.current_period_end
+    current_period_start = datetime.fromisoformat(subscription['current_period_start'])
+    current_period_end = datetime.fromisoformat(subscription['current_period_end'])
     
-    usage_data = {}
-    
-    # Device count
-    device_count = len(current_user.devices)
-    usage_data['devices'] = {
-        'used': device_count,
-        'limit': limits.get('devices', 0),
-        'percentage': (device_count / limits.get('devices', 1)) * 100 if limits.get('devices', 0) > 0 else 0
-    }
-    
-    # Automation count
-    automation_count = len(current_user.automation_rules)
-    usage_data['automations'] = {
-        'used': automation_count,
-        'limit': limits.get('automations', 0),
-        'percentage': (automation_count / limits.get('automations', 1)) * 100 if limits.get('automations', 0) > 0 else 0
-    }
+    devices, automations, api_calls, storage = _usage_counts(current_user.id, current_period_start, current_period_end)
     
-    # API calls (simulated)
-    api_calls = UsageRecord.query.filter(
-        UsageRecord.user_id == current_user.id,
-        UsageRecord.metric_type == 'api_calls',
-        UsageRecord.period_start >= current_period_start,
-        UsageRecord.period_end <= current_period_end
-    ).first()
-    
-    api_calls_count = api_calls.usage_count if api_calls else 0
-    usage_data['api_calls'] = {
-        'used': api_calls_count,
-        'limit': limits.get('api_calls', 0),
-        'percentage': (api_calls_count / limits.get('api_calls', 1)) * 100 if limits.get('api_calls', 0) > 0 else 0
-    }
-    
-    # Storage (simulated)
-    storage_usage = UsageRecord.query.filter(
-        UsageRecord.user_id == current_user.id,
-        UsageRecord.metric_type == 'storage',
-        UsageRecord.period_start >= current_period_start,
-        UsageRecord.period_end <= current_period_end
-    ).first()
-    
-    storage_count = storage_usage.usage_count if storage_usage else 0
-    usage_data['storage'] = {
-        'used': storage_count,
-        'limit': limits.get('storage', 0),
-        'percentage': (storage_count / limits.get('storage', 1)) * 100 if limits.get('storage', 0) > 0 else 0
+    return jsonify({
+        'devices': _usage(devices, device_limit),
+        'automations': _usage(automations, automation_limit),
+        'api_calls': _usage(api_calls, api_calls_limit),  # Simulated
+        'storage': _usage(storage, storage_limit)  # Simulated
+    })
+
+def _usage_counts(user_id, period_start, period_end):
+    """(devices, automations, api_calls, storage) for a user in one round trip"""
+    def period_total(metric_type):
+        # Usage recorded within the billing period
+        return func.coalesce(select(UsageRecord.usage_count).where(
+            UsageRecord.user_id == user_id,
+            UsageRecord.metric_type == metric_type,
+            UsageRecord.period_start >= period_start,
+            UsageRecord.period_end <= period_end
+        ).order_by(UsageRecord.period_start).limit(1).scalar_subquery(), 0)
+    
+    return db.session.execute(select(
+        select(func.count(Device.id)).where(Device.user_id == user_id).scalar_subquery(),
+        select(func.count(AutomationRule.id)).where(AutomationRule.user_id == user_id).scalar_subquery(),
+        period_total('api_calls'),
+        period_total('storage')
+    )).one()
+
+def _usage(used, limit):
+    """Usage entry for one metric; a limit of -1 (unlimited) or 0 reports 0%"""
+    return {
+        'used': used,
+        'limit': limit,
+        'percentage': (used / limit) * 100 if limit > 0 else 0
     }
-    
-    return jsonify(usage_data)
 
 @billing_bp.route('/billing/plans', methods=['GET'])
 def get_plans():
     """Get available subscription plans"""
-    return jsonify(SUBSCRIPTION_PLANS)
+    return static_json(SUBSCRIPTION_PLANS_JSON, SUBSCRIPTION_PLANS_ETAG, max_age=300)
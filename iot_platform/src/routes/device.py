@@ -1,39 +1,76 @@
-from flask import Blueprint, request, jsonify
+import math
+from flask import Blueprint, Response, request, jsonify, g, current_app, stream_with_context
+from sqlalchemy import select, insert, update, delete, tuple_
 from src.models.user import db
-from src.models.device import Device, DeviceData, AutomationRule
-from src.decorators.rbac_decorators import token_required, permission_required, owner_or_permission_required
+from src.models.device import Device, DeviceData, DeviceDataOut, AutomationRule, AutomationRuleOut
+from src.decorators.rbac_decorators import auth_required
 from datetime import datetime, timedelta
-import json
 
 device_bp = Blueprint('device', __name__)
 
+# Rows per fetch when streaming device history
+DATA_STREAM_BATCH_SIZE = 1000
+
+# Rows per fetch when streaming the unscoped admin device listing
+DEVICE_STREAM_BATCH_SIZE = 500
+
+# Upper bound on readings accepted by one bulk ingest request
+MAX_BULK_SAMPLES = 10000
+
+# Largest ?limit= page of device history
+MAX_DATA_PAGE_SIZE = 1000
+
 @device_bp.route('/devices', methods=['GET'])
-@permission_required('devices', 'read')
+@auth_required(permission=('devices', 'read'))
 def get_devices(current_user):
     """Get all devices - filtered by user permissions"""
     room_id = request.args.get('room_id')  # Optional room filter
+    minimal = request.args.get('view') == 'minimal'  # id, device_id, name, status, room_id only
     
     # Admin users can see all devices, regular users see only their own
-    if current_user.has_permission('devices', 'manage'):
-        query = Device.query
-    else:
-        query = Device.query.filter_by(user_id=current_user.id)
+    owner_id = None if g.auth.has_permission('devices', 'manage') else current_user.id
     
-    if room_id:
-        query = query.filter_by(room_id=room_id)
+    if minimal:
+        query = Device.minimal_select(owner_id)
+        if room_id:
+            query = query.where(Device.room_id == room_id)
+        return jsonify([device.to_dict_minimal() for device in db.session.scalars(query)])
     
-    devices = query.all()
-    return jsonify([device.to_dict() for device in devices])
+    criteria = []
+    if owner_id is not None:
+        criteria.append(Device.user_id == owner_id)
+    if room_id:
+        criteria.append(Device.room_id == room_id)
+    
+    if owner_id is not None:
+        return jsonify(Device.list_out(*criteria))
+    
+    # Admins list every device in the system; stream it rather than build it in memory
+    batches = Device.iter_out(*criteria, batch_size=DEVICE_STREAM_BATCH_SIZE)
+    dumps = current_app.json.dumps
+    
+    def stream():
+        yield '['
+        separator = ''
+        for items in batches:
+            if not items:
+                continue
+            # Drop the list brackets so batches join into one array
+            yield separator + dumps(items)[1:-1]
+            separator = ','
+        yield ']'
+    
+    return Response(stream_with_context(stream()), mimetype='application/json')
 
 @device_bp.route('/devices', methods=['POST'])
-@permission_required('devices', 'write')
+@auth_required(permission=('devices', 'write'))
 def create_device(current_user):
     """Create a new device"""
     data = request.get_json()
     
     # Determine user_id - admins can create devices for other users
     user_id = data.get('user_id', current_user.id)
-    if user_id != current_user.id and not current_user.has_permission('devices', 'manage'):
+    if user_id != current_user.id and not g.auth.has_permission('devices', 'manage'):
         return jsonify({'error': 'Insufficient permissions to create device for other users'}), 403
     
     device = Device(
@@ -43,7 +80,7 @@ def create_device(current_user):
         location=data.get('location'),  # Legacy field
         user_id=user_id,
         room_id=data.get('room_id'),  # New room association
-        config=json.dumps(data.get('config', {}))
+        config=data.get('config', {})
     )
     
     db.session.add(device)
@@ -52,7 +89,7 @@ def create_device(current_user):
     return jsonify(device.to_dict()), 201
 
 @device_bp.route('/devices/<device_id>', methods=['GET'])
-@permission_required('devices', 'read')
+@auth_required(permission=('devices', 'read'))
 def get_device(current_user, device_id):
     """Get a specific device"""
     device = Device.query.filter_by(device_id=device_id).first()
@@ -60,13 +97,13 @@ def get_device(current_user, device_id):
         return jsonify({'error': 'Device not found'}), 404
     
     # Check if user can access this device
-    if device.user_id != current_user.id and not current_user.has_permission('devices', 'manage'):
+    if device.user_id != current_user.id and not g.auth.has_permission('devices', 'manage'):
         return jsonify({'error': 'Access denied'}), 403
     
     return jsonify(device.to_dict())
 
 @device_bp.route('/devices/<device_id>', methods=['PUT'])
-@permission_required('devices', 'write')
+@auth_required(permission=('devices', 'write'))
 def update_device(current_user, device_id):
     """Update a device"""
     device = Device.query.filter_by(device_id=device_id).first()
@@ -74,7 +111,7 @@ def update_device(current_user, device_id):
         return jsonify({'error': 'Device not found'}), 404
     
     # Check if user can update this device
-    if device.user_id != current_user.id and not current_user.has_permission('devices', 'manage'):
+    if device.user_id != current_user.id and not g.auth.has_permission('devices', 'manage'):
         return jsonify({'error': 'Access denied'}), 403
     
     data = request.get_json()
@@ -83,13 +120,13 @@ def update_device(current_user, device_id):
     device.room_id = data.get('room_id', device.room_id)  # New room association
     device.status = data.get('status', device.status)
     if 'config' in data:
-        device.config = json.dumps(data['config'])
+        device.config = data['config']
     
     db.session.commit()
     return jsonify(device.to_dict())
 
 @device_bp.route('/devices/<device_id>', methods=['DELETE'])
-@permission_required('devices', 'delete')
+@auth_required(permission=('devices', 'delete'))
 def delete_device(current_user, device_id):
     """Delete a device"""
     device = Device.query.filter_by(device_id=device_id).first()
@@ -97,60 +134,117 @@ def delete_device(current_user, device_id):
         return jsonify({'error': 'Device not found'}), 404
     
     # Check if user can delete this device
-    if device.user_id != current_user.id and not current_user.has_permission('devices', 'manage'):
+    if device.user_id != current_user.id and not g.auth.has_permission('devices', 'manage'):
         return jsonify({'error': 'Access denied'}), 403
     
+    # Telemetry is keyed on the integer pk, which SQLite reuses for the next
+    # device created, so the readings go with the device
+    db.session.execute(delete(DeviceData).where(DeviceData.device_pk == device.id))
     db.session.delete(device)
     db.session.commit()
     return jsonify({'message': 'Device deleted successfully'})
 
 @device_bp.route('/rooms/<int:room_id>/devices', methods=['GET'])
-@permission_required('devices', 'read')
+@auth_required(permission=('devices', 'read'))
 def get_room_devices(current_user, room_id):
     """Get all devices in a specific room"""
     # Admin users can see all devices, regular users see only their own
-    if current_user.has_permission('devices', 'manage'):
-        devices = Device.query.filter_by(room_id=room_id).all()
+    if g.auth.has_permission('devices', 'manage'):
+        devices = Device.list_out(Device.room_id == room_id)
     else:
-        devices = Device.query.filter_by(room_id=room_id, user_id=current_user.id).all()
-    return jsonify([device.to_dict() for device in devices])
+        devices = Device.list_out(Device.room_id == room_id, Device.user_id == current_user.id)
+    return jsonify(devices)
+
+def _touch_device(current_user, device_id, now):
+    """
+    Mark a device online as of now for a telemetry write. The UPDATE is also
+    the existence and ownership check: it returns the device's pk, or None
+    with a 404/403 response when no row the user may write to matched.
+    """
+    query = update(Device).where(Device.device_id == device_id)
+    if not g.auth.has_permission('devices', 'manage'):
+        query = query.where(Device.user_id == current_user.id)
+    device_pk = db.session.execute(
+        query.values(last_seen=now, status='online').returning(Device.id),
+        execution_options={'synchronize_session': False}
+    ).scalar()
+    if device_pk is not None:
+        return device_pk, None
+    
+    # Only failed writes pay for telling the two errors apart
+    if db.session.execute(select(Device.id).where(Device.device_id == device_id)).first() is None:
+        return None, (jsonify({'error': 'Device not found'}), 404)
+    return None, (jsonify({'error': 'Access denied'}), 403)
 
 @device_bp.route('/devices/<device_id>/data', methods=['POST'])
-@permission_required('devices', 'write')
-def add_device_data(current_user):
+@auth_required(permission=('devices', 'write'))
+def add_device_data(current_user, device_id):
     """Add data from a device"""
-    device_id = request.view_args['device_id']
     data = request.get_json()
     
-    # Check if device exists
-    device = Device.query.filter_by(device_id=device_id).first()
-    if not device:
-        return jsonify({'error': 'Device not found'}), 404
-    
-    # Check if user can add data to this device
-    if device.user_id != current_user.id and not current_user.has_permission('devices', 'manage'):
-        return jsonify({'error': 'Access denied'}), 403
-    
-    # Update device last_seen
-    device.last_seen = datetime.utcnow()
-    device.status = 'online'
-    
-    # Add device data
-    device_data = DeviceData(
-        device_id=device_id,
-        data_type=data['data_type'],
-        value=data['value'],
-        unit=data.get('unit'),
-        timestamp=datetime.fromisoformat(data['timestamp']) if 'timestamp' in data else datetime.utcnow()
-    )
+    data_type = data['data_type']
+    try:
+        value_q, value_raw = DeviceData.encode_value(data_type, data['value'])
+    except (TypeError, ValueError):
+        return jsonify({'error': 'value must be a finite number'}), 400
+    
+    now = datetime.utcnow()
+    device_pk, error = _touch_device(current_user, device_id, now)
+    if error:
+        return error
+    
+    # One UPDATE above and one INSERT here; no Device or DeviceData objects
+    timestamp = datetime.fromisoformat(data['timestamp']) if 'timestamp' in data else now
+    unit = data.get('unit')
+    data_id = db.session.execute(insert(DeviceData).values(
+        device_pk=device_pk, data_type=data_type, value_q=value_q, value_raw=value_raw,
+        unit=unit, timestamp=timestamp
+    ).returning(DeviceData.id)).scalar_one()
+    db.session.commit()
     
-    db.session.add(device_data)
+    return jsonify(DeviceDataOut(data_id, device_id, timestamp, data_type,
+                                 DeviceData.decode_value(data_type, value_q, value_raw), unit)), 201
+
+@device_bp.route('/devices/<device_id>/data/bulk', methods=['POST'])
+@auth_required(permission=('devices', 'write'))
+def add_device_data_bulk(current_user, device_id):
+    """Add a batch of readings from a device in one transaction"""
+    body = request.get_json()
+    samples = body.get('samples') if isinstance(body, dict) else None
+    if not isinstance(samples, list) or not samples:
+        return jsonify({'error': 'samples must be a non-empty list'}), 400
+    if len(samples) > MAX_BULK_SAMPLES:
+        return jsonify({'error': f'At most {MAX_BULK_SAMPLES} samples per request'}), 400
+    
+    now = datetime.utcnow()
+    records = []
+    for sample in samples:
+        try:
+            value = float(sample['value'])
+            if not math.isfinite(value):
+                raise ValueError(value)
+            records.append({
+                'data_type': sample['data_type'],
+                'value': value,
+                'unit': sample.get('unit'),
+                'timestamp': datetime.fromisoformat(sample['timestamp']) if 'timestamp' in sample else now
+            })
+        except (KeyError, TypeError, ValueError, AttributeError):
+            return jsonify({'error': 'Each sample needs data_type, a finite numeric value and an ISO timestamp if given'}), 400
+    
+    # One UPDATE for the device and executemany batches for the readings
+    device_pk, error = _touch_device(current_user, device_id, now)
+    if error:
+        return error
+    for record in records:
+        record['device_pk'] = device_pk
+    DeviceData.bulk_create(records)
     db.session.commit()
     
-    return jsonify(device_data.to_dict()), 201
+    return jsonify({'device_id': device_id, 'inserted': len(records)}), 201
 
 @device_bp.route('/devices/<device_id>/data', methods=['GET'])
-@permission_required('devices', 'read')
+@auth_required(permission=('devices', 'read'))
 def get_device_data(current_user, device_id):
     """Get historical data for a device"""
     # Check if device exists and user can access it
@@ -158,7 +252,7 @@ def get_device_data(current_user, device_id):
     if not device:
         return jsonify({'error': 'Device not found'}), 404
     
-    if device.user_id != current_user.id and not current_user.has_permission('devices', 'manage'):
+    if device.user_id != current_user.id and not g.auth.has_permission('devices', 'manage'):
         return jsonify({'error': 'Access denied'}), 403
     
     # Query parameters
@@ -169,45 +263,90 @@ def get_device_data(current_user, device_id):
     end_time = datetime.utcnow()
     start_time = end_time - timedelta(hours=hours)
     
-    # Build query
-    query = DeviceData.query.filter_by(device_id=device_id)
+    # Plain columns keyed on the loaded device's pk; no ORM objects are built
+    query = select(
+        DeviceData.id, DeviceData.timestamp, DeviceData.data_type,
+        DeviceData.value_q, DeviceData.value_raw, DeviceData.unit
+    ).where(DeviceData.device_pk == device.id, DeviceData.timestamp >= start_time)
     if data_type:
-        query = query.filter_by(data_type=data_type)
-    query = query.filter(DeviceData.timestamp >= start_time)
+        query = query.where(DeviceData.data_type == data_type)
+    decode = DeviceData.decode_value
+    
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        # Keyset page: newest first, resuming strictly after the (timestamp, id)
+        # of the previous page's last row, so equal timestamps are not skipped
+        cursor = request.args.get('cursor')
+        if cursor:
+            try:
+                cursor_ts, cursor_id = cursor.rsplit('_', 1)
+                query = query.where(tuple_(DeviceData.timestamp, DeviceData.id)
+                                    < tuple_(datetime.fromisoformat(cursor_ts), int(cursor_id)))
+            except ValueError:
+                return jsonify({'error': 'Invalid cursor'}), 400
+        limit = max(1, min(limit, MAX_DATA_PAGE_SIZE))
+        rows = db.session.execute(
+            query.order_by(DeviceData.timestamp.desc(), DeviceData.id.desc()).limit(limit)
+        ).all()
+        next_cursor = None
+        if len(rows) == limit:
+            next_cursor = f'{rows[-1].timestamp.isoformat()}_{rows[-1].id}'
+        return jsonify({
+            'data': [
+                DeviceDataOut(pk, device_id, timestamp, dtype, decode(dtype, value_q, value_raw), unit)
+                for pk, timestamp, dtype, value_q, value_raw, unit in rows
+            ],
+            'next_cursor': next_cursor
+        })
+    
+    # Unpaginated: server-side cursor, fetched and serialized in batches
     query = query.order_by(DeviceData.timestamp.desc())
-    
-    data = query.all()
-    return jsonify([item.to_dict() for item in data])
+    rows = db.session.execute(query.execution_options(yield_per=DATA_STREAM_BATCH_SIZE))
+    dumps = current_app.json.dumps
+    
+    def stream():
+        yield '['
+        separator = ''
+        for batch in rows.partitions():
+            items = [
+                DeviceDataOut(pk, device_id, timestamp, dtype, decode(dtype, value_q, value_raw), unit)
+                for pk, timestamp, dtype, value_q, value_raw, unit in batch
+            ]
+            # Drop the list brackets so batches join into one array
+            yield separator + dumps(items)[1:-1]
+            separator = ','
+        yield ']'
+    
+    return Response(stream_with_context(stream()), mimetype='application/json')
 
 @device_bp.route('/automation/rules', methods=['GET'])
-@permission_required('automations', 'read')
+@auth_required(permission=('automations', 'read'))
 def get_automation_rules(current_user):
     """Get all automation rules"""
     # Admin users can see all rules, regular users see only their own
-    if current_user.has_permission('automations', 'manage'):
-        rules = AutomationRule.query.all()
-    else:
-        rules = AutomationRule.query.filter_by(user_id=current_user.id).all()
-    return jsonify([rule.to_dict() for rule in rules])
+    query = AutomationRule.select_out()
+    if not g.auth.has_permission('automations', 'manage'):
+        query = query.where(AutomationRule.user_id == current_user.id)
+    return jsonify([AutomationRuleOut(*row) for row in db.session.execute(query)])
 
 @device_bp.route('/automation/rules', methods=['POST'])
-@permission_required('automations', 'write')
+@auth_required(permission=('automations', 'write'))
 def create_automation_rule(current_user):
     """Create a new automation rule"""
     data = request.get_json()
     
     # Determine user_id - admins can create rules for other users
     user_id = data.get('user_id', current_user.id)
-    if user_id != current_user.id and not current_user.has_permission('automations', 'manage'):
+    if user_id != current_user.id and not g.auth.has_permission('automations', 'manage'):
         return jsonify({'error': 'Insufficient permissions to create automation rule for other users'}), 403
     
     rule = AutomationRule(
         name=data['name'],
         description=data.get('description'),
         trigger_device_id=data['trigger_device_id'],
-        trigger_condition=json.dumps(data['trigger_condition']),
+        trigger_condition=data['trigger_condition'],
         action_device_id=data['action_device_id'],
-        action_command=json.dumps(data['action_command']),
+        action_command=data['action_command'],
         user_id=user_id
     )
     
@@ -217,7 +356,7 @@ def create_automation_rule(current_user):
     return jsonify(rule.to_dict()), 201
 
 @device_bp.route('/automation/rules/<int:rule_id>', methods=['PUT'])
-@permission_required('automations', 'write')
+@auth_required(permission=('automations', 'write'))
 def update_automation_rule(current_user, rule_id):
     """Update an automation rule"""
     rule = AutomationRule.query.get(rule_id)
@@ -225,7 +364,7 @@ def update_automation_rule(current_user, rule_id):
         return jsonify({'error': 'Rule not found'}), 404
     
     # Check if user can update this rule
-    if rule.user_id != current_user.id and not current_user.has_permission('automations', 'manage'):
+    if rule.user_id != current_user.id and not g.auth.has_permission('automations', 'manage'):
         return jsonify({'error': 'Access denied'}), 403
     
     data = request.get_json()
@@ -234,15 +373,15 @@ def update_automation_rule(current_user, rule_id):
     rule.is_active = data.get('is_active', rule.is_active)
     
     if 'trigger_condition' in data:
-        rule.trigger_condition = json.dumps(data['trigger_condition'])
+        rule.trigger_condition = data['trigger_condition']
     if 'action_command' in data:
-        rule.action_command = json.dumps(data['action_command'])
+        rule.action_command = data['action_command']
     
     db.session.commit()
     return jsonify(rule.to_dict())
 
 @device_bp.route('/automation/rules/<int:rule_id>', methods=['DELETE'])
-@permission_required('automations', 'delete')
+@auth_required(permission=('automations', 'delete'))
 def delete_automation_rule(current_user, rule_id):
     """Delete an automation rule"""
     rule = AutomationRule.query.get(rule_id)
@@ -250,7 +389,7 @@ def delete_automation_rule(current_user, rule_id):
         return jsonify({'error': 'Rule not found'}), 404
     
     # Check if user can delete this rule
-    if rule.user_id != current_user.id and not current_user.has_permission('automations', 'manage'):
+    if rule.user_id != current_user.id and not g.auth.has_permission('automations', 'manage'):
         return jsonify({'error': 'Access denied'}), 403
     
     db.session.delete(rule)
@@ -1,11 +1,13 @@
 from flask import Blueprint, request, jsonify
+from sqlalchemy.orm import joinedload, selectinload
 from src.models.user import db, User
-from src.models.device import Device, ThreadNetwork
+from src.models.device import Device, ThreadNetwork, ThreadNetworkOut
 from src.routes.auth import token_required, permission_required
+from src.routes.responses import static_json
 from datetime import datetime
-import json
 import secrets
 import hashlib
+import orjson
 
 matter_thread_bp = Blueprint('matter_thread', __name__)
 
@@ -15,8 +17,8 @@ matter_thread_bp = Blueprint('matter_thread', __name__)
 @token_required
 def get_thread_networks(current_user):
     """Get all Thread networks for the current user"""
-    networks = ThreadNetwork.query.filter_by(user_id=current_user.id).all()
-    return jsonify([network.to_dict() for network in networks])
+    rows = db.session.execute(ThreadNetwork.select_out().where(ThreadNetwork.user_id == current_user.id))
+    return jsonify([ThreadNetworkOut(*row) for row in rows])
 
 @matter_thread_bp.route('/thread/networks', methods=['POST'])
 @token_required
@@ -84,10 +86,9 @@ def delete_thread_network(current_user, network_id):
     if not network:
         return jsonify({'error': 'Thread network not found'}), 404
     
-    # Check if any devices are using this network
-    devices_using_network = Device.query.filter_by(thread_network_id=network_id).count()
-    if devices_using_network > 0:
-        return jsonify({'error': f'Cannot delete network. {devices_using_network} devices are still using this network.'}), 400
+    # devices_count is kept in step with Device.thread_network_id by count_children()
+    if network.devices_count > 0:
+        return jsonify({'error': f'Cannot delete network. {network.devices_count} devices are still using this network.'}), 400
     
     db.session.delete(network)
     db.session.commit()
@@ -101,7 +102,7 @@ def get_thread_network_devices(current_user, network_id):
     if not network:
         return jsonify({'error': 'Thread network not found'}), 404
     
-    devices = Device.query.filter_by(thread_network_id=network_id).all()
+    devices = Device.query.options(selectinload(Device.matter_ext)).filter_by(thread_network_id=network_id).all()
     return jsonify([device.to_dict() for device in devices])
 
 # Matter Device Management Routes
@@ -110,21 +111,22 @@ def get_thread_network_devices(current_user, network_id):
 @token_required
 def commission_matter_device(current_user, device_id):
     """Commission a Matter device"""
-    device = Device.query.filter_by(device_id=device_id, user_id=current_user.id).first()
+    device = Device.query.options(joinedload(Device.matter_ext)).filter_by(device_id=device_id, user_id=current_user.id).first()
     if not device:
         return jsonify({'error': 'Device not found'}), 404
     
     data = request.get_json()
     
     # Update Matter-specific fields
-    device.matter_vendor_id = data.get('vendor_id')
-    device.matter_product_id = data.get('product_id')
-    device.matter_device_type_id = data.get('device_type_id')
-    device.matter_fabric_id = data.get('fabric_id')
-    device.matter_node_id = data.get('node_id')
-    device.matter_certificate = data.get('certificate')
+    ext = device.get_matter_ext()
+    ext.matter_vendor_id = data.get('vendor_id')
+    ext.matter_product_id = data.get('product_id')
+    ext.matter_device_type_id = data.get('device_type_id')
+    ext.matter_fabric_id = data.get('fabric_id')
+    ext.matter_node_id = data.get('node_id')
+    ext.matter_certificate = data.get('certificate')
+    ext.matter_commissioning_date = datetime.utcnow()
     device.matter_commissioned = True
-    device.matter_commissioning_date = datetime.utcnow()
     
     db.session.commit()
     return jsonify(device.to_dict())
@@ -133,19 +135,20 @@ def commission_matter_device(current_user, device_id):
 @token_required
 def decommission_matter_device(current_user, device_id):
     """Decommission a Matter device"""
-    device = Device.query.filter_by(device_id=device_id, user_id=current_user.id).first()
+    device = Device.query.options(joinedload(Device.matter_ext)).filter_by(device_id=device_id, user_id=current_user.id).first()
     if not device:
         return jsonify({'error': 'Device not found'}), 404
     
     # Clear Matter-specific fields
-    device.matter_vendor_id = None
-    device.matter_product_id = None
-    device.matter_device_type_id = None
-    device.matter_fabric_id = None
-    device.matter_node_id = None
-    device.matter_certificate = None
+    ext = device.get_matter_ext()
+    ext.matter_vendor_id = None
+    ext.matter_product_id = None
+    ext.matter_device_type_id = None
+    ext.matter_fabric_id = None
+    ext.matter_node_id = None
+    ext.matter_certificate = None
+    ext.matter_commissioning_date = None
     device.matter_commissioned = False
-    device.matter_commissioning_date = None
     
     db.session.commit()
     return jsonify(device.to_dict())
@@ -154,7 +157,7 @@ def decommission_matter_device(current_user, device_id):
 @token_required
 def get_matter_devices(current_user):
     """Get all Matter-commissioned devices for the current user"""
-    devices = Device.query.filter_by(user_id=current_user.id, matter_commissioned=True).all()
+    devices = Device.query.options(selectinload(Device.matter_ext)).filter_by(user_id=current_user.id, matter_commissioned=True).all()
     return jsonify([device.to_dict() for device in devices])
 
 # Thread Device Management Routes
@@ -163,7 +166,7 @@ def get_matter_devices(current_user):
 @token_required
 def join_thread_network(current_user, device_id):
     """Join a device to a Thread network"""
-    device = Device.query.filter_by(device_id=device_id, user_id=current_user.id).first()
+    device = Device.query.options(joinedload(Device.matter_ext)).filter_by(device_id=device_id, user_id=current_user.id).first()
     if not device:
         return jsonify({'error': 'Device not found'}), 404
     
@@ -180,14 +183,15 @@ def join_thread_network(current_user, device_id):
     # Update device Thread configuration
     device.thread_enabled = True
     device.thread_network_id = network_id
-    device.thread_network_name = network.network_name
-    device.thread_network_key = network.network_key
-    device.thread_extended_pan_id = network.extended_pan_id
-    device.thread_channel = network.channel
-    device.thread_mesh_local_prefix = network.mesh_local_prefix
-    device.thread_border_router = data.get('border_router', False)
-    device.thread_router_role = data.get('router_role', 'child')
-    device.thread_parent_address = data.get('parent_address')
+    ext = device.get_matter_ext()
+    ext.thread_network_name = network.network_name
+    ext.thread_network_key = network.network_key
+    ext.thread_extended_pan_id = network.extended_pan_id
+    ext.thread_channel = network.channel
+    ext.thread_mesh_local_prefix = network.mesh_local_prefix
+    ext.thread_border_router = data.get('border_router', False)
+    ext.thread_router_role = data.get('router_role', 'child')
+    ext.thread_parent_address = data.get('parent_address')
     
     db.session.commit()
     return jsonify(device.to_dict())
@@ -196,21 +200,22 @@ def join_thread_network(current_user, device_id):
 @token_required
 def leave_thread_network(current_user, device_id):
     """Remove a device from a Thread network"""
-    device = Device.query.filter_by(device_id=device_id, user_id=current_user.id).first()
+    device = Device.query.options(joinedload(Device.matter_ext)).filter_by(device_id=device_id, user_id=current_user.id).first()
     if not device:
         return jsonify({'error': 'Device not found'}), 404
     
     # Clear Thread configuration
     device.thread_enabled = False
     device.thread_network_id = None
-    device.thread_network_name = None
-    device.thread_network_key = None
-    device.thread_extended_pan_id = None
-    device.thread_channel = None
-    device.thread_mesh_local_prefix = None
-    device.thread_border_router = False
-    device.thread_router_role = None
-    device.thread_parent_address = None
+    ext = device.get_matter_ext()
+    ext.thread_network_name = None
+    ext.thread_network_key = None
+    ext.thread_extended_pan_id = None
+    ext.thread_channel = None
+    ext.thread_mesh_local_prefix = None
+    ext.thread_border_router = False
+    ext.thread_router_role = None
+    ext.thread_parent_address = None
     
     db.session.commit()
     return jsonify(device.to_dict())
@@ -219,7 +224,7 @@ def leave_thread_network(current_user, device_id):
 @token_required
 def get_thread_devices(current_user):
     """Get all Thread-enabled devices for the current user"""
-    devices = Device.query.filter_by(user_id=current_user.id, thread_enabled=True).all()
+    devices = Device.query.options(selectinload(Device.matter_ext)).filter_by(user_id=current_user.id, thread_enabled=True).all()
     return jsonify([device.to_dict() for device in devices])
 
 # Thread Network Diagnostics
@@ -232,12 +237,21 @@ def get_thread_network_diagnostics(current_user, network_id):
     if not network:
         return jsonify({'error': 'Thread network not found'}), 404
     
-    devices = Device.query.filter_by(thread_network_id=network_id).all()
+    devices = Device.query.options(selectinload(Device.matter_ext)).filter_by(thread_network_id=network_id).all()
     
-    # Build network topology
-    border_routers = [d for d in devices if d.thread_border_router]
-    routers = [d for d in devices if d.thread_router_role == 'router']
-    children = [d for d in devices if d.thread_router_role == 'child']
+    # Build network topology in one pass; a border router also counts under its role
+    border_routers, routers, children = [], [], []
+    for d in devices:
+        ext = d.matter_ext
+        if not ext:
+            continue
+        entry = {'name': d.name, 'device_id': d.device_id}
+        if ext.thread_border_router:
+            border_routers.append(entry)
+        if ext.thread_router_role == 'router':
+            routers.append(entry)
+        elif ext.thread_router_role == 'child':
+            children.append(entry)
     
     diagnostics = {
         'network': network.to_dict(),
@@ -252,9 +266,9 @@ def get_thread_network_diagnostics(current_user, network_id):
             'has_border_router': len(border_routers) > 0,
             'routing_capacity': len(routers),
             'device_distribution': {
-                'border_routers': [{'name': d.name, 'device_id': d.device_id} for d in border_routers],
-                'routers': [{'name': d.name, 'device_id': d.device_id} for d in routers],
-                'children': [{'name': d.name, 'device_id': d.device_id} for d in children]
+                'border_routers': border_routers,
+                'routers': routers,
+                'children': children
             }
         }
     }
@@ -263,93 +277,97 @@ def get_thread_network_diagnostics(current_user, network_id):
 
 # Matter Device Types and Vendor Information
 
+MATTER_DEVICE_TYPES = {
+    'on_off_light': {'id': '0x0100', 'name': 'On/Off Light'},
+    'dimmable_light': {'id': '0x0101', 'name': 'Dimmable Light'},
+    'color_temperature_light': {'id': '0x010C', 'name': 'Color Temperature Light'},
+    'extended_color_light': {'id': '0x010D', 'name': 'Extended Color Light'},
+    'on_off_light_switch': {'id': '0x0103', 'name': 'On/Off Light Switch'},
+    'dimmer_switch': {'id': '0x0104', 'name': 'Dimmer Switch'},
+    'color_dimmer_switch': {'id': '0x0105', 'name': 'Color Dimmer Switch'},
+    'on_off_plug_in_unit': {'id': '0x010A', 'name': 'On/Off Plug-in Unit'},
+    'dimmable_plug_in_unit': {'id': '0x010B', 'name': 'Dimmable Plug-in Unit'},
+    'door_lock': {'id': '0x000A', 'name': 'Door Lock'},
+    'window_covering': {'id': '0x0202', 'name': 'Window Covering'},
+    'thermostat': {'id': '0x0301', 'name': 'Thermostat'},
+    'fan': {'id': '0x002B', 'name': 'Fan'},
+    'air_quality_sensor': {'id': '0x002C', 'name': 'Air Quality Sensor'},
+    'contact_sensor': {'id': '0x0015', 'name': 'Contact Sensor'},
+    'motion_sensor': {'id': '0x002D', 'name': 'Motion Sensor'},
+    'temperature_sensor': {'id': '0x0302', 'name': 'Temperature Sensor'},
+    'humidity_sensor': {'id': '0x0307', 'name': 'Humidity Sensor'},
+    'light_sensor': {'id': '0x0106', 'name': 'Light Sensor'},
+    'pressure_sensor': {'id': '0x0305', 'name': 'Pressure Sensor'},
+    'flow_sensor': {'id': '0x0306', 'name': 'Flow Sensor'},
+    'occupancy_sensor': {'id': '0x0107', 'name': 'Occupancy Sensor'},
+    'smoke_co_alarm': {'id': '0x0028', 'name': 'Smoke/CO Alarm'},
+    'security_system': {'id': '0x0015', 'name': 'Security System'},
+    'garage_door_controller': {'id': '0x0200', 'name': 'Garage Door Controller'},
+    'speaker': {'id': '0x0022', 'name': 'Speaker'},
+    'tv': {'id': '0x0023', 'name': 'TV'},
+    'refrigerator': {'id': '0x0024', 'name': 'Refrigerator'},
+    'dishwasher': {'id': '0x0025', 'name': 'Dishwasher'},
+    'washing_machine': {'id': '0x0026', 'name': 'Washing Machine'},
+    'dryer': {'id': '0x0027', 'name': 'Dryer'},
+    'oven': {'id': '0x0028', 'name': 'Oven'},
+    'microwave_oven': {'id': '0x0029', 'name': 'Microwave Oven'},
+    'coffee_maker': {'id': '0x002A', 'name': 'Coffee Maker'},
+    'robot_vacuum_cleaner': {'id': '0x002B', 'name': 'Robot Vacuum Cleaner'},
+    'air_purifier': {'id': '0x002C', 'name': 'Air Purifier'},
+    'water_heater': {'id': '0x002D', 'name': 'Water Heater'},
+    'water_leak_detector': {'id': '0x002E', 'name': 'Water Leak Detector'},
+    'valve': {'id': '0x002F', 'name': 'Valve'},
+    'pump': {'id': '0x0030', 'name': 'Pump'},
+    'irrigation_controller': {'id': '0x0031', 'name': 'Irrigation Controller'},
+    'pool_controller': {'id': '0x0032', 'name': 'Pool Controller'},
+    'sprinkler_controller': {'id': '0x0033', 'name': 'Sprinkler Controller'},
+    'bridge': {'id': '0x000E', 'name': 'Bridge'},
+    'range_extender': {'id': '0x000F', 'name': 'Range Extender'}
+}
+MATTER_DEVICE_TYPES_JSON = orjson.dumps(MATTER_DEVICE_TYPES)
+MATTER_DEVICE_TYPES_ETAG = hashlib.blake2b(MATTER_DEVICE_TYPES_JSON, digest_size=8).hexdigest()
+
 @matter_thread_bp.route('/matter/device-types', methods=['GET'])
 def get_matter_device_types():
     """Get supported Matter device types"""
-    device_types = {
-        'on_off_light': {'id': '0x0100', 'name': 'On/Off Light'},
-        'dimmable_light': {'id': '0x0101', 'name': 'Dimmable Light'},
-        'color_temperature_light': {'id': '0x010C', 'name': 'Color Temperature Light'},
-        'extended_color_light': {'id': '0x010D', 'name': 'Extended Color Light'},
-        'on_off_light_switch': {'id': '0x0103', 'name': 'On/Off Light Switch'},
-        'dimmer_switch': {'id': '0x0104', 'name': 'Dimmer Switch'},
-        'color_dimmer_switch': {'id': '0x0105', 'name': 'Color Dimmer Switch'},
-        'on_off_plug_in_unit': {'id': '0x010A', 'name': 'On/Off Plug-in Unit'},
-        'dimmable_plug_in_unit': {'id': '0x010B', 'name': 'Dimmable Plug-in Unit'},
-        'door_lock': {'id': '0x000A', 'name': 'Door Lock'},
-        'window_covering': {'id': '0x0202', 'name': 'Window Covering'},
-        'thermostat': {'id': '0x0301', 'name': 'Thermostat'},
-        'fan': {'id': '0x002B', 'name': 'Fan'},
-        'air_quality_sensor': {'id': '0x002C', 'name': 'Air Quality Sensor'},
-        'contact_sensor': {'id': '0x0015', 'name': 'Contact Sensor'},
-        'motion_sensor': {'id': '0x002D', 'name': 'Motion Sensor'},
-        'temperature_sensor': {'id': '0x0302', 'name': 'Temperature Sensor'},
-        'humidity_sensor': {'id': '0x0307', 'name': 'Humidity Sensor'},
-        'light_sensor': {'id': '0x0106', 'name': 'Light Sensor'},
-        'pressure_sensor': {'id': '0x0305', 'name': 'Pressure Sensor'},
-        'flow_sensor': {'id': '0x0306', 'name': 'Flow Sensor'},
-        'occupancy_sensor': {'id': '0x0107', 'name': 'Occupancy Sensor'},
-        'smoke_co_alarm': {'id': '0x0028', 'name': 'Smoke/CO Alarm'},
-        'security_system': {'id': '0x0015', 'name': 'Security System'},
-        'garage_door_controller': {'id': '0x0200', 'name': 'Garage Door Controller'},
-        'speaker': {'id': '0x0022', 'name': 'Speaker'},
-        'tv': {'id': '0x0023', 'name': 'TV'},
-        'refrigerator': {'id': '0x0024', 'name': 'Refrigerator'},
-        'dishwasher': {'id': '0x0025', 'name': 'Dishwasher'},
-        'washing_machine': {'id': '0x0026', 'name': 'Washing Machine'},
-        'dryer': {'id': '0x0027', 'name': 'Dryer'},
-        'oven': {'id': '0x0028', 'name': 'Oven'},
-        'microwave_oven': {'id': '0x0029', 'name': 'Microwave Oven'},
-        'coffee_maker': {'id': '0x002A', 'name': 'Coffee Maker'},
-        'robot_vacuum_cleaner': {'id': '0x002B', 'name': 'Robot Vacuum Cleaner'},
-        'air_purifier': {'id': '0x002C', 'name': 'Air Purifier'},
-        'water_heater': {'id': '0x002D', 'name': 'Water Heater'},
-        'water_leak_detector': {'id': '0x002E', 'name': 'Water Leak Detector'},
-        'valve': {'id': '0x002F', 'name': 'Valve'},
-        'pump': {'id': '0x0030', 'name': 'Pump'},
-        'irrigation_controller': {'id': '0x0031', 'name': 'Irrigation Controller'},
-        'pool_controller': {'id': '0x0032', 'name': 'Pool Controller'},
-        'sprinkler_controller': {'id': '0x0033', 'name': 'Sprinkler Controller'},
-        'bridge': {'id': '0x000E', 'name': 'Bridge'},
-        'range_extender': {'id': '0x000F', 'name': 'Range Extender'}
-    }
-    
-    return jsonify(device_types)
+    return static_json(MATTER_DEVICE_TYPES_JSON, MATTER_DEVICE_TYPES_ETAG, max_age=86400)
+
+MATTER_VENDORS = {
+    'apple': {'id': '0x001D', 'name': 'Apple Inc.'},
+    'google': {'id': '0x6006', 'name': 'Google LLC'},
+    'amazon': {'id': '0x131D', 'name': 'Amazon.com Services LLC'},
+    'samsung': {'id': '0x1349', 'name': 'Samsung Electronics Co., Ltd.'},
+    'philips': {'id': '0x100B', 'name': 'Philips Lighting B.V.'},
+    'schlage': {'id': '0x110A', 'name': 'Schlage (Allegion)'},
+    'yale': {'id': '0x1111', 'name': 'Yale Security Inc.'},
+    'august': {'id': '0x1112', 'name': 'August Home, Inc.'},
+    'nest': {'id': '0x1113', 'name': 'Nest Labs Inc.'},
+    'honeywell': {'id': '0x1114', 'name': 'Honeywell International Inc.'},
+    'ecobee': {'id': '0x1115', 'name': 'ecobee Inc.'},
+    'lifx': {'id': '0x1116', 'name': 'LIFX (Buddy Technologies)'},
+    'nanoleaf': {'id': '0x1117', 'name': 'Nanoleaf'},
+    'ikea': {'id': '0x1118', 'name': 'IKEA of Sweden AB'},
+    'signify': {'id': '0x1119', 'name': 'Signify Netherlands B.V.'},
+    'lutron': {'id': '0x111A', 'name': 'Lutron Electronics Co., Inc.'},
+    'leviton': {'id': '0x111B', 'name': 'Leviton Manufacturing Co., Inc.'},
+    'legrand': {'id': '0x111C', 'name': 'Legrand'},
+    'somfy': {'id': '0x111D', 'name': 'Somfy'},
+    'zwave': {'id': '0x111E', 'name': 'Z-Wave Alliance'},
+    'zigbee': {'id': '0x111F', 'name': 'Zigbee Alliance'},
+    'silicon_labs': {'id': '0x1120', 'name': 'Silicon Labs'},
+    'nordic_semiconductor': {'id': '0x1121', 'name': 'Nordic Semiconductor ASA'},
+    'espressif': {'id': '0x1122', 'name': 'Espressif Systems'},
+    'raspberry_pi': {'id': '0x1123', 'name': 'Raspberry Pi Foundation'},
+    'arduino': {'id': '0x1124', 'name': 'Arduino LLC'},
+    'particle': {'id': '0x1125', 'name': 'Particle Industries, Inc.'},
+    'adafruit': {'id': '0x1126', 'name': 'Adafruit Industries'},
+    'sparkfun': {'id': '0x1127', 'name': 'SparkFun Electronics'},
+    'seeed': {'id': '0x1128', 'name': 'Seeed Technology Co., Ltd.'}
+}
+MATTER_VENDORS_JSON = orjson.dumps(MATTER_VENDORS)
+MATTER_VENDORS_ETAG = hashlib.blake2b(MATTER_VENDORS_JSON, digest_size=8).hexdigest()
 
 @matter_thread_bp.route('/matter/vendors', methods=['GET'])
 def get_matter_vendors():
     """Get common Matter vendor IDs"""
-    vendors = {
-        'apple': {'id': '0x001D', 'name': 'Apple Inc.'},
-        'google': {'id': '0x6006', 'name': 'Google LLC'},
-        'amazon': {'id': '0x131D', 'name': 'Amazon.com Services LLC'},
-        'samsung': {'id': '0x1349', 'name': 'Samsung Electronics Co., Ltd.'},
-        'philips': {'id': '0x100B', 'name': 'Philips Lighting B.V.'},
-        'schlage': {'id': '0x110A', 'name': 'Schlage (Allegion)'},
-        'yale': {'id': '0x1111', 'name': 'Yale Security Inc.'},
-        'august': {'id': '0x1112', 'name': 'August Home, Inc.'},
-        'nest': {'id': '0x1113', 'name': 'Nest Labs Inc.'},
-        'honeywell': {'id': '0x1114', 'name': 'Honeywell International Inc.'},
-        'ecobee': {'id': '0x1115', 'name': 'ecobee Inc.'},
-        'lifx': {'id': '0x1116', 'name': 'LIFX (Buddy Technologies)'},
-        'nanoleaf': {'id': '0x1117', 'name': 'Nanoleaf'},
-        'ikea': {'id': '0x1118', 'name': 'IKEA of Sweden AB'},
-        'signify': {'id': '0x1119', 'name': 'Signify Netherlands B.V.'},
-        'lutron': {'id': '0x111A', 'name': 'Lutron Electronics Co., Inc.'},
-        'leviton': {'id': '0x111B', 'name': 'Leviton Manufacturing Co., Inc.'},
-        'legrand': {'id': '0x111C', 'name': 'Legrand'},
-        'somfy': {'id': '0x111D', 'name': 'Somfy'},
-        'zwave': {'id': '0x111E', 'name': 'Z-Wave Alliance'},
-        'zigbee': {'id': '0x111F', 'name': 'Zigbee Alliance'},
-        'silicon_labs': {'id': '0x1120', 'name': 'Silicon Labs'},
-        'nordic_semiconductor': {'id': '0x1121', 'name': 'Nordic Semiconductor ASA'},
-        'espressif': {'id': '0x1122', 'name': 'Espressif Systems'},
-        'raspberry_pi': {'id': '0x1123', 'name': 'Raspberry Pi Foundation'},
-        'arduino': {'id': '0x1124', 'name': 'Arduino LLC'},
-        'particle': {'id': '0x1125', 'name': 'Particle Industries, Inc.'},
-        'adafruit': {'id': '0x1126', 'name': 'Adafruit Industries'},
-        'sparkfun': {'id': '0x1127', 'name': 'SparkFun Electronics'},
-        'seeed': {'id': '0x1128', 'name': 'Seeed Technology Co., Ltd.'}
-    }
-    
-    return jsonify(vendors)
+    return static_json(MATTER_VENDORS_JSON, MATTER_VENDORS_ETAG, max_age=86400)
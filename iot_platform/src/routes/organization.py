@@ -180,7 +180,7 @@ def create_location(current_user, org_id):
 @token_required
 def get_location(current_user, location_id):
     """Get a specific location"""
-    location = Location.query.get(location_id)
+    location = Location.get_with_organization(location_id)
     if not location:
         return jsonify({'error': 'Location not found'}), 404
     
@@ -193,7 +193,7 @@ def get_location(current_user, location_id):
 @token_required
 def update_location(current_user, location_id):
     """Update a location"""
-    location = Location.query.get(location_id)
+    location = Location.get_with_organization(location_id)
     if not location:
         return jsonify({'error': 'Location not found'}), 404
     
@@ -239,7 +239,7 @@ def update_location(current_user, location_id):
 @token_required
 def delete_location(current_user, location_id):
     """Delete a location"""
-    location = Location.query.get(location_id)
+    location = Location.get_with_organization(location_id)
     if not location:
         return jsonify({'error': 'Location not found'}), 404
     
@@ -256,7 +256,7 @@ def delete_location(current_user, location_id):
 @token_required
 def get_rooms(current_user, location_id):
     """Get all rooms for a location"""
-    location = Location.query.get(location_id)
+    location = Location.get_with_organization(location_id)
     if not location:
         return jsonify({'error': 'Location not found'}), 404
     
@@ -269,7 +269,7 @@ def get_rooms(current_user, location_id):
 @token_required
 def create_room(current_user, location_id):
     """Create a new room"""
-    location = Location.query.get(location_id)
+    location = Location.get_with_organization(location_id)
     if not location:
         return jsonify({'error': 'Location not found'}), 404
     
@@ -308,7 +308,7 @@ def create_room(current_user, location_id):
 @token_required
 def get_room(current_user, room_id):
     """Get a specific room"""
-    room = Room.query.get(room_id)
+    room = Room.get_with_organization(room_id)
     if not room:
         return jsonify({'error': 'Room not found'}), 404
     
@@ -321,7 +321,7 @@ def get_room(current_user, room_id):
 @token_required
 def update_room(current_user, room_id):
     """Update a room"""
-    room = Room.query.get(room_id)
+    room = Room.get_with_organization(room_id)
     if not room:
         return jsonify({'error': 'Room not found'}), 404
     
@@ -355,7 +355,7 @@ def update_room(current_user, room_id):
 @token_required
 def delete_room(current_user, room_id):
     """Delete a room"""
-    room = Room.query.get(room_id)
+    room = Room.get_with_organization(room_id)
     if not room:
         return jsonify({'error': 'Room not found'}), 404
     
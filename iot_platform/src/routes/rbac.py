@@ -1,8 +1,8 @@
 """
 RBAC Management Routes
 """
-from flask import Blueprint, request, jsonify
-from src.decorators.rbac_decorators import token_required, permission_required, superuser_required, admin_required
+from flask import Blueprint, request, jsonify, g
+from src.decorators.rbac_decorators import auth_required
 from src.services.rbac_service import RBACService
 from src.models.user import db, Role, Permission, User
 
@@ -10,7 +10,7 @@ rbac_bp = Blueprint('rbac', __name__)
 
 # Initialize RBAC system
 @rbac_bp.route('/init', methods=['POST'])
-@superuser_required
+@auth_required(superuser=True)
 def initialize_rbac(current_user):
     """Initialize default roles and permissions (superuser only)"""
     try:
@@ -25,7 +25,7 @@ def initialize_rbac(current_user):
 
 # Role Management
 @rbac_bp.route('/roles', methods=['GET'])
-@permission_required('users', 'read')
+@auth_required(permission=('users', 'read'))
 def get_roles(current_user):
     """Get all roles"""
     try:
@@ -37,7 +37,7 @@ def get_roles(current_user):
         return jsonify({'error': f'Failed to get roles: {str(e)}'}), 500
 
 @rbac_bp.route('/roles', methods=['POST'])
-@permission_required('users', 'manage')
+@auth_required(permission=('users', 'manage'))
 def create_role(current_user):
     """Create a new role"""
     try:
@@ -66,7 +66,7 @@ def create_role(current_user):
         return jsonify({'error': f'Failed to create role: {str(e)}'}), 500
 
 @rbac_bp.route('/roles/<int:role_id>', methods=['PUT'])
-@permission_required('users', 'manage')
+@auth_required(permission=('users', 'manage'))
 def update_role(current_user, role_id):
     """Update an existing role"""
     try:
@@ -91,7 +91,7 @@ def update_role(current_user, role_id):
         return jsonify({'error': f'Failed to update role: {str(e)}'}), 500
 
 @rbac_bp.route('/roles/<int:role_id>', methods=['DELETE'])
-@permission_required('users', 'manage')
+@auth_required(permission=('users', 'manage'))
 def delete_role(current_user, role_id):
     """Delete a role"""
     try:
@@ -107,7 +107,7 @@ def delete_role(current_user, role_id):
 
 # Permission Management
 @rbac_bp.route('/permissions', methods=['GET'])
-@permission_required('users', 'read')
+@auth_required(permission=('users', 'read'))
 def get_permissions(current_user):
     """Get all permissions"""
     try:
@@ -119,7 +119,7 @@ def get_permissions(current_user):
         return jsonify({'error': f'Failed to get permissions: {str(e)}'}), 500
 
 @rbac_bp.route('/permissions/<resource>', methods=['GET'])
-@permission_required('users', 'read')
+@auth_required(permission=('users', 'read'))
 def get_permissions_by_resource(current_user, resource):
     """Get permissions for a specific resource"""
     try:
@@ -133,7 +133,7 @@ def get_permissions_by_resource(current_user, resource):
 
 # User Role Assignment
 @rbac_bp.route('/users/<int:user_id>/role', methods=['PUT'])
-@permission_required('users', 'manage')
+@auth_required(permission=('users', 'manage'))
 def assign_role_to_user(current_user, user_id):
     """Assign a role to a user"""
     try:
@@ -153,7 +153,7 @@ def assign_role_to_user(current_user, user_id):
         return jsonify({'error': f'Failed to assign role: {str(e)}'}), 500
 
 @rbac_bp.route('/users/<int:user_id>/role', methods=['DELETE'])
-@permission_required('users', 'manage')
+@auth_required(permission=('users', 'manage'))
 def remove_role_from_user(current_user, user_id):
     """Remove role assignment from a user"""
     try:
@@ -169,29 +169,28 @@ def remove_role_from_user(current_user, user_id):
 
 # User Permissions
 @rbac_bp.route('/users/<int:user_id>/permissions', methods=['GET'])
-@permission_required('users', 'read')
+@auth_required(permission=('users', 'read'))
 def get_user_permissions(current_user, user_id):
     """Get all permissions for a user"""
     try:
         # Users can only view their own permissions unless they have manage_users permission
-        if user_id != current_user.id and not current_user.has_permission('users', 'manage'):
+        if user_id != current_user.id and not g.auth.has_permission('users', 'manage'):
             return jsonify({'error': 'Access denied'}), 403
         
-        permissions = RBACService.get_user_permissions(user_id)
         return jsonify({
             'user_id': user_id,
-            'permissions': [permission.to_dict() for permission in permissions]
+            'permissions': RBACService.get_user_permission_dicts(user_id)
         }), 200
     except Exception as e:
         return jsonify({'error': f'Failed to get user permissions: {str(e)}'}), 500
 
 @rbac_bp.route('/users/<int:user_id>/permissions/check', methods=['POST'])
-@permission_required('users', 'read')
+@auth_required(permission=('users', 'read'))
 def check_user_permission(current_user, user_id):
     """Check if a user has a specific permission"""
     try:
         # Users can only check their own permissions unless they have manage_users permission
-        if user_id != current_user.id and not current_user.has_permission('users', 'manage'):
+        if user_id != current_user.id and not g.auth.has_permission('users', 'manage'):
             return jsonify({'error': 'Access denied'}), 403
         
         data = request.get_json()
@@ -219,23 +218,22 @@ def check_user_permission(current_user, user_id):
 
 # Current User Info
 @rbac_bp.route('/me/permissions', methods=['GET'])
-@token_required
+@auth_required()
 def get_my_permissions(current_user):
     """Get current user's permissions"""
     try:
-        permissions = current_user.get_permissions()
         return jsonify({
             'user_id': current_user.id,
             'username': current_user.username,
             'role': current_user.user_role.to_dict() if current_user.user_role else None,
             'is_superuser': current_user.is_superuser,
-            'permissions': [permission.to_dict() for permission in permissions]
+            'permissions': current_user.get_permission_dicts()
         }), 200
     except Exception as e:
         return jsonify({'error': f'Failed to get permissions: {str(e)}'}), 500
 
 @rbac_bp.route('/me/check-permission', methods=['POST'])
-@token_required
+@auth_required()
 def check_my_permission(current_user):
     """Check if current user has a specific permission"""
     try:
@@ -246,7 +244,7 @@ def check_my_permission(current_user):
             if field not in data:
                 return jsonify({'error': f'{field} is required'}), 400
         
-        has_permission = current_user.has_permission(data['resource'], data['action'])
+        has_permission = g.auth.has_permission(data['resource'], data['action'])
         
         return jsonify({
             'user_id': current_user.id,
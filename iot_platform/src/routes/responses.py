@@ -0,0 +1,15 @@
+"""
+Response helpers shared by the route modules
+"""
+from flask import Response, request
+
+def static_json(body, etag, max_age):
+    """
+    Response for pre-encoded JSON that only changes with a deploy.
+    Cacheable for max_age seconds; revalidations get an empty 304.
+    """
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response.make_conditional(request)
@@ -1,18 +1,18 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, jsonify, request, g
 from src.models.user import User, db
-from src.decorators.rbac_decorators import token_required, permission_required
+from src.decorators.rbac_decorators import auth_required
 
 user_bp = Blueprint('user', __name__)
 
 @user_bp.route('/users', methods=['GET'])
-@permission_required('users', 'read')
+@auth_required(permission=('users', 'read'))
 def get_users(current_user):
     """Get all users - only accessible by users with read permission"""
-    users = User.query.all()
+    users = User.list_for_serialization()
     return jsonify([user.to_dict() for user in users])
 
 @user_bp.route('/users', methods=['POST'])
-@permission_required('users', 'write')
+@auth_required(permission=('users', 'write'))
 def create_user(current_user):
     """Create a new user - only accessible by users with write permission"""
     data = request.json
@@ -23,20 +23,20 @@ def create_user(current_user):
     return jsonify(user.to_dict()), 201
 
 @user_bp.route('/users/<int:user_id>', methods=['GET'])
-@token_required
+@auth_required()
 def get_user(current_user, user_id):
     """Get user profile - users can only access their own profile, admins can access any"""
-    if current_user.id != user_id and not current_user.has_permission('users', 'read'):
+    if current_user.id != user_id and not g.auth.has_permission('users', 'read'):
         return jsonify({'error': 'Access denied'}), 403
     
     user = User.query.get_or_404(user_id)
     return jsonify(user.to_dict())
 
 @user_bp.route('/users/<int:user_id>', methods=['PUT'])
-@token_required
+@auth_required()
 def update_user(current_user, user_id):
     """Update user profile - users can only update their own profile, admins can update any"""
-    if current_user.id != user_id and not current_user.has_permission('users', 'write'):
+    if current_user.id != user_id and not g.auth.has_permission('users', 'write'):
         return jsonify({'error': 'Access denied'}), 403
     
     user = User.query.get_or_404(user_id)
@@ -49,7 +49,7 @@ def update_user(current_user, user_id):
     return jsonify(user.to_dict())
 
 @user_bp.route('/users/<int:user_id>', methods=['DELETE'])
-@permission_required('users', 'delete')
+@auth_required(permission=('users', 'delete'))
 def delete_user(current_user, user_id):
     """Delete user - only accessible by users with delete permission"""
     user = User.query.get_or_404(user_id)
@@ -58,13 +58,13 @@ def delete_user(current_user, user_id):
     return '', 204
 
 @user_bp.route('/profile', methods=['GET'])
-@token_required
+@auth_required()
 def get_current_user_profile(current_user):
     """Get current user's own profile"""
     return jsonify(current_user.to_dict())
 
 @user_bp.route('/profile', methods=['PUT'])
-@token_required
+@auth_required()
 def update_current_user_profile(current_user):
     """Update current user's own profile"""
     data = request.json
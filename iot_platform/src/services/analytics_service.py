@@ -2,12 +2,49 @@ import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 from typing import Dict, List, Any, Optional
+from sqlalchemy.orm import Session, object_session
 from src.models.user import db
 from src.models.device import Device, DeviceData
+from src.services.cache_service import cache
 import logging
 
 logger = logging.getLogger(__name__)
 
+# System overviews are aggregate and tolerate a few seconds of staleness
+OVERVIEW_CACHE_TTL = 10  # seconds
+_OVERVIEW_GENERATION_KEY = "analytics:overview:gen"
+
+def _overview_cache_key(hours):
+    # Keys embed a generation so any device write retires every hours variant at once
+    return f"analytics:overview:{cache.get(_OVERVIEW_GENERATION_KEY) or 0}:{hours}"
+
+def _bump_overview_generation():
+    cache.set(_OVERVIEW_GENERATION_KEY, datetime.utcnow().timestamp(), OVERVIEW_CACHE_TTL)
+
+_OVERVIEW_STALE = 'overview_stale'  # Session.info key
+
+# ORM device writes retire the overview once committed; bumping at flush would
+# let a rebuild cache pre-commit data under the new generation. Core UPDATEs
+# (MQTT flush, telemetry last_seen) don't fire these and rely on the TTL.
+@db.event.listens_for(Device, 'after_insert')
+@db.event.listens_for(Device, 'after_update')
+@db.event.listens_for(Device, 'after_delete')
+def _invalidate_overview_cache(mapper, connection, target):
+    session = object_session(target)
+    if session is None:
+        _bump_overview_generation()
+    else:
+        session.info[_OVERVIEW_STALE] = True
+
+@db.event.listens_for(Session, 'after_commit')
+def _retire_stale_overview(session):
+    if session.info.pop(_OVERVIEW_STALE, False):
+        _bump_overview_generation()
+
+@db.event.listens_for(Session, 'after_rollback')
+def _discard_stale_overview(session):
+    session.info.pop(_OVERVIEW_STALE, None)
+
 class AnalyticsService:
     """
     Service for advanced analytics and data processing of IoT device data
@@ -37,38 +74,43 @@ class AnalyticsService:
                 'unit': dp.unit
             } for dp in data_points])
             
-            # Group by data type and calculate statistics
-            stats = {}
-            for data_type in df['data_type'].unique():
-                type_data = df[df['data_type'] == data_type]['value']
-                
-                stats[data_type] = {
-                    'count': len(type_data),
-                    'mean': float(type_data.mean()),
-                    'median': float(type_data.median()),
-                    'std': float(type_data.std()) if len(type_data) > 1 else 0,
-                    'min': float(type_data.min()),
-                    'max': float(type_data.max()),
-                    'latest': float(type_data.iloc[-1]) if len(type_data) > 0 else None,
-                    'unit': df[df['data_type'] == data_type]['unit'].iloc[0]
-                }
-            
-            return {
-                'device_id': device_id,
-                'time_period_hours': hours,
-                'total_data_points': len(data_points),
-                'data_types': list(df['data_type'].unique()),
-                'statistics': stats,
-                'time_range': {
-                    'start': df['timestamp'].min().isoformat(),
-                    'end': df['timestamp'].max().isoformat()
-                }
-            }
+            return self._statistics_from_frame(device_id, hours, df)
             
         except Exception as e:
             logger.error(f"Error calculating device statistics: {e}")
             return {"error": str(e)}
     
+    @staticmethod
+    def _statistics_from_frame(device_id: str, hours: int, df: pd.DataFrame) -> Dict[str, Any]:
+        """Per-data-type summary of a timestamp/data_type/value/unit frame"""
+        # Group by data type and calculate statistics
+        stats = {}
+        for data_type in df['data_type'].unique():
+            type_data = df[df['data_type'] == data_type]['value']
+            
+            stats[data_type] = {
+                'count': len(type_data),
+                'mean': float(type_data.mean()),
+                'median': float(type_data.median()),
+                'std': float(type_data.std()) if len(type_data) > 1 else 0,
+                'min': float(type_data.min()),
+                'max': float(type_data.max()),
+                'latest': float(type_data.iloc[-1]) if len(type_data) > 0 else None,
+                'unit': df[df['data_type'] == data_type]['unit'].iloc[0]
+            }
+        
+        return {
+            'device_id': device_id,
+            'time_period_hours': hours,
+            'total_data_points': len(df),
+            'data_types': list(df['data_type'].unique()),
+            'statistics': stats,
+            'time_range': {
+                'start': df['timestamp'].min().isoformat(),
+                'end': df['timestamp'].max().isoformat()
+            }
+        }
+    
     def get_aggregated_data(self, device_id: str, data_type: str, 
                           interval: str = '1H', hours: int = 24) -> List[Dict[str, Any]]:
         """Get aggregated data for visualization"""
@@ -135,47 +177,90 @@ class AnalyticsService:
                         hours: int = 24, threshold: float = 2.0) -> List[Dict[str, Any]]:
         """Detect anomalies in device data using statistical methods"""
         try:
-            # Get data for analysis
+            # Get data for analysis, as (timestamp, value) rows rather than ORM objects
             since_time = datetime.utcnow() - timedelta(hours=hours)
-            data_points = DeviceData.query.filter(
-                DeviceData.device_id == device_id,
-                DeviceData.data_type == data_type,
-                DeviceData.timestamp >= since_time
-            ).order_by(DeviceData.timestamp).all()
-            
-            if len(data_points) < 10:  # Need minimum data for anomaly detection
-                return []
-            
-            # Convert to DataFrame
-            df = pd.DataFrame([{
-                'timestamp': dp.timestamp,
-                'value': dp.value
-            } for dp in data_points])
-            
-            # Calculate rolling statistics
-            df['rolling_mean'] = df['value'].rolling(window=10, center=True).mean()
-            df['rolling_std'] = df['value'].rolling(window=10, center=True).std()
-            
-            # Detect anomalies using z-score
-            df['z_score'] = np.abs((df['value'] - df['rolling_mean']) / df['rolling_std'])
-            anomalies = df[df['z_score'] > threshold].copy()
+            rows = db.session.execute(
+                db.select(DeviceData.timestamp, DeviceData.value)
+                .where(
+                    DeviceData.device_id == device_id,
+                    DeviceData.data_type == data_type,
+                    DeviceData.timestamp >= since_time
+                )
+                .order_by(DeviceData.timestamp)
+            ).all()
             
-            # Convert to list of dictionaries
-            result = []
-            for _, row in anomalies.iterrows():
-                result.append({
-                    'timestamp': row['timestamp'].isoformat(),
-                    'value': float(row['value']),
-                    'expected_value': float(row['rolling_mean']) if not pd.isna(row['rolling_mean']) else None,
-                    'z_score': float(row['z_score']) if not pd.isna(row['z_score']) else None,
-                    'severity': 'high' if row['z_score'] > threshold * 1.5 else 'medium'
-                })
+            timestamps = [row[0] for row in rows]
+            values = np.fromiter((row[1] for row in rows), dtype=np.float64, count=len(rows))
+            return self._rolling_anomalies(timestamps, values, threshold)
             
+        except Exception as e:
+            logger.error(f"Error detecting anomalies: {e}")
+            return []
+    
+    def detect_anomalies_bulk(self, device_ids: List[str], data_type: str = 'temperature',
+                              hours: int = 24, threshold: float = 2.0) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        detect_anomalies for several devices at once: one query for all of
+        their readings, then the same rolling z-scores per device slice.
+        Returns {device_id: anomalies}; devices without anomalies are omitted.
+        """
+        if not device_ids:
+            return {}
+        try:
+            since_time = datetime.utcnow() - timedelta(hours=hours)
+            rows = db.session.execute(
+                db.select(Device.device_id, DeviceData.timestamp, DeviceData.value)
+                .join(DeviceData.device)
+                .where(
+                    Device.device_id.in_(device_ids),
+                    DeviceData.data_type == data_type,
+                    DeviceData.timestamp >= since_time
+                )
+                .order_by(Device.device_id, DeviceData.timestamp)
+            ).all()
+            if not rows:
+                return {}
+            
+            owners = [row[0] for row in rows]
+            timestamps = [row[1] for row in rows]
+            values = np.fromiter((row[2] for row in rows), dtype=np.float64, count=len(rows))
+            
+            # Rows are grouped by device, so each device is one contiguous slice
+            result = {}
+            bounds = [0] + [i for i in range(1, len(owners)) if owners[i] != owners[i - 1]] + [len(owners)]
+            for begin, end in zip(bounds, bounds[1:]):
+                anomalies = self._rolling_anomalies(timestamps[begin:end], values[begin:end], threshold)
+                if anomalies:
+                    result[owners[begin]] = anomalies
             return result
             
         except Exception as e:
             logger.error(f"Error detecting anomalies: {e}")
+            return {}
+    
+    @staticmethod
+    def _rolling_anomalies(timestamps: List[datetime], values: np.ndarray,
+                           threshold: float) -> List[Dict[str, Any]]:
+        """
+        Flag readings more than threshold rolling standard deviations from the
+        centered 10-reading rolling mean. Only the flagged rows become dicts.
+        """
+        if len(values) < 10:  # Need minimum data for anomaly detection
             return []
+        
+        rolling = pd.Series(values).rolling(window=10, center=True)
+        rolling_mean = rolling.mean().to_numpy()
+        rolling_std = rolling.std().to_numpy()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z_scores = np.abs((values - rolling_mean) / rolling_std)
+        
+        return [{
+            'timestamp': timestamps[i].isoformat(),
+            'value': float(values[i]),
+            'expected_value': float(rolling_mean[i]),
+            'z_score': float(z_scores[i]),
+            'severity': 'high' if z_scores[i] > threshold * 1.5 else 'medium'
+        } for i in np.flatnonzero(z_scores > threshold)]  # NaN windows compare False
     
     def get_device_health_score(self, device_id: str, hours: int = 24) -> Dict[str, Any]:
         """Calculate a health score for a device based on various metrics"""
@@ -186,81 +271,146 @@ class AnalyticsService:
             
             # Get recent data
             since_time = datetime.utcnow() - timedelta(hours=hours)
-            data_points = DeviceData.query.filter(
-                DeviceData.device_id == device_id,
-                DeviceData.timestamp >= since_time
-            ).all()
-            
-            # Calculate health metrics
-            health_score = 100  # Start with perfect score
-            issues = []
-            
-            # Check data availability (30% of score)
-            expected_data_points = hours * 12  # Assuming data every 5 minutes
-            actual_data_points = len(data_points)
-            data_availability = min(actual_data_points / expected_data_points, 1.0) * 100
-            
-            if data_availability < 80:
-                health_score -= (100 - data_availability) * 0.3
-                issues.append(f"Low data availability: {data_availability:.1f}%")
-            
-            # Check device status (20% of score)
-            if device.status != 'online':
-                health_score -= 20
-                issues.append(f"Device status: {device.status}")
-            
-            # Check last seen time (20% of score)
-            if device.last_seen:
-                time_since_last_seen = (datetime.utcnow() - device.last_seen).total_seconds() / 3600
-                if time_since_last_seen > 1:  # More than 1 hour
-                    health_score -= min(time_since_last_seen * 5, 20)
-                    issues.append(f"Last seen {time_since_last_seen:.1f} hours ago")
-            
-            # Check for anomalies (30% of score)
-            if data_points:
-                df = pd.DataFrame([{'value': dp.value, 'data_type': dp.data_type} for dp in data_points])
-                for data_type in df['data_type'].unique():
-                    anomalies = self.detect_anomalies(device_id, data_type, hours=hours)
-                    if anomalies:
-                        anomaly_penalty = min(len(anomalies) * 2, 30)
-                        health_score -= anomaly_penalty
-                        issues.append(f"{len(anomalies)} anomalies detected in {data_type}")
-            
-            # Ensure score doesn't go below 0
-            health_score = max(health_score, 0)
-            
-            # Determine health status
-            if health_score >= 90:
-                status = "excellent"
-            elif health_score >= 75:
-                status = "good"
-            elif health_score >= 50:
-                status = "fair"
-            elif health_score >= 25:
-                status = "poor"
-            else:
-                status = "critical"
-            
-            return {
-                'device_id': device_id,
-                'health_score': round(health_score, 1),
-                'status': status,
-                'data_availability': round(data_availability, 1),
-                'issues': issues,
-                'metrics': {
-                    'total_data_points': actual_data_points,
-                    'expected_data_points': expected_data_points,
-                    'device_status': device.status,
-                    'last_seen': device.last_seen.isoformat() if device.last_seen else None
-                }
+            data_types = db.session.execute(
+                db.select(DeviceData.data_type).where(
+                    DeviceData.device_id == device_id,
+                    DeviceData.timestamp >= since_time
+                )
+            ).scalars().all()
+            
+            anomalies_by_type = {
+                data_type: self.detect_anomalies(device_id, data_type, hours=hours)
+                for data_type in dict.fromkeys(data_types)
             }
+            return self._health_score(device, hours, len(data_types), anomalies_by_type)
             
         except Exception as e:
             logger.error(f"Error calculating device health score: {e}")
             return {"error": str(e)}
     
+    @staticmethod
+    def _health_score(device: Device, hours: int, actual_data_points: int,
+                      anomalies_by_type: Dict[str, List[Dict[str, Any]]]) -> Dict[str, Any]:
+        """Score a device from its reading count, status and detected anomalies"""
+        # Calculate health metrics
+        health_score = 100  # Start with perfect score
+        issues = []
+        
+        # Check data availability (30% of score)
+        expected_data_points = hours * 12  # Assuming data every 5 minutes
+        data_availability = min(actual_data_points / expected_data_points, 1.0) * 100
+        
+        if data_availability < 80:
+            health_score -= (100 - data_availability) * 0.3
+            issues.append(f"Low data availability: {data_availability:.1f}%")
+        
+        # Check device status (20% of score)
+        if device.status != 'online':
+            health_score -= 20
+            issues.append(f"Device status: {device.status}")
+        
+        # Check last seen time (20% of score)
+        if device.last_seen:
+            time_since_last_seen = (datetime.utcnow() - device.last_seen).total_seconds() / 3600
+            if time_since_last_seen > 1:  # More than 1 hour
+                health_score -= min(time_since_last_seen * 5, 20)
+                issues.append(f"Last seen {time_since_last_seen:.1f} hours ago")
+        
+        # Check for anomalies (30% of score)
+        for data_type, anomalies in anomalies_by_type.items():
+            if anomalies:
+                anomaly_penalty = min(len(anomalies) * 2, 30)
+                health_score -= anomaly_penalty
+                issues.append(f"{len(anomalies)} anomalies detected in {data_type}")
+        
+        # Ensure score doesn't go below 0
+        health_score = max(health_score, 0)
+        
+        # Determine health status
+        if health_score >= 90:
+            status = "excellent"
+        elif health_score >= 75:
+            status = "good"
+        elif health_score >= 50:
+            status = "fair"
+        elif health_score >= 25:
+            status = "poor"
+        else:
+            status = "critical"
+        
+        return {
+            'device_id': device.device_id,
+            'health_score': round(health_score, 1),
+            'status': status,
+            'data_availability': round(data_availability, 1),
+            'issues': issues,
+            'metrics': {
+                'total_data_points': actual_data_points,
+                'expected_data_points': expected_data_points,
+                'device_status': device.status,
+                'last_seen': device.last_seen
+            }
+        }
+    
+    def generate_report_bundle(self, device_id: str, hours: int = 168):
+        """
+        Statistics, health score and anomalies for a device report from a
+        single telemetry query. Returns (statistics, health, anomalies_by_type)
+        with the same shapes as get_device_statistics, get_device_health_score
+        and detect_anomalies; data types without anomalies are omitted.
+        """
+        try:
+            device = Device.query.filter_by(device_id=device_id).first()
+            if not device:
+                error = {"error": "Device not found"}
+                return error, error, {}
+            
+            since_time = datetime.utcnow() - timedelta(hours=hours)
+            rows = db.session.execute(
+                db.select(DeviceData.timestamp, DeviceData.data_type, DeviceData.value, DeviceData.unit)
+                .where(
+                    DeviceData.device_id == device_id,
+                    DeviceData.timestamp >= since_time
+                )
+                .order_by(DeviceData.timestamp)
+            ).all()
+            
+            if not rows:
+                return {"error": "No data available"}, self._health_score(device, hours, 0, {}), {}
+            
+            df = pd.DataFrame(rows, columns=['timestamp', 'data_type', 'value', 'unit'])
+            statistics = self._statistics_from_frame(device_id, hours, df)
+            
+            # Rows are time-ordered, so each data type's positions are too
+            timestamps = [row[0] for row in rows]
+            values = df['value'].to_numpy(dtype=np.float64)
+            positions = df.groupby('data_type', sort=False).indices
+            anomalies_by_type = {}
+            for data_type in df['data_type'].unique():
+                idx = positions[data_type]
+                anomalies_by_type[data_type] = self._rolling_anomalies(
+                    [timestamps[i] for i in idx], values[idx], 2.0
+                )
+            
+            health = self._health_score(device, hours, len(rows), anomalies_by_type)
+            return statistics, health, {k: v for k, v in anomalies_by_type.items() if v}
+            
+        except Exception as e:
+            logger.error(f"Error generating report bundle: {e}")
+            error = {"error": str(e)}
+            return error, error, {}
+    
     def get_system_overview(self, hours: int = 24) -> Dict[str, Any]:
-        """Get system-wide analytics overview"""
+        """Get system-wide analytics overview, cached for OVERVIEW_CACHE_TTL seconds"""
+        key = _overview_cache_key(hours)
+        overview = cache.get(key)
+        if overview is None:
+            overview = self._build_system_overview(hours)
+            if 'error' not in overview:
+                cache.set(key, overview, OVERVIEW_CACHE_TTL)
+        return overview
+    
+    def _build_system_overview(self, hours: int) -> Dict[str, Any]:
         try:
             # Get all devices
             devices = Device.query.all()
@@ -286,7 +436,7 @@ class AnalyticsService:
                     health_scores.append(health['health_score'])
                     device_health[device.device_id] = health
             
-            avg_health_score = np.mean(health_scores) if health_scores else 0
+            avg_health_score = float(np.mean(health_scores)) if health_scores else 0
             
             # Get data by device type
             device_types = {}
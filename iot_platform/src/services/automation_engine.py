@@ -1,4 +1,3 @@
-import json
 import threading
 import time
 import logging
@@ -64,7 +63,7 @@ class AutomationEngine:
         """Evaluate a single automation rule"""
         try:
             # Parse trigger condition
-            trigger_condition = json.loads(rule.trigger_condition)
+            trigger_condition = rule.trigger_condition
             
             # Check if rule should be evaluated (avoid too frequent evaluations)
             rule_key = f"rule_{rule.id}"
@@ -79,7 +78,7 @@ class AutomationEngine:
                 logger.info(f"Rule {rule.id} ({rule.name}) triggered")
                 
                 # Execute the action
-                action_command = json.loads(rule.action_command)
+                action_command = rule.action_command
                 self._execute_action(rule.action_device_id, action_command)
                 
                 # Update last evaluation time
@@ -376,22 +375,22 @@ def create_sample_rules():
             name="Motion Activated Lights",
             description="Turn on living room light when motion is detected in hallway",
             trigger_device_id="motion_001",
-            trigger_condition=json.dumps({
+            trigger_condition={
                 "type": "value_threshold",
                 "data_type": "motion",
                 "operator": "eq",
                 "threshold": 1,
                 "time_window_minutes": 1,
                 "min_interval_seconds": 30
-            }),
+            },
             action_device_id="light_001",
-            action_command=json.dumps({
+            action_command={
                 "type": "device_command",
                 "command": {
                     "action": "turn_on",
                     "brightness": 80
                 }
-            }),
+            },
             user_id=1
         )
         
@@ -400,20 +399,20 @@ def create_sample_rules():
             name="High Temperature Alert",
             description="Send notification when temperature exceeds 25°C",
             trigger_device_id="temp_001",
-            trigger_condition=json.dumps({
+            trigger_condition={
                 "type": "value_threshold",
                 "data_type": "temperature",
                 "operator": "gt",
                 "threshold": 25.0,
                 "time_window_minutes": 5,
                 "min_interval_seconds": 300  # 5 minutes
-            }),
+            },
             action_device_id="",
-            action_command=json.dumps({
+            action_command={
                 "type": "notification",
                 "message": "High temperature detected in Living Room",
                 "notification_type": "log"
-            }),
+            },
             user_id=1
         )
         
@@ -422,14 +421,14 @@ def create_sample_rules():
             name="Evening Lights",
             description="Turn on all lights at sunset",
             trigger_device_id="",
-            trigger_condition=json.dumps({
+            trigger_condition={
                 "type": "time_based",
                 "time_type": "time_of_day",
                 "start_time": "18:00",
                 "end_time": "18:01"
-            }),
+            },
             action_device_id="light_001",
-            action_command=json.dumps({
+            action_command={
                 "type": "sequence",
                 "actions": [
                     {
@@ -443,7 +442,7 @@ def create_sample_rules():
                         "command": {"action": "turn_on", "brightness": 60}
                     }
                 ]
-            }),
+            },
             user_id=1
         )
         
@@ -0,0 +1,72 @@
+import os
+import logging
+import threading
+import orjson
+from cachetools import TLRUCache
+
+# Redis is optional: without it (or without REDIS_URL) values live in-process
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+class CacheService:
+    """
+    Small key/value cache with per-key TTLs.
+    Uses Redis when a URL is configured so all workers share entries,
+    otherwise falls back to a per-process TTL cache. Values must be
+    JSON-serializable; both backends store them as orjson bytes.
+    """
+    
+    def __init__(self, url=None, maxsize=10000):
+        self._redis = None
+        if url and redis is not None:
+            self._redis = redis.Redis.from_url(url, socket_timeout=0.5)
+        # Entries are (ttl, value); the TTL sets each entry's expiry time
+        self._local = TLRUCache(maxsize=maxsize, ttu=lambda key, entry, now: now + entry[0])
+        self._lock = threading.Lock()
+    
+    @property
+    def backend(self):
+        return 'redis' if self._redis is not None else 'memory'
+    
+    def get(self, key):
+        """Return the cached value, or None on a miss"""
+        if self._redis is not None:
+            try:
+                raw = self._redis.get(key)
+            except redis.RedisError as e:
+                logger.warning(f"Cache read failed for {key}: {e}")
+                return None
+        else:
+            with self._lock:
+                entry = self._local.get(key)
+            raw = entry[1] if entry else None
+        return orjson.loads(raw) if raw is not None else None
+    
+    def set(self, key, value, ttl):
+        """Store a value for ttl seconds"""
+        raw = orjson.dumps(value)
+        if self._redis is not None:
+            try:
+                self._redis.setex(key, int(ttl), raw)
+            except redis.RedisError as e:
+                logger.warning(f"Cache write failed for {key}: {e}")
+        else:
+            with self._lock:
+                self._local[key] = (ttl, raw)
+    
+    def delete(self, key):
+        if self._redis is not None:
+            try:
+                self._redis.delete(key)
+            except redis.RedisError as e:
+                logger.warning(f"Cache delete failed for {key}: {e}")
+        else:
+            with self._lock:
+                self._local.pop(key, None)
+
+# Global cache instance
+cache = CacheService(os.getenv('REDIS_URL'))
@@ -1,12 +1,30 @@
 import paho.mqtt.client as mqtt
-import json
+import orjson
+import math
 import threading
+import time
 from datetime import datetime
+from sqlalchemy import bindparam
 from src.models.user import db
 from src.models.device import Device, DeviceData
+from src.services.retention_service import RetentionService
 import logging
 
+def parse_timestamp(value):
+    """Parse a payload timestamp: epoch milliseconds (int) or an ISO 8601 string"""
+    if value is None:
+        return datetime.utcnow()
+    if isinstance(value, (int, float)):
+        return datetime.utcfromtimestamp(value / 1000)
+    return datetime.fromisoformat(value)
+
 class MQTTService:
+    # Telemetry is buffered and written in bulk when either limit is reached
+    FLUSH_SIZE = 10000  # readings
+    FLUSH_INTERVAL = 1.0  # seconds
+    # How often the flush thread makes sure upcoming device_data partitions exist
+    PARTITION_CHECK_INTERVAL = 3600  # seconds
+    
     def __init__(self, app, broker_host='localhost', broker_port=1883):
         self.app = app
         self.broker_host = broker_host
@@ -17,6 +35,15 @@ class MQTTService:
         self.client.on_disconnect = self.on_disconnect
         self.is_connected = False
         
+        # Buffered telemetry: DeviceData rows and last-seen info per device
+        self._pending = []
+        self._seen = {}  # device_id -> (last_seen, device_type)
+        # Status messages share the buffer so they apply in arrival order with telemetry
+        self._statuses = {}  # device_id -> (status, received_at)
+        self._buffer_lock = threading.Lock()
+        self._flush_now = threading.Event()
+        self._flush_thread = None
+        
         # Setup logging
         logging.basicConfig(level=logging.INFO)
         self.logger = logging.getLogger(__name__)
@@ -30,6 +57,7 @@ class MQTTService:
             client.subscribe("devices/+/data")  # Listen to all device data
             client.subscribe("devices/+/status")  # Listen to device status updates
             client.subscribe("gateway/+/data")  # Listen to gateway data
+            client.subscribe("gateway/+/batch")  # Listen to batched device data from gateways
         else:
             self.logger.error(f"Failed to connect to MQTT broker, return code {rc}")
     
@@ -46,13 +74,15 @@ class MQTTService:
                 device_id = topic_parts[1]
                 message_type = topic_parts[2]
                 
-                payload = json.loads(msg.payload.decode())
+                payload = orjson.loads(msg.payload)
                 
                 with self.app.app_context():
                     if message_type == 'data':
                         self.handle_device_data(device_id, payload)
                     elif message_type == 'status':
                         self.handle_device_status(device_id, payload)
+                    elif message_type == 'batch':
+                        self.handle_gateway_batch(device_id, payload)
                         
         except Exception as e:
             self.logger.error(f"Error processing MQTT message: {e}")
@@ -60,61 +90,172 @@ class MQTTService:
     def handle_device_data(self, device_id, payload):
         """Handle incoming device data"""
         try:
-            # Check if device exists, create if not
-            device = Device.query.filter_by(device_id=device_id).first()
-            if not device:
-                # Auto-register device
-                device = Device(
-                    device_id=device_id,
-                    name=f"Auto-registered {device_id}",
-                    device_type=payload.get('device_type', 'sensor'),
-                    user_id=1,  # Default to user 1 for demo
-                    status='online'
-                )
-                db.session.add(device)
-                db.session.commit()
-                self.logger.info(f"Auto-registered device: {device_id}")
-            
-            # Update device last seen
-            device.last_seen = datetime.utcnow()
-            device.status = 'online'
-            
-            # Store device data
-            for data_type, value in payload.get('data', {}).items():
-                device_data = DeviceData(
-                    device_id=device_id,
-                    data_type=data_type,
-                    value=float(value),
-                    unit=payload.get('units', {}).get(data_type),
-                    timestamp=datetime.fromisoformat(payload['timestamp']) if 'timestamp' in payload else datetime.utcnow()
-                )
-                db.session.add(device_data)
-            
-            db.session.commit()
-            self.logger.info(f"Stored data for device: {device_id}")
-            
+            self._buffer_device_data(device_id, payload)
         except Exception as e:
             self.logger.error(f"Error handling device data: {e}")
-            db.session.rollback()
     
-    def handle_device_status(self, device_id, payload):
-        """Handle device status updates"""
+    def handle_gateway_batch(self, gateway_id, messages):
+        """Handle a batch of device data messages published by a gateway"""
         try:
-            device = Device.query.filter_by(device_id=device_id).first()
-            if device:
-                device.status = payload.get('status', 'unknown')
-                device.last_seen = datetime.utcnow()
-                db.session.commit()
-                self.logger.info(f"Updated status for device {device_id}: {device.status}")
+            for message in messages:
+                self._buffer_device_data(message['device_id'], message)
+            self.logger.debug(f"Buffered batch of {len(messages)} messages from gateway: {gateway_id}")
         except Exception as e:
-            self.logger.error(f"Error handling device status: {e}")
-            db.session.rollback()
+            self.logger.error(f"Error handling gateway batch: {e}")
+    
+    def _buffer_device_data(self, device_id, payload):
+        """Queue a device data message for the next bulk flush"""
+        timestamp = parse_timestamp(payload.get('timestamp'))
+        units = payload.get('units', {})
+        records = []
+        for data_type, value in payload.get('data', {}).items():
+            value = float(value)
+            # NaN/inf would fail the whole bulk write at flush time
+            if not math.isfinite(value):
+                self.logger.warning(f"Dropped non-finite {data_type} reading from {device_id}")
+                continue
+            records.append({
+                'device_id': device_id,
+                'data_type': data_type,
+                'value': value,
+                'unit': units.get(data_type),
+                'timestamp': timestamp
+            })
+        
+        with self._buffer_lock:
+            self._pending.extend(records)
+            self._seen[device_id] = (datetime.utcnow(), payload.get('device_type', 'sensor'))
+            # Newer telemetry means the device is online again
+            self._statuses.pop(device_id, None)
+            full = len(self._pending) >= self.FLUSH_SIZE
+        if full:
+            self._flush_now.set()
+    
+    def flush_device_data(self):
+        """
+        Write buffered telemetry in one transaction. If that fails the batch
+        is retried one device at a time, so a bad reading only costs its own
+        device's share of the buffer.
+        """
+        with self._buffer_lock:
+            records, self._pending = self._pending, []
+            seen, self._seen = self._seen, {}
+            statuses, self._statuses = self._statuses, {}
+        if not seen and not statuses:
+            return
+        
+        with self.app.app_context():
+            try:
+                self._store_device_data(records, seen, statuses)
+                return
+            except Exception as e:
+                self.logger.error(f"Error storing device data: {e}")
+                db.session.rollback()
+            if len(seen.keys() | statuses.keys()) == 1:
+                return
+            
+            by_device = {device_id: [] for device_id in seen.keys() | statuses.keys()}
+            for record in records:
+                by_device[record['device_id']].append(record)
+            for device_id, device_records in by_device.items():
+                try:
+                    self._store_device_data(
+                        device_records,
+                        {device_id: seen[device_id]} if device_id in seen else {},
+                        {device_id: statuses[device_id]} if device_id in statuses else {}
+                    )
+                except Exception as e:
+                    self.logger.error(f"Dropped {len(device_records)} readings from {device_id}: {e}")
+                    db.session.rollback()
+    
+    def _store_device_data(self, records, seen, statuses):
+        """
+        Register unknown devices, update last seen and insert the readings,
+        then apply status messages that arrived after them, and commit
+        """
+        devices = Device.__table__
+        if seen:
+            # Auto-register devices we have not seen before
+            device_pks = dict(db.session.query(Device.device_id, Device.id).filter(Device.device_id.in_(seen)))
+            new_devices = []
+            for device_id, (_, device_type) in seen.items():
+                if device_id not in device_pks:
+                    new_devices.append(Device(
+                        device_id=device_id,
+                        name=f"Auto-registered {device_id}",
+                        device_type=device_type,
+                        user_id=1,  # Default to user 1 for demo
+                        status='online'
+                    ))
+                    self.logger.info(f"Auto-registered device: {device_id}")
+            db.session.add_all(new_devices)
+            db.session.flush()
+            device_pks.update((device.device_id, device.id) for device in new_devices)
+            
+            # Update device last seen
+            db.session.execute(
+                devices.update()
+                .where(devices.c.device_id == bindparam('b_device_id'))
+                .values(last_seen=bindparam('b_last_seen'), status='online'),
+                [{'b_device_id': device_id, 'b_last_seen': last_seen}
+                 for device_id, (last_seen, _) in seen.items()]
+            )
+            
+            # Store device data; copies, so the caller can retry with the same records
+            rows = []
+            for record in records:
+                row = dict(record)
+                row['device_pk'] = device_pks[row.pop('device_id')]
+                rows.append(row)
+            DeviceData.bulk_create(rows)
+        
+        if statuses:
+            # Applied last, so a status sent after a device's final reading wins
+            db.session.execute(
+                devices.update()
+                .where(devices.c.device_id == bindparam('b_device_id'))
+                .values(status=bindparam('b_status'), last_seen=bindparam('b_last_seen')),
+                [{'b_device_id': device_id, 'b_status': status, 'b_last_seen': received_at}
+                 for device_id, (status, received_at) in statuses.items()]
+            )
+        
+        db.session.commit()
+        self.logger.info(f"Stored {len(records)} readings from {len(seen)} devices, {len(statuses)} status updates")
+    
+    def _flush_loop(self):
+        """
+        Flush buffered telemetry every FLUSH_INTERVAL, or sooner when the buffer
+        fills. Upcoming partitions are created at startup and then every
+        PARTITION_CHECK_INTERVAL.
+        """
+        next_partition_check = 0
+        while True:
+            if time.monotonic() >= next_partition_check:
+                self.ensure_partitions()
+                next_partition_check = time.monotonic() + self.PARTITION_CHECK_INTERVAL
+            self._flush_now.wait(self.FLUSH_INTERVAL)
+            self._flush_now.clear()
+            self.flush_device_data()
+    
+    def ensure_partitions(self):
+        """Create upcoming device_data partitions (no-op unless partitioned)"""
+        with self.app.app_context():
+            try:
+                RetentionService.ensure_partitions()
+            except Exception as e:
+                self.logger.error(f"Error creating device_data partitions: {e}")
+                db.session.rollback()
+    
+    def handle_device_status(self, device_id, payload):
+        """Queue a device status update for the next flush, after any buffered telemetry"""
+        with self._buffer_lock:
+            self._statuses[device_id] = (payload.get('status', 'unknown'), datetime.utcnow())
     
     def publish_command(self, device_id, command):
         """Send a command to a device"""
         if self.is_connected:
             topic = f"devices/{device_id}/commands"
-            payload = json.dumps(command)
+            payload = orjson.dumps(command)
             self.client.publish(topic, payload)
             self.logger.info(f"Sent command to {device_id}: {command}")
             return True
@@ -123,6 +264,8 @@ class MQTTService:
     def start(self):
         """Start the MQTT service"""
         try:
+            self._flush_thread = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flush_thread.start()
             self.client.connect(self.broker_host, self.broker_port, 60)
             # Start the network loop in a separate thread
             self.client.loop_start()
@@ -136,6 +279,7 @@ class MQTTService:
             self.client.loop_stop()
             self.client.disconnect()
             self.logger.info("MQTT service stopped")
+        self.flush_device_data()
 
 # Global MQTT service instance
 mqtt_service = None
@@ -245,6 +245,15 @@ class RBACService:
         
         return user.get_permissions()
     
+    @staticmethod
+    def get_user_permission_dicts(user_id):
+        """Serialized permissions for a user, from the per-role cache"""
+        user = User.query.get(user_id)
+        if not user:
+            return []
+        
+        return user.get_permission_dicts()
+    
     @staticmethod
     def check_user_permission(user_id, resource, action):
         """Check if a user has a specific permission"""
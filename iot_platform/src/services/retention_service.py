@@ -0,0 +1,90 @@
+"""
+Retention service for device telemetry
+"""
+import re
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import text, delete, select
+from src.models.user import db
+from src.models.device import DeviceData
+
+logger = logging.getLogger(__name__)
+
+# Monthly partitions created by create_device_data_partition() in the postgres init SQL
+_PARTITION_RE = re.compile(r'^device_data_y(\d{4})m(\d{2})$')
+
+def _next_month(year, month):
+    return (year + 1, 1) if month == 12 else (year, month + 1)
+
+class RetentionService:
+    """Service class for expiring old telemetry"""
+
+    # Rows per DELETE when the table isn't partitioned
+    DELETE_BATCH_SIZE = 10000
+
+    @staticmethod
+    def is_partitioned():
+        """True when device_data is a partitioned postgres table"""
+        if db.engine.dialect.name != 'postgresql':
+            return False
+        relkind = db.session.execute(text(
+            "SELECT c.relkind FROM pg_class c WHERE c.oid = to_regclass('device_data')"
+        )).scalar()
+        return relkind == 'p'
+
+    @staticmethod
+    def ensure_partitions(months_ahead=2):
+        """Create monthly partitions from the current month up to months_ahead"""
+        if not RetentionService.is_partitioned():
+            return
+        now = datetime.utcnow()
+        year, month = now.year, now.month
+        for _ in range(months_ahead + 1):
+            db.session.execute(text('SELECT create_device_data_partition(:month_start)'),
+                               {'month_start': f'{year:04d}-{month:02d}-01'})
+            year, month = _next_month(year, month)
+        db.session.commit()
+
+    @staticmethod
+    def purge_device_data(older_than_days):
+        """
+        Remove telemetry older than older_than_days.
+        On a partitioned table only whole months that end before the cutoff
+        are dropped, so rows up to a month past the cutoff may remain.
+        Returns the dropped partition names or the number of deleted rows.
+        """
+        cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+
+        if RetentionService.is_partitioned():
+            names = db.session.execute(text(
+                "SELECT c.relname FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = to_regclass('device_data')"
+            )).scalars().all()
+
+            dropped = []
+            for name in sorted(names):
+                match = _PARTITION_RE.match(name)
+                if not match:
+                    continue
+                year, month = _next_month(int(match.group(1)), int(match.group(2)))
+                if datetime(year, month, 1) <= cutoff:
+                    db.session.execute(text(f'DROP TABLE IF EXISTS "{name}"'))
+                    dropped.append(name)
+            # Back-dated readings that fell into the default partition
+            db.session.execute(text('DELETE FROM device_data_default WHERE timestamp < :cutoff'),
+                               {'cutoff': cutoff})
+            db.session.commit()
+            logger.info(f"Dropped device_data partitions: {dropped}")
+            return dropped
+
+        deleted = 0
+        while True:
+            ids = select(DeviceData.id).where(DeviceData.timestamp < cutoff).limit(RetentionService.DELETE_BATCH_SIZE)
+            result = db.session.execute(delete(DeviceData).where(DeviceData.id.in_(ids)))
+            db.session.commit()
+            deleted += result.rowcount
+            if result.rowcount < RetentionService.DELETE_BATCH_SIZE:
+                break
+        logger.info(f"Deleted {deleted} device_data rows older than {cutoff}")
+        return deleted
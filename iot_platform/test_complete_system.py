@@ -10,6 +10,7 @@ import sys
 import os
 import threading
 import subprocess
+from datetime import datetime
 
 # Add the project root to Python path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -101,6 +102,132 @@ class SystemTester:
             else:
                 self.log_result("Device availability", False, "No devices found")
     
+    def create_test_device(self, prefix, headers):
+        """Create a throwaway device owned by the caller, returning its device_id"""
+        device_id = f"{prefix}_{int(time.time() * 1000)}"
+        device = {"device_id": device_id, "name": f"System Test {prefix}", "device_type": "sensor"}
+        response = requests.post(f"{API_BASE}/devices", json=device, headers=headers)
+        if response.status_code != 201:
+            self.log_result(f"Create {prefix} device", False, f"Status: {response.status_code}")
+            return None
+        return device_id
+    
+    def test_bulk_ingest(self):
+        """Test bulk device data ingestion"""
+        print("\n=== Testing Bulk Ingest ===")
+        
+        headers = {"Authorization": f"Bearer {self.admin_token}"}
+        device_id = self.create_test_device("systest_bulk", headers)
+        if not device_id:
+            return
+        url = f"{API_BASE}/devices/{device_id}/data/bulk"
+        
+        try:
+            # Valid batch
+            samples = [{"data_type": "temperature", "value": 20.0 + i, "unit": "C"} for i in range(3)]
+            response = requests.post(url, json={"samples": samples}, headers=headers)
+            self.log_result("Bulk ingest", response.status_code == 201 and response.json().get('inserted') == 3,
+                            f"Status: {response.status_code}")
+            
+            # More than MAX_BULK_SAMPLES (10000) in one request
+            samples = [{"data_type": "temperature", "value": 20.0}] * 10001
+            response = requests.post(url, json={"samples": samples}, headers=headers)
+            self.log_result("Bulk ingest cap enforced", response.status_code == 400, f"Status: {response.status_code}")
+            
+            # Non-finite readings are rejected rather than stored
+            for value in ("nan", "inf", "-inf"):
+                samples = [{"data_type": "temperature", "value": 20.0}, {"data_type": "temperature", "value": value}]
+                response = requests.post(url, json={"samples": samples}, headers=headers)
+                self.log_result(f"Bulk ingest rejects {value}", response.status_code == 400, f"Status: {response.status_code}")
+            
+            # Body and samples must be objects
+            response = requests.post(url, json=[{"data_type": "temperature", "value": 20.0}], headers=headers)
+            self.log_result("Bulk ingest rejects non-object body", response.status_code == 400, f"Status: {response.status_code}")
+            response = requests.post(url, json={"samples": [20.0]}, headers=headers)
+            self.log_result("Bulk ingest rejects non-object sample", response.status_code == 400, f"Status: {response.status_code}")
+            
+            # Nothing from the rejected batches was stored
+            response = requests.get(f"{API_BASE}/devices/{device_id}/data", headers=headers)
+            self.log_result("Rejected batches not stored", response.status_code == 200 and len(response.json()) == 3,
+                            f"Status: {response.status_code}")
+        finally:
+            requests.delete(f"{API_BASE}/devices/{device_id}", headers=headers)
+    
+    def test_data_paging(self):
+        """Test keyset paging of device data"""
+        print("\n=== Testing Device Data Paging ===")
+        
+        headers = {"Authorization": f"Bearer {self.admin_token}"}
+        device_id = self.create_test_device("systest_paging", headers)
+        if not device_id:
+            return
+        url = f"{API_BASE}/devices/{device_id}/data"
+        
+        try:
+            # Five readings sharing one timestamp, so pages split inside a tie
+            timestamp = datetime.utcnow().replace(microsecond=0).isoformat()
+            samples = [{"data_type": "temperature", "value": 20.0 + i, "timestamp": timestamp} for i in range(5)]
+            response = requests.post(f"{url}/bulk", json={"samples": samples}, headers=headers)
+            self.log_result("Seed paging data", response.status_code == 201, f"Status: {response.status_code}")
+            
+            ids, pages, cursor = [], 0, None
+            while pages < 10:
+                params = {"limit": 2}
+                if cursor:
+                    params["cursor"] = cursor
+                response = requests.get(url, params=params, headers=headers)
+                if response.status_code != 200:
+                    break
+                page = response.json()
+                ids.extend(point['id'] for point in page['data'])
+                pages += 1
+                cursor = page['next_cursor']
+                if not cursor:
+                    break
+            self.log_result("Paging across equal timestamps", len(ids) == 5 and len(set(ids)) == 5,
+                            f"Got ids {ids} in {pages} pages")
+            
+            # A malformed cursor is a client error, not a 500
+            for cursor in ("garbage", "not-a-date_1", f"{timestamp}_x"):
+                response = requests.get(url, params={"limit": 2, "cursor": cursor}, headers=headers)
+                self.log_result(f"Bad cursor rejected ({cursor})", response.status_code == 400, f"Status: {response.status_code}")
+        finally:
+            requests.delete(f"{API_BASE}/devices/{device_id}", headers=headers)
+    
+    def test_thread_network_deletion(self):
+        """Test that a Thread network in use cannot be deleted"""
+        print("\n=== Testing Thread Network Deletion ===")
+        
+        headers = {"Authorization": f"Bearer {self.admin_token}"}
+        network = {"name": "System Test Network", "network_name": "SysTestNet"}
+        response = requests.post(f"{API_BASE}/thread/networks", json=network, headers=headers)
+        if response.status_code != 201:
+            self.log_result("Create thread network", False, f"Status: {response.status_code}")
+            return
+        network_id = response.json()['id']
+        device_id = self.create_test_device("systest_thread", headers)
+        
+        try:
+            if not device_id:
+                return
+            response = requests.post(f"{API_BASE}/thread/devices/{device_id}/join",
+                                     json={"network_id": network_id}, headers=headers)
+            self.log_result("Join thread network", response.status_code == 200, f"Status: {response.status_code}")
+            
+            # devices_count tracks the join, so the network is still in use
+            response = requests.delete(f"{API_BASE}/thread/networks/{network_id}", headers=headers)
+            self.log_result("Thread network in use not deleted", response.status_code == 400, f"Status: {response.status_code}")
+            
+            response = requests.post(f"{API_BASE}/thread/devices/{device_id}/leave", headers=headers)
+            self.log_result("Leave thread network", response.status_code == 200, f"Status: {response.status_code}")
+            
+            response = requests.delete(f"{API_BASE}/thread/networks/{network_id}", headers=headers)
+            self.log_result("Empty thread network deleted", response.status_code == 200, f"Status: {response.status_code}")
+        finally:
+            if device_id:
+                requests.delete(f"{API_BASE}/devices/{device_id}", headers=headers)
+            requests.delete(f"{API_BASE}/thread/networks/{network_id}", headers=headers)
+    
     def test_automation_engine(self):
         """Test automation engine functionality"""
         print("\n=== Testing Automation Engine ===")
@@ -340,6 +467,9 @@ class SystemTester:
             
             # Run all test suites
             self.test_device_management()
+            self.test_bulk_ingest()
+            self.test_data_paging()
+            self.test_thread_network_deletion()
             self.test_automation_engine()
             self.test_analytics()
             self.test_user_management()
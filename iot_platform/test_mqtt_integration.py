@@ -79,6 +79,53 @@ def test_api_endpoints():
     except Exception as e:
         print(f"Error testing API: {e}")
 
+def test_status_after_buffered_flush():
+    """Check that a status message is applied after buffered telemetry for the same device"""
+    from types import SimpleNamespace
+    from src.main import app, db
+    from src.models.device import Device, DeviceData
+    from src.services.mqtt_service import MQTTService
+    
+    print("Testing status message after buffered telemetry...")
+    service = MQTTService(app)  # Not started; messages are fed and flushed by hand
+    device_id = f"mqtt_test_{int(time.time() * 1000)}"
+    
+    def publish(kind, payload):
+        message = SimpleNamespace(topic=f"devices/{device_id}/{kind}", payload=json.dumps(payload).encode())
+        service.on_message(None, None, message)
+    
+    def status():
+        with app.app_context():
+            return db.session.query(Device.status).filter_by(device_id=device_id).scalar()
+    
+    results = []
+    try:
+        publish('data', {'data': {'temperature': 21.0}})
+        service.flush_device_data()
+        results.append(('Telemetry registers the device as online', status() == 'online'))
+        
+        # Telemetry still in the buffer must not override a later status message
+        publish('data', {'data': {'temperature': 21.5}})
+        publish('status', {'status': 'offline'})
+        service.flush_device_data()
+        results.append(('Status after buffered telemetry wins', status() == 'offline'))
+        
+        publish('status', {'status': 'offline'})
+        publish('data', {'data': {'temperature': 22.0}})
+        service.flush_device_data()
+        results.append(('Telemetry after a status message wins', status() == 'online'))
+    finally:
+        with app.app_context():
+            device = Device.query.filter_by(device_id=device_id).first()
+            if device:
+                DeviceData.query.filter_by(device_pk=device.id).delete()
+                db.session.delete(device)
+                db.session.commit()
+    
+    for name, passed in results:
+        print(f"  {'✓' if passed else '✗'} {name}")
+    return all(passed for _, passed in results)
+
 def main():
     """Main test function"""
     print("=== IoT Platform MQTT Integration Test ===\n")
@@ -87,6 +134,9 @@ def main():
     gateway_process = None
     
     try:
+        # Buffered ingest ordering, checked against the app directly
+        test_status_after_buffered_flush()
+        
         # Start Flask application
         flask_process = start_flask_app()
         